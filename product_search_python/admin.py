@@ -15,17 +15,20 @@
 # limitations under the License.
 
 """Defines the routing for the app's admin request handlers
-(those that require administrative access)."""
-
-from admin_handlers import *
+(those that require administrative access).  As in main.py, the handlers are
+named by string, and admin_handlers.py is only loaded on the first request."""
 
 import webapp2
 
 application = webapp2.WSGIApplication(
     [
-        ('/admin/manage', AdminHandler),
-        ('/admin/create_product', CreateProductHandler),
-        ('/admin/delete_product', DeleteProductHandler)
+        ('/admin/manage', 'admin_handlers.AdminHandler'),
+        ('/admin/create_product', 'admin_handlers.CreateProductHandler'),
+        ('/admin/delete_product', 'admin_handlers.DeleteProductHandler'),
+        ('/admin/update_ratings_info', 'admin_handlers.UpdateRatingsHandler'),
+        ('/admin/ingest_reviews', 'admin_handlers.IngestReviewsHandler'),
+        ('/admin/reconcile', 'admin_handlers.ReconcileHandler'),
+        ('/admin/reinit_status', 'admin_handlers.ReinitStatusHandler')
     ],
     debug=True)
 
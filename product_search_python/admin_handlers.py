@@ -19,24 +19,28 @@ administrative access).
 """
 
 import csv
+import json
 import logging
 import os
+import time
 import urllib
 import uuid
 
 from base_handler import BaseHandler
-import categories
 import config
 import docs
 import errors
+import importer
 import models
-import stores
-import utils
+import reconcile
+import reinit
+import reviewingest
+import schema
+import searchcache
 
 from google.appengine.api import users
 from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
-from google.appengine.api import search
 
 
 def reinitAll(sample_data=True):
@@ -45,84 +49,20 @@ def reinitAll(sample_data=True):
   state, then loads in static sample data if requested. Hardwired for the
   expected product types in the sample data.
   (Re)loads store location data from stores.py as well.
-  This function is intended to be run 'offline' (e.g., via a Task Queue task).
-  As an extension to this functionality, the channel ID could be used to notify
-  when done."""
-
-  # delete all the product and review entities
-  review_keys = models.Review.query().fetch(keys_only=True)
-  ndb.delete_multi(review_keys)
-  prod_keys = models.Product.query().fetch(keys_only=True)
-  ndb.delete_multi(prod_keys)
-  # delete all the associated product documents in the doc and
-  # store indexes
-  docs.Product.deleteAllInProductIndex()
-  docs.Store.deleteAllInIndex()
-  # load in sample data if indicated
-  if sample_data:
-    logging.info('Loading product sample data')
-    # Load from csv sample files.
-    # The following are hardwired to the format of the sample data files
-    # for the two example product types ('books' and 'hd televisions')-- see
-    # categories.py
-    datafile = os.path.join('data', config.SAMPLE_DATA_BOOKS)
-    # books
-    reader = csv.DictReader(
-        open(datafile, 'r'),
-        ['pid', 'name', 'category', 'price',
-         'publisher', 'title', 'pages', 'author',
-         'description', 'isbn'])
-    importData(reader)
-    datafile = os.path.join('data', config.SAMPLE_DATA_TVS)
-    # tvs
-    reader = csv.DictReader(
-        open(datafile, 'r'),
-        ['pid', 'name', 'category', 'price',
-         'size', 'brand', 'tv_type',
-         'description'])
-    importData(reader)
-
-    # next create docs from store location info
-    loadStoreLocationData()
-
-  logging.info('Re-initialization complete.')
-
-def loadStoreLocationData():
-    # create documents from store location info
-    # currently logs but otherwise swallows search errors.
-    slocs = stores.stores
-    for s in slocs:
-      logging.info("s: %s", s)
-      geopoint = search.GeoPoint(s[3][0], s[3][1])
-      fields = [search.TextField(name=docs.Store.STORE_NAME, value=s[1]),
-                search.TextField(name=docs.Store.STORE_ADDRESS, value=s[2]),
-                search.GeoField(name=docs.Store.STORE_LOCATION, value=geopoint)
-              ]
-      d = search.Document(doc_id=s[0], fields=fields)
-      try:
-        add_result = search.Index(config.STORE_INDEX_NAME).put(d)
-      except search.Error:
-        logging.exception("Error adding document:")
+  The work is done 'offline', as a resumable job made up of chains of Task
+  Queue tasks, which work through the data in parallel shards (see reinit.py).
+  Returns the job entity, whose progress can be polled via
+  /admin/reinit_status."""
+  return reinit.startJob(sample_data)
 
 
 def importData(reader):
   """Import via the csv reader iterator using the specified batch size as set in
   the config file.  We want to ensure the batch is not too large-- we allow 100
-  rows/products max per batch."""
-  MAX_BATCH_SIZE = 100
-  rows = []
-  # index in batches
-  # ensure the batch size in the config file is not over the max or < 1.
-  batchsize = utils.intClamp(config.IMPORT_BATCH_SIZE, 1, MAX_BATCH_SIZE)
-  logging.debug('batchsize: %s', batchsize)
-  for row in reader:
-    if len(rows) == batchsize:
-      docs.Product.buildProductBatch(rows)
-      rows = [row]
-    else:
-      rows.append(row)
-  if rows:
-    docs.Product.buildProductBatch(rows)
+  rows/products max per batch.  The rows are read lazily, and several batches
+  are written concurrently (see importer.ProductImporter).  Returns a report of
+  the import counts and throughput."""
+  return importer.ProductImporter().run(reader)
 
 
 class AdminHandler(BaseHandler):
@@ -135,7 +75,12 @@ class AdminHandler(BaseHandler):
     tdict = {
         'sampleb': config.SAMPLE_DATA_BOOKS,
         'samplet': config.SAMPLE_DATA_TVS,
-        'update_sample': config.DEMO_UPDATE_BOOKS_DATA}
+        'update_sample': config.DEMO_UPDATE_BOOKS_DATA,
+        'reinit_status': reinit.getJobStatus(reinit.getLatestJob()),
+        'reconcile_status': reconcile.getJobStatus(
+            reconcile.getLatestJob()),
+        # the search results cache counters for this instance
+        'cache_stats': searchcache.allStats()}
     if notification:
       tdict['notification'] = notification
     self.render_template('admin.html', tdict)
@@ -145,8 +90,8 @@ class AdminHandler(BaseHandler):
     action = self.request.get('action')
     if action == 'reinit':
       # reinitialise the app data to the sample data
-      defer(reinitAll)
-      self.buildAdminPage(notification="Reinitialization performed.")
+      reinitAll()
+      self.buildAdminPage(notification="Reinitialization started.")
     elif action == 'demo_update':
       # update the sample data, from (hardwired) book update
       # data. Demonstrates updating some existing products, and adding some new
@@ -159,13 +104,17 @@ class AdminHandler(BaseHandler):
           ['pid', 'name', 'category', 'price',
            'publisher', 'title', 'pages', 'author',
            'description', 'isbn'])
-      for row in reader:
-        docs.Product.buildProduct(row)
-      self.buildAdminPage(notification="Demo update performed.")
+      report = docs.Product.upsertProducts(reader)
+      self.buildAdminPage(notification=(
+          'Demo update performed: %(created)s products created, %(updated)s '
+          'updated, %(unchanged)s unchanged, %(failed)s failed.' % report))
 
     elif action == 'update_ratings':
       self.update_ratings()
       self.buildAdminPage(notification="Ratings update performed.")
+    elif action == 'reconcile':
+      reconcile.startJob()
+      self.buildAdminPage(notification="Consistency check started.")
     else:
       self.buildAdminPage()
 
@@ -174,13 +123,53 @@ class AdminHandler(BaseHandler):
     associated documents updated (re-indexed) to reflect that change; and
     re-index those docs in batch. There will only
     be such products if config.BATCH_RATINGS_UPDATE is True; otherwise the
-    associated documents will be updated right away."""
-    # get the pids of the products that need review info updated in their
-    # associated documents.
-    pkeys = models.Product.query(
-        models.Product.needs_review_reindex == True).fetch(keys_only=True)
-    # re-index these docs in batch
-    models.Product.updateProdDocsWithNewRating(pkeys)
+    associated documents will be updated right away.
+    The first batch of products is processed now; any others in follow-up
+    tasks."""
+    models.Product.reindexFlaggedProducts()
+
+
+class UpdateRatingsHandler(BaseHandler):
+  """Re-index the documents of products with an updated average rating.
+  Requested by the cron job defined in cron.yaml."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    models.Product.reindexFlaggedProducts()
+
+
+class IngestReviewsHandler(BaseHandler):
+  """Apply any reviews left in the review ingestion queue.  Requested by the
+  cron job defined in cron.yaml."""
+
+  # stop sweeping well within the deadline of a cron request.
+  _SWEEP_SECONDS = 300
+
+  @BaseHandler.logged_in
+  def get(self):
+    applied = reviewingest.ingestAllReviews(
+        deadline=time.time() + self._SWEEP_SECONDS)
+    logging.info('applied %s queued reviews.', applied)
+
+
+class ReconcileHandler(BaseHandler):
+  """Start a check of the consistency of the product entities and the
+  product index, which repairs any inconsistencies found.  Requested by the
+  cron job defined in cron.yaml."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    reconcile.startJob()
+
+
+class ReinitStatusHandler(BaseHandler):
+  """Reports the progress of the latest reinitialization job, as JSON."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(
+        json.dumps(reinit.getJobStatus(reinit.getLatestJob())))
 
 
 class DeleteProductHandler(BaseHandler):
@@ -204,10 +193,14 @@ class DeleteProductHandler(BaseHandler):
     # Delete the product entity within a transaction, and define transactional
     # tasks for deleting the product's reviews and its associated document.
     # These tasks will only be run if the transaction successfully commits.
+    # The deletion is recorded in the change log.
+    seq = models.ProductChange.allocateSeqs(1)[0]
     def _tx():
       prod = models.Product.get_by_id(pid)
       if prod:
         prod.key.delete()
+        models.ProductChange.build(
+            seq, prod.key, models.ProductChange.DELETE).put()
         defer(models.Review.deleteReviews, prod.key.id(), _transactional=True)
         defer(
             docs.Product.removeProductDocByPid,
@@ -248,13 +241,9 @@ class CreateProductHandler(BaseHandler):
           'description': '',
           'category': '',
           'price': ''}
-      pf = categories.product_dict
       # add the fields specific to the categories
-      for _, cdict in pf.iteritems():
-        temp = {}
-        for elt in cdict.keys():
-          temp[elt] = ''
-        params.update(temp)
+      for elt in schema.getFormFields():
+        params[elt] = ''
 
     for k, v in params.iteritems():
       # Process the request params. Possibly replace default values.
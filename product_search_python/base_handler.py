@@ -19,12 +19,54 @@
 
 
 import webapp2
+from jinja2 import MemcachedBytecodeCache
 from webapp2_extras import jinja2
 import json
+import os
+import re
+import urlparse
 
+import config
+import fragments
+import profiling
+
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 
+# the JSONP callback names allowed: dotted javascript identifiers.
+_CALLBACK_RE = re.compile(r'^[A-Za-z_$][\w$]*(\.[A-Za-z_$][\w$]*)*$')
+
+TEMPLATE_PATH = 'templates'
+
+
+def templateEnvironmentArgs(bytecode_cache=True):
+  """Return the args of the jinja2 environment: those of webapp2_extras'
+  default config, plus, if config.TEMPLATE_BYTECODE_CACHE is set, a cache of
+  the compiled templates in memcache, so that a new instance does not have to
+  compile them again.  The cache is keyed on the app version as well as on
+  the template source."""
+  args = {'autoescape': True,
+          'extensions': ['jinja2.ext.autoescape', 'jinja2.ext.with_']}
+  if bytecode_cache and config.TEMPLATE_BYTECODE_CACHE:
+    args['bytecode_cache'] = MemcachedBytecodeCache(
+        memcache, prefix='jinja2_bytecode:%s:' % os.environ.get(
+            'CURRENT_VERSION_ID', ''))
+  return args
+
+
+def _createJinja2(app):
+  """Create the app's jinja2 renderer.  If config.USE_COMPILED_TEMPLATES is
+  set, the templates are loaded from the python modules compiled from them by
+  compile_templates.py, rather than parsed."""
+  return jinja2.Jinja2(app, config={
+      'template_path': TEMPLATE_PATH,
+      'compiled_path': (config.COMPILED_TEMPLATES_PATH
+                        if config.USE_COMPILED_TEMPLATES else None),
+      'force_compiled': True,
+      'environment_args': templateEnvironmentArgs()})
+
+
 class BaseHandler(webapp2.RequestHandler):
   """The other handlers inherit from this class.  Provides some helper methods
   for rendering a template and generating template links."""
@@ -42,57 +84,59 @@ class BaseHandler(webapp2.RequestHandler):
         self.error(403)
     return auth_required
 
+  def dispatch(self):
+    """Dispatch the request, profiling it if config.REQUEST_PROFILING is
+    set."""
+    if not config.REQUEST_PROFILING:
+      return super(BaseHandler, self).dispatch()
+    profiling.start(self.request.path)
+    try:
+      return super(BaseHandler, self).dispatch()
+    finally:
+      profile = profiling.finish()
+      self.response.headers['Server-Timing'] = profile.serverTiming()
+
   @webapp2.cached_property
   def jinja2(self):
-    return jinja2.get_jinja2(app=self.app)
+    return jinja2.get_jinja2(factory=_createJinja2, app=self.app)
 
   def render_template(self, filename, template_args):
-    template_args.update(self.generateSidebarLinksDict())
-    self.response.write(self.jinja2.render_template(filename, **template_args))
-
-  def render_json(self, response):
-    self.response.write("%s(%s);" % (self.request.GET['callback'],
-                                     json.dumps(response)))
-
-  def getLoginLink(self):
-    """Generate login or logout link and text, depending upon the logged-in
-    status of the client."""
-    if users.get_current_user():
-      url = users.create_logout_url(self.request.uri)
-      url_linktext = 'Logout'
-    else:
-      url = users.create_login_url(self.request.uri)
-      url_linktext = 'Login'
-    return (url, url_linktext)
-
-  def getAdminManageLink(self):
-    """Build link to the admin management page, if the user is logged in."""
-    if users.get_current_user():
-      admin_url = '/admin/manage'
-      return (admin_url, 'Admin/Add sample data')
+    # the sidebar links depend only on whether the user is logged in.
+    template_args['sidebar_links'] = fragments.sidebarLinks(
+        self.jinja2, users.get_current_user() is not None)
+    with profiling.span('render'):
+      self.response.write(
+          self.jinja2.render_template(filename, **template_args))
+
+  def render_json_list(self, key, items, extra=None):
+    """Write a JSON object with the given items as a list under the given
+    key, and the members of the extra dict, wrapped in a call of the
+    'callback' request param if given (JSONP).  Each item is encoded as it is
+    written, so the whole encoded list is never built in memory."""
+    callback = self.request.get('callback')
+    if callback and not _CALLBACK_RE.match(callback):
+      self.error(400)
+      return
+    write = self.response.write
+    if callback:
+      self.response.content_type = 'application/javascript'
+      write('%s(' % callback)
     else:
-      return (None, None)
-
-  def createProductAdminLink(self):
-    if users.get_current_user():
-      admin_create_url = '/admin/create_product'
-      return (admin_create_url, 'Create new product (admin)')
-    else:
-      return (None, None)
-
-  def generateSidebarLinksDict(self):
-    """Build a dict containing login/logout and admin links, which will be
-    included in the sidebar for all app pages."""
-
-    url, url_linktext = self.getLoginLink()
-    admin_create_url, admin_create_text = self.createProductAdminLink()
-    admin_url, admin_text = self.getAdminManageLink()
-    return {
-        'admin_create_url': admin_create_url,
-        'admin_create_text': admin_create_text,
-        'admin_url': admin_url,
-        'admin_text': admin_text,
-        'url': url,
-        'url_linktext': url_linktext
-        }
-
+      self.response.content_type = 'application/json'
+    write('{%s: [' % json.dumps(key))
+    for i, item in enumerate(items):
+      if i:
+        write(', ')
+      write(json.dumps(item))
+    write(']')
+    for name, value in sorted((extra or {}).iteritems()):
+      write(', %s: %s' % (json.dumps(name), json.dumps(value)))
+    write('}')
+    if callback:
+      write(');')
+
+  def getContinueUrl(self):
+    """The path of the page the request was linked from (without its host,
+    so that it is on this app), for returning to after logging in or out."""
+    referer = urlparse.urlsplit(self.request.referer or '/')
+    return urlparse.urlunsplit(('', '', referer.path or '/', referer.query, ''))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import optparse
+import os
+import sys
+
+USAGE = """%prog SDK_PATH
+Compile the app's templates into python modules, written to
+config.COMPILED_TEMPLATES_PATH, which the app loads instead of parsing the
+templates if config.USE_COMPILED_TEMPLATES is set.  Rerun this whenever a
+template changes, before deploying.
+
+SDK_PATH    Path to the SDK installation"""
+
+
+def main(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, project_dir)
+    os.chdir(project_dir)
+    import jinja2
+    import base_handler
+    import config
+    # the modules are compiled with the same environment args as the app's,
+    # e.g. its autoescaping.
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(base_handler.TEMPLATE_PATH),
+        **base_handler.templateEnvironmentArgs(bytecode_cache=False))
+    env.compile_templates(config.COMPILED_TEMPLATES_PATH, zip=None,
+                          ignore_errors=False, py_compile=False)
+    print 'compiled %s templates to %s.' % (
+        len(env.list_templates()), config.COMPILED_TEMPLATES_PATH)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    main(args[0])
@@ -25,12 +25,41 @@ PRODUCT_INDEX_NAME = 'productsearch1'  # The document index name.
 
 STORE_INDEX_NAME = 'stores1'
 
+# The search backend the indexes are served from: 'service' for the search
+# service, or 'local' for the in-memory backend in localsearch.py (useful for
+# offline testing and benchmarking, but not shared between instances).
+SEARCH_BACKEND = 'service'
+
 # set BATCH_RATINGS_UPDATE to False to update documents with changed ratings
 # info right away.  If True, updates will only occur when triggered by
 # an admin request or a cron job.  See cron.yaml for an example.
 BATCH_RATINGS_UPDATE = False
 # BATCH_RATINGS_UPDATE = True
 
+# set RATINGS_AGGREGATION to 'sharded' to count review ratings in
+# RATING_SHARDS counter shards per product, rather than in the product entity
+# itself, so that reviews of a popular product are not serialized on its
+# entity group.  The product's average rating is then rolled up from its shards
+# at most once every RATINGS_ROLLUP_DELAY seconds.  Ratings counted in one mode
+# are not carried over to the other, and RATING_SHARDS may be increased but not
+# decreased.  See models.ProductRatingShard.
+RATINGS_AGGREGATION = 'transactional'
+# RATINGS_AGGREGATION = 'sharded'
+RATING_SHARDS = 20
+RATINGS_ROLLUP_DELAY = 10
+
+# set REVIEW_INGESTION to 'pull' to apply new reviews to their products in
+# batches: reviews are queued in the REVIEW_INGEST_QUEUE pull queue (see
+# queue.yaml), and the reviews of each product are applied together, up to
+# REVIEW_INGEST_BATCH_SIZE at a time, at the end of each window of
+# REVIEW_INGEST_WINDOW seconds, with a single re-index of the product's doc.
+# With 'task', each review is applied in its own task.  See reviewingest.py.
+REVIEW_INGESTION = 'task'
+# REVIEW_INGESTION = 'pull'
+REVIEW_INGEST_QUEUE = 'review-ingest'
+REVIEW_INGEST_WINDOW = 10
+REVIEW_INGEST_BATCH_SIZE = 100
+
 # The max and min (integer) ratings values allowed.
 RATING_MIN = 1
 RATING_MAX = 5
@@ -44,4 +73,105 @@ DEMO_UPDATE_BOOKS_DATA = 'sample_data_books_update.csv'
 
 # the size of the import batches, when reading from the csv file.  Must not
 # exceed 100.
-IMPORT_BATCH_SIZE = 5
+IMPORT_BATCH_SIZE = 100
+# the max number of import batches waiting on each of the index and datastore
+# writes at once, and the number of times a batch whose write failed is retried.
+IMPORT_MAX_IN_FLIGHT = 4
+IMPORT_MAX_RETRIES = 3
+
+# The price ranges for which facet counts are returned with each product
+# search, as (start, end) pairs.  A start or end of None leaves that side of
+# the range open.
+PRICE_FACET_RANGES = [(None, 10), (10, 25), (25, 50), (50, 100), (100, None)]
+
+# The number of top-ranked documents the search service examines when
+# computing facet counts.  Counts for queries matching more documents than
+# this are approximate.
+FACET_DEPTH = 1000
+
+# set CURSOR_PAGINATION to True to page through search results with cursors,
+# so that fetching a page costs the same however deep it is, and result sets
+# can be paged through beyond the offset limit.  If False, pages are fetched by
+# offset.
+CURSOR_PAGINATION = True
+
+# Search results cache settings.  SEARCH_CACHE_SIZE is the max number of result
+# pages cached in-process on each instance (0 disables the cache), and
+# SEARCH_CACHE_TTL the number of seconds they are cached for.  If
+# SEARCH_CACHE_MEMCACHE is True, cached results are also shared between
+# instances via memcache.
+SEARCH_CACHE_SIZE = 500
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_MEMCACHE = True
+# the max number of seconds an instance uses the generation of an index that it
+# last read from memcache (see searchcache.py), before reading it again.  A
+# modification of the index made on another instance may take that long to
+# invalidate the results cached on this one.
+SEARCH_GENERATION_CHECK_SECONDS = 1
+
+# the number of flagged products whose documents are re-indexed with their new
+# ratings info per task, when updating ratings in batch.  Larger backlogs are
+# processed in a chain of tasks.
+RATINGS_REINDEX_BATCH_SIZE = 500
+
+# Settings for the job that reinitializes the app data (see reinit.py): the
+# number of key-range shards each datastore kind is deleted in, the number of
+# seconds each task in a shard's chain works for before handing over to the
+# next, and the number of sample data rows imported between checkpoints.
+REINIT_SHARDS = 4
+REINIT_TASK_SECONDS = 300
+REINIT_LOAD_CHUNK = 500
+
+# the number of seconds each task deleting a range of an index's documents
+# works for before handing over to the next (see
+# docs.BaseDocumentManager.deleteAllInIndexParallel).
+DELETE_TASK_SECONDS = 300
+
+# set REQUEST_PROFILING to True to time the main parts of each request (search
+# calls, category lookups, template rendering) and count its RPCs.  A summary
+# line is logged for each request, and the timings are returned in a
+# Server-Timing response header.  See profiling.py.
+REQUEST_PROFILING = False
+
+# the max number of seconds an instance uses its cached category information
+# for before checking whether the categories have changed.
+CATEGORY_VERSION_CHECK_SECONDS = 30
+
+# the number of product id range shards the consistency check between the
+# product entities and the product index is run in, the number of seconds each
+# task in a shard's chain works for before handing over to the next, and the
+# number of products and docs read per batch, and repaired per batch (see
+# reconcile.py).
+RECONCILE_SHARDS = 4
+RECONCILE_TASK_SECONDS = 300
+RECONCILE_BATCH_SIZE = 200
+
+# Store location lookup settings (see geo.py).  Store docs are indexed with the
+# geohash cells that contain them at each precision up to GEO_MAX_PRECISION
+# (cells of about 1.2 by 0.6 km at precision 6); GEO_CELL_LIMIT is the max
+# number of stores fetched per cell (a block of cells with more is not used;
+# the stores are then found by a distance-sorted search of the index), and
+# GEO_CELL_CACHE_TTL the number of seconds the stores in a cell are cached for.
+GEO_MAX_PRECISION = 6
+GEO_CELL_LIMIT = 1000
+GEO_CELL_CACHE_TTL = 3600
+
+# the max number of stores returned per page of a store location lookup, and
+# the max number of nearest stores that can be paged through.
+STORE_LOCATION_MAX_LIMIT = 100
+STORE_LOCATION_MAX_RESULTS = 1000
+
+# the max number of rendered page fragments (the sidebar links, and the
+# category and sort menus) cached on each instance, and the number of seconds
+# they are cached for.  See fragments.py.
+FRAGMENT_CACHE_SIZE = 100
+FRAGMENT_CACHE_TTL = 3600
+
+# set TEMPLATE_BYTECODE_CACHE to cache the compiled templates in memcache, so
+# that new instances do not have to compile them.  Set USE_COMPILED_TEMPLATES
+# to load the templates from the python modules that compile_templates.py
+# writes to COMPILED_TEMPLATES_PATH instead; rerun it whenever a template
+# changes.  See base_handler.py.
+TEMPLATE_BYTECODE_CACHE = True
+USE_COMPILED_TEMPLATES = False
+COMPILED_TEMPLATES_PATH = 'templates_compiled'
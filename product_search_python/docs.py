@@ -22,17 +22,23 @@ adds some Product-document-specific helper methods.
 import collections
 import copy
 import datetime
+import hashlib
+import itertools
 import logging
 import re
 import string
+import time
 import urllib
 
-import categories
 import config
 import errors
 import models
+import profiling
+import schema
+import searchcache
 
 from google.appengine.api import search
+from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 
 
@@ -40,6 +46,16 @@ class BaseDocumentManager(object):
   """Abstract class. Provides helper methods to manage search.Documents."""
 
   _INDEX_NAME = None
+  # the max number of docs to fetch with a single get_range call (see getDocs)
+  _GET_RANGE_LIMIT = 100
+  # the max number of docs that can be indexed with a single put call
+  _MAX_PUT_BATCH = 200
+  # the number of docs deleted per batch (see deleteRange)
+  _DELETE_BATCH_SIZE = 200
+  # the characters on which the id space is split (see splitIdSpace), in
+  # ascending order.
+  _ID_SPLIT_CHARS = (
+      string.digits + string.ascii_uppercase + string.ascii_lowercase)
   _VISIBLE_PRINTABLE_ASCII = frozenset(
     set(string.printable) - set(string.whitespace))
 
@@ -66,6 +82,17 @@ class BaseDocumentManager(object):
         return True
     return False
 
+  def setFirstFacet(self, new_facet):
+    """Set the value of the (first) document facet with the given name.  If
+    the document does not yet have such a facet (e.g. it was indexed before
+    faceting was added), the facet is appended."""
+    for i, facet in enumerate(self.doc.facets):
+      if facet.name == new_facet.name:
+        self.doc.facets[i] = new_facet
+        return True
+    self.doc.facets.append(new_facet)
+    return False
+
   @classmethod
   def isValidDocId(cls, doc_id):
     """Checks if the given id is a visible printable ASCII string not starting
@@ -78,43 +105,183 @@ class BaseDocumentManager(object):
 
   @classmethod
   def getIndex(cls):
-    return search.Index(name=cls._INDEX_NAME)
+    """Return the index, from the search backend set in the config."""
+    if config.SEARCH_BACKEND == 'local':
+      # the local backend is only loaded by the apps that use it.
+      import localsearch
+      index = localsearch.getIndex(cls._INDEX_NAME)
+    else:
+      index = search.Index(name=cls._INDEX_NAME)
+    if profiling.current():
+      index = profiling.ProfiledIndex(index)
+    return index
 
   @classmethod
-  def deleteAllInIndex(cls):
-    """Delete all the docs in the given index."""
-    docindex = cls.getIndex()
+  def invalidateCache(cls):
+    """Invalidate the search results cached for the index.  Called whenever
+    the index is modified."""
+    searchcache.invalidate(cls._INDEX_NAME)
+
+  @classmethod
+  def deleteAllInIndex(cls, deadline=None):
+    """Delete all the docs in the given index.  If a deadline (a time.time()
+    value) is given, stop once it has passed.  Returns True if the index was
+    emptied."""
+    try:
+      deleted, last_id = cls.deleteRange(deadline=deadline)
+      return last_id is None
+    except search.Error:
+      logging.exception("Error removing documents:")
+      return False
 
+  @classmethod
+  def deleteRange(cls, start_id=None, end_id=None, deadline=None,
+                  include_start=True):
+    """Delete the docs with ids in the range [start_id, end_id), where None
+    leaves that end of the range open.  The id space is walked forward, each
+    batch of ids being fetched from just past the last id of the batch before,
+    rather than by rescanning the index from its start; and the fetch of the
+    next batch of ids is done while the current batch is being deleted.  Only
+    one batch of ids is held at a time.
+
+    If a deadline (a time.time() value) is given, stop once it has passed,
+    but only after deleting at least one batch, so that each call makes
+    progress.  Returns the number of docs deleted and, if stopped before the
+    end of the range, the last id deleted, from which the deletion can be
+    resumed (with include_start=False); otherwise None.  Search errors are
+    raised, so that a task running the deletion is retried."""
+    docindex = cls.getIndex()
+    deleted = 0
+    started = time.time()
+    last_id = None
     try:
+      fetch = docindex.get_range_async(
+          start_id=start_id, include_start_object=include_start,
+          ids_only=True, limit=cls._DELETE_BATCH_SIZE)
+      delete = None
       while True:
-        # until no more documents, get a list of documents,
-        # constraining the returned objects to contain only the doc ids,
-        # extract the doc ids, and delete the docs.
         document_ids = [document.doc_id
-                        for document in docindex.get_range(ids_only=True)]
+                        for document in fetch.get_result().results
+                        if end_id is None or document.doc_id < end_id]
+        # the id returned to resume from must have been deleted, so the
+        # deadline only applies once a batch has been.
+        stopping = (deadline is not None and time.time() >= deadline and
+                    delete is not None)
+        if document_ids and not stopping:
+          # start fetching the next batch of ids before deleting this one.
+          fetch = docindex.get_range_async(
+              start_id=document_ids[-1], include_start_object=False,
+              ids_only=True, limit=cls._DELETE_BATCH_SIZE)
+        if delete:
+          delete.get_result()
+          deleted += len(delete_ids)
+          last_id = delete_ids[-1]
+          delete = None
         if not document_ids:
+          last_id = None
           break
-        docindex.delete(document_ids)
-    except search.Error:
-      logging.exception("Error removing documents:")
+        if stopping:
+          break
+        delete_ids = document_ids
+        delete = docindex.delete_async(delete_ids)
+    finally:
+      cls.invalidateCache()
+    elapsed = time.time() - started
+    logging.info('deleted %s docs from index %s in %.1f secs (%.1f docs/sec).',
+                 deleted, cls._INDEX_NAME, elapsed,
+                 deleted / elapsed if elapsed else 0.0)
+    return (deleted, last_id)
+
+  @classmethod
+  def splitIdSpace(cls, num_ranges):
+    """Split the doc id space into (up to) num_ranges ranges, for deleting in
+    parallel.  Returns a list of (start_id, end_id) pairs, where None marks an
+    open end.  The ranges are split on the first character of the id, over the
+    alphanumeric characters that ids typically start with."""
+    bounds = sorted(set(
+        cls._ID_SPLIT_CHARS[len(cls._ID_SPLIT_CHARS) * i // num_ranges]
+        for i in range(1, num_ranges)))
+    bounds = [None] + bounds + [None]
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+  @classmethod
+  def deleteAllInIndexParallel(cls, num_workers):
+    """Delete all the docs in the index, in num_workers parallel chains of
+    tasks, each working through one range of the id space."""
+    for start_id, end_id in cls.splitIdSpace(num_workers):
+      defer(cls.deleteRangeTask, start_id, end_id)
+
+  @classmethod
+  def deleteRangeTask(cls, start_id, end_id, include_start=True):
+    """Delete the docs in the given id range for up to
+    config.DELETE_TASK_SECONDS, then defer a task to resume where this one
+    stopped, if needed."""
+    deleted, last_id = cls.deleteRange(
+        start_id, end_id, time.time() + config.DELETE_TASK_SECONDS,
+        include_start)
+    if last_id is not None:
+      defer(cls.deleteRangeTask, last_id, end_id, False)
+
+  @classmethod
+  def getDocs(cls, doc_ids):
+    """Return a dict of the documents with the given doc ids, keyed by doc id.
+    Ids for which there is no document are left out.
+
+    The documents are fetched via range scans of the index, which return the
+    documents in doc id order: the sorted ids are split into runs of up to
+    _GET_RANGE_LIMIT ids, and each run is fetched with a single get_range call,
+    starting at its first id.  If the ids of a run are dense in the index, the
+    run is fetched by that one call.  Its ids past the last document returned
+    are then each fetched with a get_range call of limit 1, so that ids spread
+    thinly through the index cost one more round, not a scan of the documents
+    between them.  The calls of each round are made in parallel."""
+    pending = sorted(set(
+        doc_id for doc_id in doc_ids if doc_id and cls.isValidDocId(doc_id)))
+    found = {}
+    index = cls.getIndex()
+    runs = [pending[i:i + cls._GET_RANGE_LIMIT]
+            for i in range(0, len(pending), cls._GET_RANGE_LIMIT)]
+    futures = [index.get_range_async(start_id=run[0], limit=len(run),
+                                     include_start_object=True)
+               for run in runs]
+    pending = []
+    for run, future in zip(runs, futures):
+      results = cls._getRangeResults(future, run)
+      for doc in results:
+        found[doc.doc_id] = doc
+      if len(results) == len(run):
+        # the index may hold more docs within the range of this run than
+        # the run's own; look up the ids beyond those returned one by one.
+        last_id = results[-1].doc_id
+        pending.extend(
+            doc_id for doc_id in run
+            if doc_id > last_id and doc_id not in found)
+    futures = [index.get_range_async(start_id=doc_id, limit=1,
+                                     include_start_object=True)
+               for doc_id in pending]
+    for doc_id, future in zip(pending, futures):
+      for doc in cls._getRangeResults(future, [doc_id]):
+        if doc.doc_id == doc_id:
+          found[doc_id] = doc
+    return dict((doc_id, found[doc_id]) for doc_id in doc_ids
+                if doc_id in found)
+
+  @classmethod
+  def _getRangeResults(cls, future, doc_ids):
+    """Return the docs of a get_range_async call for the given ids, or an
+    empty list if the call failed."""
+    try:
+      return future.get_result().results
+    except search.InvalidRequest:  # catches ill-formed doc ids
+      logging.exception('Error getting documents %s.', doc_ids)
+      return []
 
   @classmethod
   def getDoc(cls, doc_id):
-    """Return the document with the given doc id. One way to do this is via
-    the get_range method, as shown here.  If the doc id is not in the
-    index, the first doc in the index will be returned instead, so we need
-    to check for that case."""
+    """Return the document with the given doc id, or None.  See getDocs."""
     if not doc_id:
       return None
-    try:
-      index = cls.getIndex()
-      response = index.get_range(
-          start_id=doc_id, limit=1, include_start_object=True)
-      if response.results and response.results[0].doc_id == doc_id:
-        return response.results[0]
-      return None
-    except search.InvalidRequest: # catches ill-formed doc ids
-      return None
+    return cls.getDocs([doc_id]).get(doc_id)
 
   @classmethod
   def removeDocById(cls, doc_id):
@@ -123,14 +290,46 @@ class BaseDocumentManager(object):
       cls.getIndex().delete(doc_id)
     except search.Error:
       logging.exception("Error removing doc id %s.", doc_id)
+    finally:
+      cls.invalidateCache()
 
   @classmethod
   def add(cls, documents):
-    """wrapper for search index add method; specifies the index name."""
+    """wrapper for search index add method; specifies the index name.
+    A list of more documents than can be indexed by a single put is indexed in
+    batches.  Invalidates the search results cached for the index."""
     try:
-      return cls.getIndex().put(documents)
+      index = cls.getIndex()
+      if (not isinstance(documents, (list, tuple))
+          or len(documents) <= cls._MAX_PUT_BATCH):
+        return index.put(documents)
+      results = []
+      for i in range(0, len(documents), cls._MAX_PUT_BATCH):
+        results.extend(index.put(documents[i:i + cls._MAX_PUT_BATCH]))
+      return results
     except search.Error:
       logging.exception("Error adding documents.")
+    finally:
+      cls.invalidateCache()
+
+
+class _RatingsBucketsFuture(object):
+  """The pending ratings buckets of a facet query started by
+  Product.generateRatingsBucketsAsync.  Search errors are logged, and give
+  None buckets."""
+
+  def __init__(self, search_future):
+    self._search_future = search_future
+
+  def get_result(self):
+    if self._search_future is None:
+      return None
+    try:
+      search_results = self._search_future.get_result()
+    except search.Error:
+      logging.exception('An error occurred on search.')
+      return None
+    return Product.ratingsBucketsFromFacets(search_results.facets)
 
 
 class Store(BaseDocumentManager):
@@ -139,6 +338,8 @@ class Store(BaseDocumentManager):
   STORE_NAME = 'store_name'
   STORE_LOCATION = 'store_location'
   STORE_ADDRESS = 'store_address'
+  # the geohash cells containing the store (see geo.py)
+  STORE_CELL = 'store_cell'
 
 
 class Product(BaseDocumentManager):
@@ -161,6 +362,7 @@ class Product(BaseDocumentManager):
   PRICE = 'price'
   AVG_RATING = 'ar' #average rating
   UPDATED = 'modified'
+  CONTENT_HASH = 'content_hash'
 
   _SORT_OPTIONS = [
         [AVG_RATING, 'average rating', search.SortExpression(
@@ -189,6 +391,13 @@ class Product(BaseDocumentManager):
 
   _SORT_MENU = None
   _SORT_DICT = None
+  _FACET_REQUESTS = None
+
+  # the fields left out of the content hash of a product doc, as they change
+  # without the product data changing.
+  _UNHASHED_FIELDS = frozenset([UPDATED, AVG_RATING, CONTENT_HASH])
+  # the number of rows diffed and written at a time by upsertProducts.
+  _UPSERT_BATCH_SIZE = 100
 
 
   @classmethod
@@ -284,14 +493,72 @@ class Product(BaseDocumentManager):
     return self.getFieldVal(self.AVG_RATING)
 
   def setAvgRating(self, ar):
-    """Set the value of the 'ar' field of a Product doc."""
+    """Set the value of the 'ar' field of a Product doc, and of the facet
+    used to generate the ratings 'buckets'."""
+    self.setFirstFacet(search.NumberFacet(name=self.AVG_RATING, value=ar))
     return self.setFirstField(search.NumberField(name=self.AVG_RATING, value=ar))
 
+  def getContentHash(self):
+    """Get the value of the 'content_hash' field of a Product doc."""
+    return self.getFieldVal(self.CONTENT_HASH)
+
   def getPrice(self):
     """Get the value of the 'price' field of a Product doc."""
     return self.getFieldVal(self.PRICE)
 
   @classmethod
+  def _buildRatingsFacetRequest(cls):
+    """Build the facet request for the ratings 'buckets': one range per integer
+    rating, the last of which (RATING_MAX) is open-ended."""
+    ranges = [search.FacetRange(start=k, end=k+1)
+              for k in range(config.RATING_MIN, config.RATING_MAX)]
+    ranges.append(search.FacetRange(start=config.RATING_MAX))
+    return search.FacetRequest(cls.AVG_RATING, ranges=ranges)
+
+  @classmethod
+  def getFacetRequests(cls):
+    """The facet requests sent along with each product search, so that the
+    ratings, category and price facet counts are returned in the same round
+    trip as the page of results."""
+    if not cls._FACET_REQUESTS:
+      price_ranges = [search.FacetRange(start=start, end=end)
+                      for (start, end) in config.PRICE_FACET_RANGES]
+      cls._FACET_REQUESTS = [
+          cls._buildRatingsFacetRequest(),
+          search.FacetRequest(cls.CATEGORY),
+          search.FacetRequest(cls.PRICE, ranges=price_ranges)]
+    return cls._FACET_REQUESTS
+
+  @classmethod
+  def getFacetOptions(cls):
+    return search.FacetOptions(depth=config.FACET_DEPTH)
+
+  @classmethod
+  def _getFacetResult(cls, facet_results, name):
+    """Return the facet result with the given name, or None."""
+    for facet_result in facet_results or []:
+      if facet_result.name == name:
+        return facet_result
+    return None
+
+  @classmethod
+  def ratingsBucketsFromFacets(cls, facet_results):
+    """Builds a dict of ratings 'buckets' and their counts from the 'ar' facet
+    result of a search.  The bucket of each facet value is recovered from its
+    refinement token, which encodes the requested range."""
+    facet_result = cls._getFacetResult(facet_results, cls.AVG_RATING)
+    if not facet_result:
+      return None
+    ratings_buckets = collections.defaultdict(int)
+    for value in facet_result.values:
+      refinement = search.FacetRefinement.FromTokenString(
+          value.refinement_token)
+      if refinement.facet_range:
+        ratings_buckets[int(refinement.facet_range.start)] += value.count
+    return ratings_buckets
+
+  @classmethod
+  @profiling.timed('ratings_buckets')
   def generateRatingsBuckets(cls, query_string):
     """Builds a dict of ratings 'buckets' and their counts, based on the
     value of the 'avg_rating" field for the documents retrieved by the given
@@ -299,35 +566,40 @@ class Product(BaseDocumentManager):
     be used to generate sidebar links that allow the user to drill down in query
     results based on rating.
 
-    For demonstration purposes only; this will be expensive for large data
-    sets.
+    The counts are computed by the search service, as facets; only the ids of
+    a single document are returned, so the cost of this query does not grow
+    with the number of matching documents.  It is only needed when the
+    facet counts can't be taken from the page query itself, i.e. when that
+    query is already filtered on rating.
     """
+    return cls.generateRatingsBucketsAsync(query_string).get_result()
 
-    # do the query on the *full* search results
-    # to generate the facet information, imitating what may in future be
-    # provided by the FTS API.
+  @classmethod
+  def generateRatingsBucketsAsync(cls, query_string):
+    """Start the query of generateRatingsBuckets, without waiting for its
+    results, so that it can run concurrently with other RPCs.  Returns a
+    future whose get_result() returns the ratings buckets dict."""
     try:
       sq = search.Query(
-          query_string=query_string.strip())
-      search_results = cls.getIndex().search(sq)
+          query_string=query_string.strip(),
+          options=search.QueryOptions(limit=1, ids_only=True),
+          return_facets=[cls._buildRatingsFacetRequest()],
+          facet_options=cls.getFacetOptions())
+      return _RatingsBucketsFuture(cls.getIndex().search_async(sq))
     except search.Error:
       logging.exception('An error occurred on search.')
-      return None
-
-    ratings_buckets = collections.defaultdict(int)
-    # populate the buckets
-    for res in search_results:
-      ratings_buckets[int((cls(res)).getAvgRating() or 0)] += 1
-    return ratings_buckets
+      return _RatingsBucketsFuture(None)
 
   @classmethod
-  def generateRatingsLinks(cls, query, phash):
+  def generateRatingsLinks(cls, query, phash, ratings_buckets=None):
     """Given a dict of ratings 'buckets' and their counts,
     builds a list of html snippets, to be displayed in the sidebar when
     showing results of a query. Each is a link that runs the query, additionally
-    filtered by the indicated ratings interval."""
+    filtered by the indicated ratings interval.  If the buckets are not given,
+    they are generated from the query."""
 
-    ratings_buckets = cls.generateRatingsBuckets(query)
+    if ratings_buckets is None:
+      ratings_buckets = cls.generateRatingsBuckets(query)
     if not ratings_buckets:
       return None
     rlist = []
@@ -346,6 +618,60 @@ class Product(BaseDocumentManager):
       rlist.append((hlink, htext))
     return rlist
 
+  @classmethod
+  def generateCategoryLinks(cls, facet_results, phash, category=None):
+    """Build a list of (link, text) sidebar links from the category facet
+    result of a search, each of which reruns the query restricted to that
+    category.
+
+    The links refine the search one level of the category tree at a time:
+    the counts of the categories of the facet are rolled up into the child
+    categories of the given category (or of the root, if none), via their
+    paths in the tree.  Categories without children, or not in the tree,
+    are linked to as they are."""
+    facet_result = cls._getFacetResult(facet_results, cls.CATEGORY)
+    if not facet_result:
+      return None
+    parent = category or models.Category.ROOT
+    children = set(models.Category.getChildCategories(parent))
+    counts = collections.defaultdict(int)
+    for value in facet_result.values:
+      path = models.Category.getCategoryPath(value.label) or [value.label]
+      linked = [name for name in path if name in children]
+      counts[linked[0] if linked else value.label] += value.count
+    clist = []
+    for label, count in sorted(counts.iteritems(),
+                               key=lambda item: (-item[1], item[0])):
+      phash['category'] = label
+      hlink = '/psearch?' + urllib.urlencode(phash)
+      clist.append((hlink, '%s (%s)' % (label, count)))
+    return clist
+
+  @classmethod
+  def generatePriceCounts(cls, facet_results):
+    """Build a list of (price range, count) pairs from the price facet result
+    of a search, in the order of config.PRICE_FACET_RANGES."""
+    facet_result = cls._getFacetResult(facet_results, cls.PRICE)
+    if not facet_result:
+      return None
+    counts = collections.defaultdict(int)
+    for value in facet_result.values:
+      refinement = search.FacetRefinement.FromTokenString(
+          value.refinement_token)
+      if refinement.facet_range:
+        frange = refinement.facet_range
+        counts[(frange.start, frange.end)] += value.count
+    plist = []
+    for (start, end) in config.PRICE_FACET_RANGES:
+      if start is None:
+        ptext = 'under %s' % end
+      elif end is None:
+        ptext = '%s and over' % start
+      else:
+        ptext = '%s-%s' % (start, end)
+      plist.append((ptext, counts[(start, end)]))
+    return plist
+
   @classmethod
   def _buildCoreProductFields(
       cls, pid, name, description, category, category_name, price):
@@ -377,6 +703,15 @@ class Product(BaseDocumentManager):
              ]
     return fields
 
+  @classmethod
+  def _buildProductFacets(cls, category, price, avg_rating=0.0):
+    """Construct the facets that all Product documents carry.  These let the
+    ratings, category and price counts for the sidebar be computed by the
+    search service along with the results of a query (see getFacetRequests)."""
+    return [search.AtomFacet(name=cls.CATEGORY, value=category),
+            search.NumberFacet(name=cls.AVG_RATING, value=avg_rating),
+            search.NumberFacet(name=cls.PRICE, value=price)]
+
   @classmethod
   def _buildProductFields(cls, pid=None, category=None, name=None,
       description=None, category_name=None, price=None, **params):
@@ -388,41 +723,20 @@ class Product(BaseDocumentManager):
 
     fields = cls._buildCoreProductFields(
         pid, name, description, category, category_name, price)
-    # get the specification of additional (non-'core') fields for this category
-    pdict = categories.product_dict.get(category_name)
-    if pdict:
-      # for all fields
-      for k, field_type in pdict.iteritems():
-        # see if there is a value in the given params for that field.
-        # if there is, get the field type, create the field, and append to the
-        # document field list.
-        if k in params:
-          v = params[k]
-          if field_type == search.NumberField:
-            try:
-              val = float(v)
-              fields.append(search.NumberField(name=k, value=val))
-            except ValueError:
-              error_message = ('bad value %s for field %s of type %s' %
-                               (k, v, field_type))
-              logging.error(error_message)
-              raise errors.OperationFailedError(error_message)
-          elif field_type == search.TextField:
-            fields.append(search.TextField(name=k, value=str(v)))
-          else:
-            # you may want to add handling of other field types for generality.
-            # Not needed for our current sample data.
-            logging.warn('not processed: %s, %s, of type %s', k, v, field_type)
-        else:
-          error_message = ('value not given for field "%s" of field type "%s"'
-                           % (k, field_type))
-          logging.warn(error_message)
-          raise errors.OperationFailedError(error_message)
+    # get the compiled schema of additional (non-'core') fields for this
+    # category, and build those fields from the given params.
+    category_schema = schema.getSchema(category_name)
+    if category_schema:
+      fields.extend(category_schema.buildFields(params))
     else:
       # else, did not have an entry in the params dict for the given field.
       logging.warn(
           'product field information not found for category name %s',
-          params['category_name'])
+          category_name)
+    # store the hash of the product data, which depends on all the other
+    # fields, so it is added last.
+    fields.append(search.AtomField(
+        name=cls.CONTENT_HASH, value=cls._hashFields(fields)))
     return fields
 
   @classmethod
@@ -445,7 +759,9 @@ class Product(BaseDocumentManager):
       # build and index the document.  Use the pid (product id) as the doc id.
       # (If we did not do this, and left the doc_id unspecified, an id would be
       # auto-generated.)
-      d = search.Document(doc_id=pid, fields=resfields)
+      d = search.Document(
+          doc_id=pid, fields=resfields,
+          facets=cls._buildProductFacets(category, price))
       return d
     else:
       raise errors.OperationFailedError('Missing parameter.')
@@ -476,13 +792,11 @@ class Product(BaseDocumentManager):
       raise errors.OperationFailedError(e2.error_message)
 
   @classmethod
-  def buildProductBatch(cls, rows):
-    """Build product documents and their related datastore entities, in batch,
-    given a list of params dicts.  Should be used for new products, as does not
-    handle updates of existing product entities. This method does not require
-    that the doc ids be tied to the product ids, and obtains the doc ids from
-    the results of the document add."""
-
+  def prepareProductBatch(cls, rows):
+    """Build product documents and their related datastore entities (sans
+    doc ids) from a list of params dicts.  Rows that don't make a valid product
+    are logged and left out.  Returns the lists of documents and entities, in
+    the same order."""
     docs = []
     dbps = []
     for row in rows:
@@ -493,26 +807,155 @@ class Product(BaseDocumentManager):
         # create product entity, sans doc_id
         dbp = models.Product(
             id=params['pid'], price=params['price'],
-            category=params['category'])
+            category=params['category'],
+            content_hash=cls(doc).getContentHash())
         dbps.append(dbp)
       except errors.OperationFailedError:
         logging.error('error creating document from data: %s', row)
-    try:
-      add_results = cls.add(docs)
-    except search.Error:
-      logging.exception('Add failed')
-      return
+    return (docs, dbps)
+
+  @classmethod
+  def setProductDocIds(cls, dbps, add_results):
+    """Set the product entities with the doc ids, the list of which are
+    returned by the index add in the same order as the list of docs given to
+    the indexers."""
     if len(add_results) != len(dbps):
       # this case should not be reached; if there was an issue,
-      # search.Error should have been thrown, above.
+      # search.Error should have been thrown by the add.
       raise errors.OperationFailedError(
           'Error: wrong number of results returned from indexing operation')
-    # now set the entities with the doc ids, the list of which are returned in
-    # the same order as the list of docs given to the indexers
     for i, dbp in enumerate(dbps):
       dbp.doc_id = add_results[i].id
-    # persist the entities
-    ndb.put_multi(dbps)
+
+  @classmethod
+  def buildProductBatch(cls, rows):
+    """Build product documents and their related datastore entities, in batch,
+    given a list of params dicts.  Should be used for new products, as does not
+    handle updates of existing product entities. This method does not require
+    that the doc ids be tied to the product ids, and obtains the doc ids from
+    the results of the document add."""
+
+    docs, dbps = cls.prepareProductBatch(rows)
+    add_results = cls.add(docs)
+    if add_results is None:  # the add failed, and was logged.
+      return
+    cls.setProductDocIds(dbps, add_results)
+    # persist the entities, and record their creation in the change log
+    changes = models.ProductChange.buildMulti(dbps, models.ProductChange.CREATE)
+    ndb.put_multi(dbps + changes)
+
+  @classmethod
+  def contentHash(cls, doc):
+    """Return the hash of the product data in the given doc: the hash stored
+    in the doc, or, for a doc indexed before hashes were stored, the hash
+    computed from its fields."""
+    return cls(doc).getContentHash() or cls._hashFields(doc.fields)
+
+  @classmethod
+  def _hashFields(cls, fields):
+    """Compute a hash of the product data in the given doc fields: their
+    names, types and values, other than the modification date and the average
+    rating."""
+    digest = hashlib.sha1()
+    for field in sorted(fields, key=lambda f: f.name):
+      if field.name in cls._UNHASHED_FIELDS:
+        continue
+      value = field.value
+      if isinstance(value, (int, long, float)):
+        value = repr(float(value))
+      elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+      digest.update('%s\0%s\0%s\0' % (
+          field.name, field.__class__.__name__, value))
+    return digest.hexdigest()
+
+  @classmethod
+  def upsertProducts(cls, rows):
+    """Create or update products in bulk, from an iterable of params dicts.
+    Unlike buildProduct, only the products whose data has changed are
+    re-indexed and written: each row's doc is diffed against the existing doc
+    by content hash (see contentHash), and against the existing entity's core
+    values.  Returns a dict of the counts of products created, updated and
+    unchanged, and of rows that failed."""
+    report = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    rows = iter(rows)
+    while True:
+      batch = list(itertools.islice(rows, cls._UPSERT_BATCH_SIZE))
+      if not batch:
+        break
+      cls._upsertBatch(batch, report)
+    logging.info('upserted products: %s', report)
+    return report
+
+  @classmethod
+  def _upsertBatch(cls, rows, report):
+    """Diff and write a batch of rows for upsertProducts, adding to the
+    counts in the report."""
+    new_docs = collections.OrderedDict()
+    params_by_pid = {}
+    for row in rows:
+      try:
+        params = cls._normalizeParams(row)
+        doc = cls._createDocument(**params)
+      except errors.OperationFailedError:
+        logging.error('error creating document from data: %s', row)
+        report['failed'] += 1
+        continue
+      new_docs[params['pid']] = doc
+      params_by_pid[params['pid']] = params
+    pids = new_docs.keys()
+    prods = dict(zip(pids, ndb.get_multi(
+        [ndb.Key(models.Product, pid) for pid in pids])))
+    curr_docs = cls.getDocs(pids)
+
+    created, updated = [], []
+    for pid in pids:
+      doc, curr_doc, prod = new_docs[pid], curr_docs.get(pid), prods[pid]
+      params = params_by_pid[pid]
+      if curr_doc:  # retain ratings info from the existing doc
+        cls(doc).setAvgRating(cls(curr_doc).getAvgRating())
+      if (curr_doc and prod and prod.doc_id == pid
+          and prod.price == params['price']
+          and prod.category == params['category']
+          and cls.contentHash(curr_doc) == cls.contentHash(doc)):
+        report['unchanged'] += 1
+      elif curr_doc or prod:
+        updated.append(pid)
+      else:
+        created.append(pid)
+    changed = created + updated
+    if not changed:
+      return
+    if cls.add([new_docs[pid] for pid in changed]) is None:
+      report['failed'] += len(changed)
+      return
+
+    # update the entities in transactions, so as not to overwrite concurrent
+    # ratings updates, recording each change in the change log.
+    seqs = dict(zip(changed, models.ProductChange.allocateSeqs(len(changed))))
+    def _tx(batch):
+      entities = []
+      for pid, prod in zip(batch, ndb.get_multi(
+          [ndb.Key(models.Product, pid) for pid in batch])):
+        content_hash = cls(new_docs[pid]).getContentHash()
+        if prod:
+          prod.update_core(params_by_pid[pid], pid, content_hash)
+          op = models.ProductChange.UPDATE
+        else:
+          params = params_by_pid[pid]
+          prod = models.Product(
+              id=pid, price=params['price'], category=params['category'],
+              doc_id=pid, content_hash=content_hash)
+          op = models.ProductChange.CREATE
+        entities.extend(
+            [prod, models.ProductChange.build(seqs[pid], prod.key, op, prod)])
+      ndb.put_multi(entities)
+    batch_size = models.Product._XG_BATCH_SIZE
+    for i in range(0, len(changed), batch_size):
+      batch = changed[i:i + batch_size]
+      ndb.transaction(lambda: _tx(batch), xg=True)
+    report['created'] += len(created)
+    report['updated'] += len(updated)
 
   @classmethod
   def buildProduct(cls, params):
@@ -537,17 +980,22 @@ class Product(BaseDocumentManager):
       doc_id = None
       raise errors.OperationFailedError('could not index document')
     logging.debug('got new doc id %s for product: %s', doc_id, params['pid'])
+    content_hash = cls(d).getContentHash()
+    seq = models.ProductChange.allocateSeqs(1)[0]
 
-    # now update the entity
+    # now update the entity, and record the change in the change log
     def _tx():
       # Check whether the product entity exists. If so, we want to update
       # from the params, but preserve its ratings-related info.
       prod = models.Product.get_by_id(params['pid'])
       if prod:  #update
-        prod.update_core(params, doc_id)
+        prod.update_core(params, doc_id, content_hash)
+        op = models.ProductChange.UPDATE
       else:   # create new entity
-        prod = models.Product.create(params, doc_id)
-      prod.put()
+        prod = models.Product.create(params, doc_id, content_hash)
+        op = models.ProductChange.CREATE
+      ndb.put_multi(
+          [prod, models.ProductChange.build(seq, prod.key, op, prod)])
       return prod
     prod = ndb.transaction(_tx)
     logging.debug('prod: %s', prod)
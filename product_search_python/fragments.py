@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the cache of rendered page fragments: the parts of the pages that
+depend only on the login state (the sidebar links), on the product categories
+(the category menu) or on the sort options (the sort menu), and on the option
+selected, rather than on the rest of the request.  Each fragment is rendered
+once per key on each instance, and reused as markup in the page templates.
+The category menu is keyed on the category version (see models.Category), so
+it is re-rendered when the categories change.
+"""
+
+from jinja2 import Markup
+
+import config
+import docs
+import models
+import searchcache
+
+
+_cache = searchcache.LRUCache(
+    config.FRAGMENT_CACHE_SIZE, config.FRAGMENT_CACHE_TTL)
+
+
+def render(jinja2, template_name, key, values):
+  """Return the rendering of the template with the given values, cached
+  under the given key (a tuple of the values' cache keys), as markup."""
+  cache_key = (template_name,) + key
+  html = _cache.get(cache_key)
+  if html is None:
+    html = jinja2.render_template(template_name, **values)
+    _cache.set(cache_key, html)
+  return Markup(html)
+
+
+def sidebarLinks(jinja2, logged_in):
+  """The login/logout and admin links of the sidebar."""
+  return render(jinja2, '_sidebar_links.html', (logged_in,),
+                {'logged_in': logged_in})
+
+
+def categoryMenu(jinja2, selected):
+  """The category select menu, with the given category selected."""
+  cat_info = models.Category.getCategoryInfo()
+  version = models.Category.getCategoryVersion()
+  # only the valid options are cached, so that the number of keys is bounded.
+  if selected not in set(cat_id for cat_id, _ in cat_info):
+    selected = None
+  values = {'cat_info': cat_info, 'pcategory': selected}
+  if version is None:
+    return Markup(jinja2.render_template('_category_menu.html', **values))
+  return render(jinja2, '_category_menu.html', (version, selected), values)
+
+
+def sortMenu(jinja2, selected):
+  """The sort select menu, with the given sort option selected."""
+  sort_info = docs.Product.getSortMenu()
+  if selected not in set(sort for sort, _ in sort_info):
+    selected = None
+  return render(jinja2, '_sort_menu.html', (selected,),
+                {'sort_info': sort_info, 'sort_order': selected})
+
+
+def clear():
+  """Clear the fragments cached on this instance."""
+  _cache.clear()
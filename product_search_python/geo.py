@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the store location lookups.  Each store doc is indexed with the
+geohash cells that contain it, at each precision from 1 to
+config.GEO_MAX_PRECISION, as values of an atom field.  A geohash cell of
+precision p is a rectangle of the lat/lon grid named by a p-character string,
+whose prefixes name the cells containing it at the lower precisions.
+
+To find the stores nearest a point, the 3x3 block of cells around the point is
+fetched, at the finest precision first.  Every store within the block's
+'covered radius' -- the distance from the point to the nearest edge of the
+block, which is at least a cell's width or height -- is in the block.  So if
+enough stores are found within that radius (or the max distance asked for is
+within it), they are the nearest; otherwise the block of the next coarser
+precision is fetched.  Each cell is fetched by a search on its atom value, and
+the stores in it are cached in memcache, keyed on the generation of the store
+index (see searchcache.py), so that changes to the index invalidate them.  A
+cell with more than config.GEO_CELL_LIMIT stores is only partly fetched, so a
+block containing one is not used: the cells of the coarser precisions contain
+it too, so the stores are then found by a distance-sorted search instead.
+"""
+
+import itertools
+import logging
+import math
+
+import config
+import docs
+import searchcache
+
+from google.appengine.api import memcache
+from google.appengine.api import search
+
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_EARTH_RADIUS_METERS = 6371010
+_METERS_PER_DEGREE = math.pi * _EARTH_RADIUS_METERS / 180
+_CELL_KEY = 'geocells:%s:%s'
+# the store doc fields returned by lookups; the cells are left out.
+_RETURNED_FIELDS = [docs.Store.STORE_NAME, docs.Store.STORE_ADDRESS,
+                    docs.Store.STORE_LOCATION]
+
+
+def geohash(lat, lon, precision):
+  """Return the geohash of the cell of the given precision containing the
+  given point."""
+  lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+  chars = []
+  bits = 0
+  value = 0
+  even = True
+  while len(chars) < precision:
+    # the bits alternate between halving the longitude and latitude ranges.
+    coord, rng = (lon, lon_range) if even else (lat, lat_range)
+    mid = (rng[0] + rng[1]) / 2
+    value <<= 1
+    if coord >= mid:
+      value |= 1
+      rng[0] = mid
+    else:
+      rng[1] = mid
+    even = not even
+    bits += 1
+    if bits == 5:
+      chars.append(_BASE32[value])
+      bits = 0
+      value = 0
+  return ''.join(chars)
+
+
+def cellSize(precision):
+  """Return the (height, width) in degrees of the cells of the given
+  precision."""
+  lon_bits = (5 * precision + 1) // 2
+  lat_bits = 5 * precision // 2
+  return (180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits)
+
+
+def blockCells(lat, lon, precision):
+  """Return the geohashes of the 3x3 block of cells of the given precision
+  centered on the cell of the given point.  Near the poles, the block may have
+  fewer cells."""
+  height, width = cellSize(precision)
+  cells = set()
+  for dlat in (-height, 0, height):
+    for dlon in (-width, 0, width):
+      cell_lat = max(-90.0, min(90.0 - 1e-9, lat + dlat))
+      cell_lon = (lon + dlon + 180.0) % 360.0 - 180.0
+      cells.add(geohash(cell_lat, cell_lon, precision))
+  return sorted(cells)
+
+
+def coveredRadius(lat, precision):
+  """Return the distance, in meters, within which all points around the given
+  latitude are in the 3x3 block of cells of the given precision: the smaller
+  of a cell's height and its width, at the block's most poleward latitude."""
+  height, width = cellSize(precision)
+  poleward = min(90.0, abs(lat) + 2 * height)
+  return _METERS_PER_DEGREE * min(
+      height, width * math.cos(math.radians(poleward)))
+
+
+def distance(lat1, lon1, lat2, lon2):
+  """Return the great-circle distance, in meters, between two points."""
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2)
+       * math.sin((lon2 - lon1) / 2) ** 2)
+  return 2 * _EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def buildStoreDoc(store_id, name, address, lat, lon):
+  """Build the doc of a store, with its geohash cells at each precision."""
+  cell = geohash(lat, lon, config.GEO_MAX_PRECISION)
+  fields = [search.TextField(name=docs.Store.STORE_NAME, value=name),
+            search.TextField(name=docs.Store.STORE_ADDRESS, value=address),
+            search.GeoField(name=docs.Store.STORE_LOCATION,
+                            value=search.GeoPoint(lat, lon))]
+  fields.extend(search.AtomField(name=docs.Store.STORE_CELL, value=cell[:p])
+                for p in range(1, config.GEO_MAX_PRECISION + 1))
+  return search.Document(doc_id=store_id, fields=fields)
+
+
+def loadStores(store_rows):
+  """Index stores from an iterable of (store_id, name, address, (lat, lon))
+  rows, in batches of as many docs as a put can take.  Returns the number of
+  stores indexed."""
+  store_rows = iter(store_rows)
+  loaded = 0
+  while True:
+    batch = [buildStoreDoc(store_id, name, address, lat, lon)
+             for store_id, name, address, (lat, lon) in itertools.islice(
+                 store_rows, docs.Store._MAX_PUT_BATCH)]
+    if not batch:
+      break
+    if docs.Store.add(batch) is not None:
+      loaded += len(batch)
+  logging.info('loaded %s stores.', loaded)
+  return loaded
+
+
+def _storeRecord(doc):
+  """Return the (store_id, name, address, lat, lon) of a store doc."""
+  sdoc = docs.Store(doc)
+  geopoint = sdoc.getFieldVal(docs.Store.STORE_LOCATION)
+  return (doc.doc_id, sdoc.getFieldVal(docs.Store.STORE_NAME),
+          sdoc.getFieldVal(docs.Store.STORE_ADDRESS),
+          geopoint.latitude, geopoint.longitude)
+
+
+def _cellQuery(cell):
+  return search.Query(
+      query_string='%s:%s' % (docs.Store.STORE_CELL, cell),
+      options=search.QueryOptions(
+          limit=config.GEO_CELL_LIMIT, returned_fields=_RETURNED_FIELDS))
+
+
+def getCells(cells):
+  """Return a dict of the store records in each of the given cells, from the
+  cache where possible, and the set of the cells with more stores than
+  config.GEO_CELL_LIMIT, whose records are incomplete.  The cells not cached
+  are searched for in parallel, and then cached."""
+  generation = searchcache.getCache(docs.Store._INDEX_NAME).getGeneration()
+  keys = dict((cell, _CELL_KEY % (generation, cell)) for cell in cells)
+  # each cell is cached as a (records, truncated) pair.
+  found = {}
+  if generation is not None:
+    cached = memcache.get_multi(keys.values())
+    for cell in cells:
+      if keys[cell] in cached:
+        found[cell] = cached[keys[cell]]
+  missing = [cell for cell in cells if cell not in found]
+  if missing:
+    index = docs.Store.getIndex()
+    futures = [(cell, index.search_async(_cellQuery(cell)))
+               for cell in missing]
+    fetched = {}
+    for cell, future in futures:
+      results = future.get_result()
+      truncated = results.number_found > config.GEO_CELL_LIMIT
+      if truncated:
+        logging.info('geo cell %s has %s stores, more than the %s fetched.',
+                     cell, results.number_found, config.GEO_CELL_LIMIT)
+      fetched[cell] = ([_storeRecord(doc) for doc in results], truncated)
+    found.update(fetched)
+    if generation is not None:
+      memcache.set_multi(
+          dict((keys[cell], value) for cell, value in fetched.iteritems()),
+          time=config.GEO_CELL_CACHE_TTL)
+  return (dict((cell, records) for cell, (records, _) in found.iteritems()),
+          set(cell for cell, (_, truncated) in found.iteritems()
+              if truncated))
+
+
+def _toResults(candidates):
+  return [{'store_id': store_id, 'name': name, 'address': address,
+           'lat': lat, 'lon': lon, 'distance': dist}
+          for dist, (store_id, name, address, lat, lon) in candidates]
+
+
+def _searchIndex(lat, lon, limit, max_distance):
+  """Find the stores nearest the point with a distance-sorted search of the
+  whole index.  Used when the coarsest block of cells does not cover the
+  stores asked for.  At most search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH
+  stores can be found this way."""
+  loc_expr = 'distance(%s, geopoint(%s, %s))' % (
+      docs.Store.STORE_LOCATION, lat, lon)
+  query_string = ''
+  if max_distance is not None:
+    query_string = '%s <= %s' % (loc_expr, max_distance)
+  results = docs.Store.getIndex().search(search.Query(
+      query_string=query_string,
+      options=search.QueryOptions(
+          limit=min(limit, search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH),
+          returned_fields=_RETURNED_FIELDS,
+          sort_options=search.SortOptions(expressions=[search.SortExpression(
+              expression=loc_expr, direction=search.SortExpression.ASCENDING,
+              default_value=0)]))))
+  candidates = []
+  for doc in results:
+    record = _storeRecord(doc)
+    candidates.append((distance(lat, lon, record[3], record[4]), record))
+  candidates.sort()
+  return _toResults(candidates)
+
+
+def nearestStores(lat, lon, limit, max_distance=None, offset=0):
+  """Return up to limit of the stores nearest the given point, within
+  max_distance meters of it if given, nearest first, skipping the offset
+  nearest.  Each store is a dict of its store_id, name, address, lat, lon,
+  and distance (in meters) from the point."""
+  return _nearestStores(lat, lon, offset + limit, max_distance)[offset:]
+
+
+def _nearestStores(lat, lon, limit, max_distance):
+  for precision in range(config.GEO_MAX_PRECISION, 0, -1):
+    covered = coveredRadius(lat, precision)
+    block, truncated = getCells(blockCells(lat, lon, precision))
+    if truncated:
+      # the block is missing stores, as are the coarser blocks containing it.
+      break
+    records = {}
+    for cell_records in block.values():
+      for record in cell_records:
+        records[record[0]] = record
+    candidates = []
+    for record in records.itervalues():
+      dist = distance(lat, lon, record[3], record[4])
+      if max_distance is None or dist <= max_distance:
+        candidates.append((dist, record))
+    candidates.sort()
+    if ((len(candidates) >= limit and candidates[limit - 1][0] <= covered)
+        or (max_distance is not None and max_distance <= covered)):
+      return _toResults(candidates[:limit])
+  return _searchIndex(lat, lon, limit, max_distance)
@@ -18,13 +18,22 @@
 
 
 import logging
+import os
+import time
 import urllib
 import wsgiref
 
+import base_handler
 from base_handler import BaseHandler
 import config
 import docs
+import fragments
+import geo
 import models
+import profiling
+import querybuilder
+import reviewingest
+import searchcache
 import utils
 
 from google.appengine.api import search
@@ -37,15 +46,54 @@ class IndexHandler(BaseHandler):
   """Displays the 'home' page."""
 
   def get(self):
-    cat_info = models.Category.getCategoryInfo()
-    sort_info = docs.Product.getSortMenu()
     template_values = {
-        'cat_info': cat_info,
-        'sort_info': sort_info,
+        'category_menu': fragments.categoryMenu(self.jinja2, None),
+        'sort_menu': fragments.sortMenu(self.jinja2, None),
     }
     self.render_template('index.html', template_values)
 
 
+class LoginHandler(BaseHandler):
+  """Redirects to the login page, returning to the page linked from.  The
+  sidebar links here, rather than to a login URL for each page, so that the
+  sidebar is the same on every page."""
+
+  def get(self):
+    self.redirect(users.create_login_url(self.getContinueUrl()))
+
+
+class LogoutHandler(BaseHandler):
+  """Redirects to the logout page, returning to the page linked from."""
+
+  def get(self):
+    self.redirect(users.create_logout_url(self.getContinueUrl()))
+
+
+class WarmupHandler(BaseHandler):
+  """Handles warmup requests, sent to new instances before they are given
+  traffic: loads the cached information used on the request path of the
+  product search pages, loads (and so compiles, or fetches the bytecode of)
+  all the templates, and renders the cached page fragments."""
+
+  def get(self):
+    started = time.time()
+    models.Category.getCategoryInfo()
+    docs.Product.getSortMenu()
+    docs.Product.getSortDict()
+    docs.Product.getFacetRequests()
+    environment = self.jinja2.environment
+    names = [name for name in os.listdir(base_handler.TEMPLATE_PATH)
+             if name.endswith('.html')]
+    for name in names:
+      environment.get_template(name)
+    for logged_in in (False, True):
+      fragments.sidebarLinks(self.jinja2, logged_in)
+    fragments.categoryMenu(self.jinja2, None)
+    fragments.sortMenu(self.jinja2, None)
+    logging.info('warmed up %s templates in %.1f secs.', len(names),
+                 time.time() - started)
+
+
 class ShowProductHandler(BaseHandler):
   """Display product details."""
 
@@ -202,12 +250,20 @@ class CreateReviewHandler(BaseHandler):
           username=username, rating=rating,
           comment=comment)
       review.put()
-      # in a transactional task, update the parent product's average
-      # rating to include this review's rating, and flag the review as
-      # processed.
-      defer(utils.updateAverageRating, key, _transactional=True)
+      if config.REVIEW_INGESTION == 'pull':
+        # queue the review, to be applied to the product along with the
+        # others it receives in the same window.
+        reviewingest.queueReview(review)
+      else:
+        # in a transactional task, update the parent product's average
+        # rating to include this review's rating, and flag the review as
+        # processed.
+        defer(utils.updateAverageRating, key, _transactional=True)
       return review
-    return ndb.transaction(_tx)
+    review = ndb.transaction(_tx)
+    if config.REVIEW_INGESTION == 'pull':
+      reviewingest.scheduleIngestion(pid)
+    return review
 
 
 class ProductSearchHandler(BaseHandler):
@@ -224,7 +280,11 @@ class ProductSearchHandler(BaseHandler):
         'category': '',
         'sort': '',
         'rating': '',
-        'offset': '0'
+        'offset': '0',
+        'cursor': '',
+        'pcursor': '',
+        'ncursor': '',
+        'noffset': ''
     }
     for k, v in params.iteritems():
       # Possibly replace default values.
@@ -254,44 +314,45 @@ class ProductSearchHandler(BaseHandler):
   def doProductSearch(self, params):
     """Perform a product search and display the results."""
 
-    # the defined product categories
-    cat_info = models.Category.getCategoryInfo()
-    # the product fields that we can sort on from the UI, and their mappings to
-    # search.SortExpression parameters
-    sort_info = docs.Product.getSortMenu()
-    sort_dict = docs.Product.getSortDict()
-    query = params.get('query', '')
-    user_query = query
+    user_query = params.get('query', '')
     doc_limit = self._getDocLimit()
-
     categoryq = params.get('category')
-    if categoryq:
-      # add specification of the category to the query
-      # Because the category field is atomic, put the category string
-      # in quotes for the search.
-      query += ' %s:"%s"' % (docs.Product.CATEGORY, categoryq)
-
     sortq = params.get('sort')
     try:
       offsetval = int(params.get('offset', 0))
     except ValueError:
       offsetval = 0
-
-    # Check to see if the query parameters include a ratings filter, and
-    # add that to the final query string if so.  At the same time, generate
-    # 'ratings bucket' counts and links-- based on the query prior to addition
-    # of the ratings filter-- for sidebar display.
-    query, rlinks = self._generateRatingsInfo(
-        params, query, user_query, sortq, categoryq)
-    logging.debug('query: %s', query.strip())
-
+    cursor = self._getCursor(params, offsetval)
+
+    # the user's query, with any category and ratings filters.  The category
+    # filter matches the categories below the chosen one in the tree too.
+    product_query = querybuilder.ProductQuery(
+        user_query, category=categoryq,
+        rating=querybuilder.parseRating(params.get('rating')),
+        sort=sortq, limit=doc_limit, offset=offsetval, cursor=cursor,
+        subcategories=(categoryq and
+                       models.Category.getDescendantCategories(categoryq)))
+    query = product_query.queryString()
+    logging.debug('query: %s', product_query)
+
+    # Results are cached on the canonical query key; the cache is invalidated
+    # whenever the product index is modified.
+    query_key = product_query.key()
+    result_cache = searchcache.getCache(docs.Product._INDEX_NAME)
+    results = None
+    if config.SEARCH_CACHE_SIZE:
+      results = result_cache.get(query_key)
     try:
-      # build the query and perform the search
-      search_query = self._buildQuery(
-          query, sortq, sort_dict, doc_limit, offsetval)
-      search_results = docs.Product.getIndex().search(search_query)
-      returned_count = len(search_results.results)
-
+      if results is None:
+        # start the searches, and look up the categories while they are in
+        # flight.
+        searches = self._startSearches(product_query)
+      # the category menu, of the defined product categories
+      category_menu = fragments.categoryMenu(self.jinja2, categoryq)
+      if results is None:
+        results = self._searchProducts(searches, product_query)
+        if config.SEARCH_CACHE_SIZE:
+          result_cache.set(query_key, results)
     except search.Error:
       logging.exception("Search error:")  # log the exception stack trace
       msg = 'There was a search error (see logs).'
@@ -302,8 +363,60 @@ class ProductSearchHandler(BaseHandler):
           {'title': 'Error', 'msg': msg,
            'goto_url': url, 'linktext': linktext})
       return
+    returned_count = results['returned_count']
+
+    if not query:
+      print_query = 'All'
+    else:
+      print_query = query
+
+    # Build the next/previous pagination links for the result set.
+    (prev_link, next_link) = self._generatePaginationLinks(
+        offsetval, returned_count,
+        results['number_found'], params, results['cursor'])
+
+    logging.debug('returned_count: %s', returned_count)
+    # construct the template values
+    template_values = {
+        'base_pquery': user_query, 'next_link': next_link,
+        'prev_link': prev_link, 'qtype': 'product',
+        'query': query, 'print_query': print_query,
+        'category_name': categoryq,
+        'first_res': offsetval + 1, 'last_res': offsetval + returned_count,
+        'returned_count': returned_count,
+        'number_found': results['number_found'],
+        'search_response': results['search_response'],
+        'category_menu': category_menu,
+        'sort_menu': fragments.sortMenu(self.jinja2, sortq),
+        'ratings_links': results['ratings_links'],
+        'category_links': results['category_links'],
+        'price_counts': results['price_counts']}
+    # render the result page.
+    self.render_template('index.html', template_values)
+
+  def _startSearches(self, product_query):
+    """Start the page search and, if the page is filtered on rating, the
+    ratings facet query for the unfiltered query, without waiting for their
+    results, so that they run concurrently.  Returns the pair of futures (the
+    second is None if not needed)."""
+
+    search_future = docs.Product.getIndex().search_async(
+        product_query.buildSearchQuery())
+    ratings_future = None
+    if product_query.rating:
+      ratings_future = docs.Product.generateRatingsBucketsAsync(
+          product_query.queryString(with_rating=False))
+    return (search_future, ratings_future)
+
+  def _searchProducts(self, searches, product_query):
+    """Wait for the searches started by _startSearches, and build a dict of
+    the result information to be displayed.  This dict is what gets cached for
+    the query."""
+
+    search_future, ratings_future = searches
+    with profiling.span('search'):
+      search_results = search_future.get_result()
 
-    # cat_name = models.Category.getCategoryName(categoryq)
     psearch_response = []
     # For each document returned from the search
     for doc in search_results:
@@ -318,7 +431,7 @@ class ProductSearchHandler(BaseHandler):
         if expr.name == docs.Product.DESCRIPTION:
           description_snippet = expr.value
         # uncomment to use 'adjusted price', which should be
-        # defined in returned_expressions in _buildQuery() below, as the
+        # defined in returned_expressions in querybuilder.QueryTemplate, as the
         # displayed price.
         # elif expr.name == 'adjusted_price':
           # price = expr.value
@@ -333,121 +446,123 @@ class ProductSearchHandler(BaseHandler):
       psearch_response.append(
           [doc, urllib.quote_plus(pid), cat,
            description_snippet, price, pname, catname, avg_rating])
-    if not query:
-      print_query = 'All'
-    else:
-      print_query = query
 
-    # Build the next/previous pagination links for the result set.
-    (prev_link, next_link) = self._generatePaginationLinks(
-        offsetval, returned_count,
-        search_results.number_found, params)
-
-    logging.debug('returned_count: %s', returned_count)
-    # construct the template values
-    template_values = {
-        'base_pquery': user_query, 'next_link': next_link,
-        'prev_link': prev_link, 'qtype': 'product',
-        'query': query, 'print_query': print_query,
-        'pcategory': categoryq, 'sort_order': sortq, 'category_name': categoryq,
-        'first_res': offsetval + 1, 'last_res': offsetval + returned_count,
-        'returned_count': returned_count,
+    # Generate the 'ratings bucket' counts and links-- based on the query prior
+    # to addition of the ratings filter-- and the category and price facet
+    # counts, for sidebar display.
+    rlinks = self._generateRatingsInfo(
+        product_query, search_results.facets, ratings_future)
+    clinks = docs.Product.generateCategoryLinks(
+        search_results.facets,
+        {'query': product_query.user_query.encode('utf-8'),
+         'sort': product_query.sort},
+        product_query.category)
+    price_counts = docs.Product.generatePriceCounts(search_results.facets)
+
+    return {
         'number_found': search_results.number_found,
+        'returned_count': len(search_results.results),
         'search_response': psearch_response,
-        'cat_info': cat_info, 'sort_info': sort_info,
-        'ratings_links': rlinks}
-    # render the result page.
-    self.render_template('index.html', template_values)
-
-  def _buildQuery(self, query, sortq, sort_dict, doc_limit, offsetval):
-    """Build and return a search query object."""
-
-    # computed and returned fields examples.  Their use is not required
-    # for the application to function correctly.
-    computed_expr = search.FieldExpression(name='adjusted_price',
-        expression='price * 1.08')
-    returned_fields = [docs.Product.PID, docs.Product.DESCRIPTION,
-                docs.Product.CATEGORY, docs.Product.AVG_RATING,
-                docs.Product.PRICE, docs.Product.PRODUCT_NAME]
-
-    if sortq == 'relevance':
-      # If sorting on 'relevance', use the Match scorer.
-      sortopts = search.SortOptions(match_scorer=search.MatchScorer())
-      search_query = search.Query(
-          query_string=query.strip(),
-          options=search.QueryOptions(
-              limit=doc_limit,
-              offset=offsetval,
-              sort_options=sortopts,
-              snippeted_fields=[docs.Product.DESCRIPTION],
-              returned_expressions=[computed_expr],
-              returned_fields=returned_fields
-              ))
+        'cursor': (search_results.cursor and
+                   search_results.cursor.web_safe_string),
+        'ratings_links': rlinks,
+        'category_links': clinks,
+        'price_counts': price_counts}
+
+  def _getCursor(self, params, offsetval):
+    """Return the search.Cursor to use for this page of results, or None to
+    page by offset.  When cursor pagination is enabled, a page is fetched from
+    the (web-safe) cursor given in the request params; otherwise, for a first
+    page, a new cursor is requested so that the next page can be fetched from
+    it."""
+    if not config.CURSOR_PAGINATION:
+      return None
+    cursor_string = params.get('cursor')
+    if cursor_string:
+      try:
+        return search.Cursor(web_safe_string=cursor_string)
+      except ValueError:
+        logging.warn('bad cursor: %s; paging by offset.', cursor_string)
+        params['cursor'] = ''
+        return None
+    if offsetval:
+      # a page reached by offset (see _generatePaginationLinks) can't also
+      # be fetched from a cursor.
+      return None
+    return search.Cursor()
+
+  def _generateRatingsInfo(
+      self, product_query, facet_results, ratings_future=None):
+    """Build the sidebar ratings buckets content.  The bucket counts are taken
+    from the facets returned with the page of results, unless that page was
+    filtered on rating; in that case the counts for the unfiltered query are
+    taken from the given ratings facet query future, or requested separately
+    if there is none."""
+
+    if product_query.rating:
+      ratings_buckets = ratings_future and (ratings_future.get_result() or {})
     else:
-      # Otherwise (not sorting on relevance), use the selected field as the
-      # first dimension of the sort expression, and the average rating as the
-      # second dimension, unless we're sorting on rating, in which case price
-      # is the second sort dimension.
-      # We get the sort direction and default from the 'sort_dict' var.
-      if sortq == docs.Product.AVG_RATING:
-        expr_list = [sort_dict.get(sortq), sort_dict.get(docs.Product.PRICE)]
-      else:
-        expr_list = [sort_dict.get(sortq), sort_dict.get(
-              docs.Product.AVG_RATING)]
-      sortopts = search.SortOptions(expressions=expr_list)
-      # logging.info("sortopts: %s", sortopts)
-      search_query = search.Query(
-          query_string=query.strip(),
-          options=search.QueryOptions(
-              limit=doc_limit,
-              offset=offsetval,
-              sort_options=sortopts,
-              snippeted_fields=[docs.Product.DESCRIPTION],
-              returned_expressions=[computed_expr],
-              returned_fields=returned_fields
-              ))
-    return search_query
-
-  def _generateRatingsInfo(self, params, query, user_query, sort, category):
-    """Add a ratings filter to the query as necessary, and build the
-    sidebar ratings buckets content."""
-
-    orig_query = query
-    try:
-      n = int(params.get('rating', 0))
-      # check that rating is not out of range
-      if n < config.RATING_MIN or n > config.RATING_MAX:
-        n = None
-    except ValueError:
-      n = None
-    if n:
-      if n < config.RATING_MAX:
-        query += ' %s >= %s %s < %s' % (docs.Product.AVG_RATING, n,
-                                        docs.Product.AVG_RATING, n+1)
-      else:  # max rating
-        query += ' %s:%s' % (docs.Product.AVG_RATING, n)
-    query_info = {'query': user_query.encode('utf-8'), 'sort': sort,
-             'category': category}
-    rlinks = docs.Product.generateRatingsLinks(orig_query, query_info)
-    return (query, rlinks)
+      ratings_buckets = (
+          docs.Product.ratingsBucketsFromFacets(facet_results) or {})
+    query_info = {'query': product_query.user_query.encode('utf-8'),
+                  'sort': product_query.sort,
+                  'category': product_query.category or ''}
+    return docs.Product.generateRatingsLinks(
+        product_query.queryString(with_rating=False), query_info,
+        ratings_buckets)
 
   def _generatePaginationLinks(
-        self, offsetval, returned_count, number_found, params):
+        self, offsetval, returned_count, number_found, params,
+        next_cursor=None):
     """Generate the next/prev pagination links for the query.  Detect when we're
     out of results in a given direction and don't generate the link in that
-    case."""
+    case.
+
+    If the search returned a (web-safe) cursor, the next link continues from
+    it, so that the cost of fetching a page does not depend on how deep it is,
+    and there is no limit on that depth.  The offset is still carried along in
+    the links, for display.  Cursors only run forward: the previous link pages
+    by offset while that is within the offset limit, and beyond it goes back
+    one page, via the cursor that the current page was fetched from
+    ('pcursor').
+
+    A page reached by offset is not fetched from a cursor, so it returns no
+    cursor for the next page.  So the previous links, and the next links
+    paging by offset, carry the cursor of the page that paging back by offset
+    started from ('ncursor'), and that page's offset ('noffset'): the next link
+    of the page before it continues from that cursor, rather than by an offset
+    that may be past the offset limit."""
 
     doc_limit = self._getDocLimit()
     pcopy = params.copy()
-    if offsetval - doc_limit >= 0:
-      pcopy['offset'] = offsetval - doc_limit
+    pcopy['cursor'] = pcopy['pcursor'] = ''
+    if params.get('cursor'):
+      pcopy['ncursor'], pcopy['noffset'] = params['cursor'], offsetval
+    prev_offset = offsetval - doc_limit
+    if 0 <= prev_offset <= self._OFFSET_LIMIT:
+      pcopy['offset'] = prev_offset
+      prev_link = '/psearch?' + urllib.urlencode(pcopy)
+    elif prev_offset > 0 and params.get('pcursor'):
+      pcopy['offset'] = prev_offset
+      pcopy['cursor'] = params['pcursor']
+      pcopy['ncursor'] = pcopy['noffset'] = ''
       prev_link = '/psearch?' + urllib.urlencode(pcopy)
     else:
       prev_link = None
-    if ((offsetval + doc_limit <= self._OFFSET_LIMIT)
-        and (returned_count == doc_limit)
-        and (offsetval + returned_count < number_found)):
-      pcopy['offset'] = offsetval + doc_limit
+    pcopy = params.copy()
+    pcopy['cursor'] = pcopy['pcursor'] = ''
+    more_results = ((returned_count == doc_limit)
+                    and (offsetval + returned_count < number_found))
+    next_offset = offsetval + doc_limit
+    if more_results and (next_cursor or params.get('ncursor') and
+                         params.get('noffset') == str(next_offset)):
+      pcopy['offset'] = next_offset
+      pcopy['cursor'] = next_cursor or params['ncursor']
+      pcopy['pcursor'] = params.get('cursor', '')
+      pcopy['ncursor'] = pcopy['noffset'] = ''
+      next_link = '/psearch?' + urllib.urlencode(pcopy)
+    elif more_results and (next_offset <= self._OFFSET_LIMIT):
+      pcopy['offset'] = next_offset
       next_link = '/psearch?' + urllib.urlencode(pcopy)
     else:
       next_link = None
@@ -491,47 +606,59 @@ class ShowReviewsHandler(BaseHandler):
 
 
 class StoreLocationHandler(BaseHandler):
-  """Show the reviews for a given product.  This information is pulled from the
-  datastore Review entities."""
+  """Show the store locations near a given location, a page at a time, as
+  JSON(P)."""
 
-  def get(self):
-    """Show a list of reviews for the product indicated by the 'pid' request
-    parameter."""
+  # the response fields of a store, and the store dict keys they come from.
+  _FIELDS = {'storename': 'name', 'addr': 'address', 'lat': 'lat',
+             'lon': 'lon', 'distance': 'distance', 'id': 'store_id'}
+  _DEFAULT_FIELDS = ('storename', 'addr', 'lat', 'lon')
 
-    query = self.request.get('location_query')
-    lat = self.request.get('latitude')
-    lon = self.request.get('longitude')
-    # the location query from the client will have this form:
-    # distance(store_location, geopoint(37.7899528, -122.3908226)) < 40000
-    # logging.info('location query: %s, lat %s, lon %s', query, lat, lon)
+  def get(self):
+    """Show a page of the stores nearest the location given by the
+    'latitude' and 'longitude' request parameters, within the number of
+    meters given by the 'distance' parameter, if any.  The 'limit' parameter,
+    which is required, gives the number of stores per page, and 'offset' the
+    number of nearer stores to skip.  The 'fields' parameter optionally lists
+    the (comma-separated) store fields to return.  The response is an object
+    with the page of 'stores', and the 'next_offset' of the next page, or
+    null.  The stores are looked up in the geohash cells around the location
+    (see geo.py), rather than by a distance sort of the whole store index."""
+
+    params = self.request
     try:
-      index = search.Index(config.STORE_INDEX_NAME)
-      # search using simply the query string:
-      # results = index.search(query)
-      # alternately: sort results by distance
-      loc_expr = 'distance(store_location, geopoint(%s, %s))' % (lat, lon)
-      sortexpr = search.SortExpression(
-            expression=loc_expr,
-            direction=search.SortExpression.ASCENDING, default_value=0)
-      sortopts = search.SortOptions(expressions=[sortexpr])
-      search_query = search.Query(
-          query_string=query.strip(),
-          options=search.QueryOptions(
-              sort_options=sortopts,
-              ))
-      results = index.search(search_query)
+      lat = float(params.get('latitude'))
+      lon = float(params.get('longitude'))
+      max_distance = (
+          float(params.get('distance')) if params.get('distance') else None)
+      limit = int(params.get('limit'))
+      offset = int(params.get('offset') or 0)
+    except ValueError:
+      logging.info('bad store location request: %s', params.query_string)
+      self.error(400)
+      return
+    fields = (params.get('fields').split(',') if params.get('fields')
+              else self._DEFAULT_FIELDS)
+    if (limit < 1 or limit > config.STORE_LOCATION_MAX_LIMIT or offset < 0
+        or offset + limit > config.STORE_LOCATION_MAX_RESULTS
+        or not set(fields) <= set(self._FIELDS)):
+      logging.info('bad store location request: %s', params.query_string)
+      self.error(400)
+      return
+    try:
+      # fetch one more than the page, to know whether there is a next page.
+      stores = geo.nearestStores(lat, lon, limit + 1, max_distance, offset)
     except search.Error:
       logging.exception("There was a search error:")
-      self.render_json([])
-      return
-    # logging.info("geo search results: %s", results)
-    response_obj2 = []
-    for res in results:
-      gdoc = docs.Store(res)
-      geopoint = gdoc.getFieldVal(gdoc.STORE_LOCATION)
-      resp = {'addr': gdoc.getFieldVal(gdoc.STORE_ADDRESS),
-              'storename': gdoc.getFieldVal(gdoc.STORE_NAME),
-              'lat': geopoint.latitude, 'lon': geopoint.longitude}
-      response_obj2.append(resp)
-    logging.info("resp: %s", response_obj2)
-    self.render_json(response_obj2)
+      stores = []
+    next_offset = None
+    if (len(stores) > limit
+        and offset + 2 * limit <= config.STORE_LOCATION_MAX_RESULTS):
+      next_offset = offset + limit
+    keys = [(field, self._FIELDS[field]) for field in fields]
+    logging.debug('found %s stores.', len(stores[:limit]))
+    self.render_json_list(
+        'stores',
+        (dict((field, store[key]) for field, key in keys)
+         for store in stores[:limit]),
+        {'next_offset': next_offset})
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the engine for importing product data in bulk.  Rows are read
+lazily from an iterator (e.g. a csv.DictReader), built into batches of
+documents and product entities, and written with the asynchronous index and
+datastore APIs, so that several batches are in flight at once.
+"""
+
+import collections
+import logging
+import time
+
+import config
+import docs
+import models
+import utils
+
+from google.appengine.ext import ndb
+
+
+class _Batch(object):
+  """A batch of product documents and entities being imported."""
+
+  def __init__(self, number, rows):
+    self.number = number
+    self.num_rows = len(rows)
+    self.docs, self.dbps = docs.Product.prepareProductBatch(rows)
+    self.attempts = 0
+    self.index_future = None
+    self.put_futures = None
+    self.changes = []
+
+
+class ProductImporter(object):
+  """Imports product rows into the product index and the datastore.
+
+  Each batch goes through two stages: its documents are indexed, and then,
+  once the doc ids are known, its product entities are put.  Up to
+  max_in_flight batches may be waiting on each stage; when either stage is
+  full, the importer waits for its oldest batch before reading more rows.
+  A batch whose index or datastore write fails is retried up to max_retries
+  times.
+  """
+
+  # the max number of rows/products per batch
+  MAX_BATCH_SIZE = 100
+  # seconds to wait before the first retry of a failed batch; doubled for
+  # each further retry.
+  RETRY_DELAY = 0.5
+
+  def __init__(self, batch_size=None, max_in_flight=None, max_retries=None):
+    # ensure the batch size is not over the max or < 1.
+    self.batch_size = utils.intClamp(
+        batch_size or config.IMPORT_BATCH_SIZE, 1, self.MAX_BATCH_SIZE)
+    self.max_in_flight = max(1, max_in_flight or config.IMPORT_MAX_IN_FLIGHT)
+    if max_retries is None:
+      max_retries = config.IMPORT_MAX_RETRIES
+    self.max_retries = max_retries
+    self._indexing = collections.deque()
+    self._putting = collections.deque()
+    self.rows = 0
+    self.imported = 0
+    self.failed = 0
+    self.retries = 0
+    self.batches = 0
+
+  def _readBatches(self, reader):
+    """Generate lists of up to batch_size rows from the reader."""
+    rows = []
+    for row in reader:
+      rows.append(row)
+      if len(rows) == self.batch_size:
+        yield rows
+        rows = []
+    if rows:
+      yield rows
+
+  def _startIndexing(self, batch):
+    batch.attempts += 1
+    batch.index_future = docs.Product.getIndex().put_async(batch.docs)
+
+  def _startPutting(self, batch):
+    batch.attempts += 1
+    batch.put_futures = ndb.put_multi_async(batch.dbps + batch.changes)
+
+  def _retry(self, batch, start_stage, stage):
+    """Retry a failed stage of the batch, if it has any attempts left."""
+    if batch.attempts > self.max_retries:
+      logging.error('giving up on import batch %s (%s): %s',
+                    batch.number, stage, [d.doc_id for d in batch.docs])
+      self.failed += len(batch.docs)
+      return False
+    self.retries += 1
+    time.sleep(self.RETRY_DELAY * 2 ** (batch.attempts - 1))
+    start_stage(batch)
+    return True
+
+  def _finishIndexing(self, batch):
+    """Wait for the indexing of the batch's docs, then start putting its
+    entities."""
+    while True:
+      try:
+        add_results = batch.index_future.get_result()
+        break
+      except Exception:  # not only search.Errors; e.g. apiproxy deadlines.
+        logging.exception('Error indexing import batch %s.', batch.number)
+        if not self._retry(batch, self._startIndexing, 'index'):
+          return
+    docs.Product.setProductDocIds(batch.dbps, add_results)
+    # record the creation of the products in the change log, with the same
+    # sequence numbers on any retries of the put.
+    batch.changes = models.ProductChange.buildMulti(
+        batch.dbps, models.ProductChange.CREATE)
+    batch.attempts = 0
+    self._startPutting(batch)
+    self._putting.append(batch)
+    if len(self._putting) >= self.max_in_flight:
+      self._finishPutting(self._putting.popleft())
+
+  def _finishPutting(self, batch):
+    """Wait for the put of the batch's entities."""
+    while True:
+      try:
+        for future in batch.put_futures:
+          future.get_result()
+        break
+      except Exception:  # datastore errors have no common base class.
+        logging.exception('Error putting import batch %s.', batch.number)
+        if not self._retry(batch, self._startPutting, 'datastore'):
+          return
+    self.imported += len(batch.dbps)
+
+  def run(self, reader):
+    """Import all the rows from the reader.  Returns a report dict of the
+    counts and the throughput."""
+    start = time.time()
+    try:
+      for rows in self._readBatches(reader):
+        self.batches += 1
+        self.rows += len(rows)
+        batch = _Batch(self.batches, rows)
+        self.failed += batch.num_rows - len(batch.docs)
+        if not batch.docs:
+          continue
+        self._startIndexing(batch)
+        self._indexing.append(batch)
+        if len(self._indexing) >= self.max_in_flight:
+          self._finishIndexing(self._indexing.popleft())
+      while self._indexing:
+        self._finishIndexing(self._indexing.popleft())
+      while self._putting:
+        self._finishPutting(self._putting.popleft())
+    finally:
+      # whatever was indexed before any error invalidates the cached results.
+      docs.Product.invalidateCache()
+
+    elapsed = time.time() - start
+    report = {
+        'rows': self.rows, 'imported': self.imported, 'failed': self.failed,
+        'batches': self.batches, 'retries': self.retries,
+        'seconds': elapsed,
+        'rows_per_sec': self.rows / elapsed if elapsed else 0.0}
+    logging.info(
+        'Imported %(imported)s of %(rows)s rows in %(batches)s batches '
+        '(%(failed)s failed, %(retries)s retries) in %(seconds).1f secs: '
+        '%(rows_per_sec).1f rows/sec.', report)
+    return report
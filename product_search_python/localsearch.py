@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains a local, in-memory search backend, for offline testing and
+benchmarking.  LocalIndex implements the subset of the search.Index interface
+that the app uses -- put, delete, get, get_range and search, and their async
+variants -- and returns the search API's own result classes.
+
+Documents are indexed in:
+  - an inverted index of text tokens, with per-document term counts
+    (posting lists), over all text fields and per field;
+  - a hash map of (field, value) for atom fields;
+  - a sorted array per number and date field, for range queries by bisection
+    (rebuilt lazily, on the first query after the field is modified);
+  - a map of doc id to location per geo field.
+
+The query language supported is a subset of the search API's: terms and quoted
+phrases (matched as conjunctions of their tokens, regardless of position);
+'field:value' and 'field = value' restrictions, and restrictions to any of a
+list of values ('field:("a" OR "b")'); numeric and date comparisons
+('price < 10', 'ar >= 4'); and distance comparisons
+('distance(store_location, geopoint(37.7, -122.4)) < 40000').  All the parts of
+a query must match.  Results can be sorted on field values, distances, or a
+simple term-frequency score.  Snippets and returned expressions are not
+computed.
+
+Set config.SEARCH_BACKEND to 'local' to use this backend (see
+docs.BaseDocumentManager.getIndex).
+"""
+
+import base64
+import bisect
+import collections
+import datetime
+import heapq
+import math
+import re
+import threading
+
+from google.appengine.api import search
+
+
+# the defaults of the search API.
+_DEFAULT_LIMIT = 20
+_DEFAULT_VALUE_LIMIT = 10
+_EARTH_RADIUS_METERS = 6371010
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_QUERY_RE = re.compile(r'''
+    \s*(?:
+      distance\(\s*(?P<dfield>\w+)\s*,\s*
+        geopoint\(\s*(?P<lat>[-+\d.]+)\s*,\s*(?P<lon>[-+\d.]+)\s*\)\s*\)
+        \s*(?P<dop><=|>=|<|>|=)\s*(?P<dvalue>[-+\d.]+)
+      | (?P<cfield>\w+)\s*:\s*\((?P<choices>(?:[^()"]|"(?:[^"\\]|\\.)*")*)\)
+      | (?P<field>\w+)\s*(?P<op><=|>=|<|>|=|:)\s*
+        (?:"(?P<fquoted>(?:[^"\\]|\\.)*)"|(?P<fvalue>[^\s()"]+))
+      | "(?P<phrase>(?:[^"\\]|\\.)*)"
+      | (?P<term>[^\s()"]+)
+    )''', re.VERBOSE | re.UNICODE)
+_DISTANCE_EXPR_RE = re.compile(
+    r'\s*distance\(\s*(\w+)\s*,\s*'
+    r'geopoint\(\s*([-+\d.]+)\s*,\s*([-+\d.]+)\s*\)\s*\)\s*$')
+_CHOICE_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s"]+)', re.UNICODE)
+# query words that the local backend treats as noise.
+_NOISE_WORDS = frozenset(['AND'])
+
+
+def _unescape(value):
+  """Remove the backslash escapes from a quoted query value."""
+  return re.sub(r'\\(.)', r'\1', value)
+
+
+def _tokenize(value):
+  return _WORD_RE.findall(unicode(value).lower())
+
+
+def _numericValue(value):
+  """Convert a number or date field value to the number it is indexed and
+  sorted as; dates are indexed as day ordinals."""
+  if isinstance(value, datetime.datetime):
+    return value.date().toordinal()
+  if isinstance(value, datetime.date):
+    return value.toordinal()
+  return value
+
+
+def _parseNumber(value):
+  """Parse a query value as a number, or as a date (YYYY-MM-DD); None if it is
+  neither."""
+  try:
+    return float(value)
+  except ValueError:
+    pass
+  try:
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+  except ValueError:
+    return None
+
+
+def _distance(point, lat, lon):
+  """The great-circle distance, in meters, between two locations."""
+  lat1, lon1 = math.radians(point.latitude), math.radians(point.longitude)
+  lat2, lon2 = math.radians(lat), math.radians(lon)
+  a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+       math.sin((lon2 - lon1) / 2) ** 2)
+  return 2 * _EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _compare(value, op, target):
+  if op in (':', '='):
+    return value == target
+  if op == '<':
+    return value < target
+  if op == '<=':
+    return value <= target
+  if op == '>':
+    return value > target
+  return value >= target
+
+
+class _NumericIndex(object):
+  """The values of one number (or date) field, as an array sorted by value.
+  The array is rebuilt on the first range query after a modification, so
+  that bulk loads don't pay for keeping it sorted."""
+
+  def __init__(self):
+    self._values = {}
+    self._keys = None
+    self._ids = None
+
+  def add(self, doc_id, value):
+    self._values[doc_id] = value
+    self._keys = None
+
+  def remove(self, doc_id):
+    if self._values.pop(doc_id, None) is not None:
+      self._keys = None
+
+  def _build(self):
+    pairs = sorted((value, doc_id) for doc_id, value in self._values.iteritems())
+    self._keys = [value for value, _ in pairs]
+    self._ids = [doc_id for _, doc_id in pairs]
+
+  def select(self, op, target):
+    """Return the set of ids of the docs whose value compares to the target
+    with the given operator."""
+    if self._keys is None:
+      self._build()
+    lo, hi = 0, len(self._keys)
+    if op in (':', '=', '>='):
+      lo = bisect.bisect_left(self._keys, target)
+    elif op == '>':
+      lo = bisect.bisect_right(self._keys, target)
+    if op in (':', '=', '<='):
+      hi = bisect.bisect_right(self._keys, target)
+    elif op == '<':
+      hi = bisect.bisect_left(self._keys, target)
+    return set(self._ids[lo:hi])
+
+
+class _Reversed(object):
+  """Wraps a sort key, inverting its order (for descending string sorts)."""
+
+  __slots__ = ['key']
+
+  def __init__(self, key):
+    self.key = key
+
+  def __lt__(self, other):
+    return other.key < self.key
+
+  def __eq__(self, other):
+    return self.key == other.key
+
+
+class _Future(object):
+  """The result of an 'async' call.  The local backend does the work up front;
+  the future just holds its result, or the error it raised."""
+
+  def __init__(self, function, *args, **kwargs):
+    self._result = self._error = None
+    try:
+      self._result = function(*args, **kwargs)
+    except search.Error as e:
+      self._error = e
+
+  def get_result(self):
+    if self._error:
+      raise self._error
+    return self._result
+
+
+class LocalIndex(object):
+  """An in-memory index, implementing the parts of search.Index used by the
+  app."""
+
+  def __init__(self, name):
+    self.name = name
+    self._lock = threading.RLock()
+    self._docs = {}
+    self._sorted_ids = None
+    self._text = collections.defaultdict(dict)  # token -> {id: count}
+    self._field_text = collections.defaultdict(set)  # (field, token) -> ids
+    self._atoms = collections.defaultdict(set)  # (field, value) -> ids
+    self._numbers = collections.defaultdict(_NumericIndex)
+    self._geo = collections.defaultdict(dict)  # field -> {id: GeoPoint}
+    self._sort_values = {}  # id -> {field: first value}
+
+  # indexing
+
+  def _index(self, doc):
+    doc_id = doc.doc_id
+    values = {}
+    for field in doc.fields:
+      name, value = field.name, field.value
+      if isinstance(field, (search.TextField, search.HtmlField)):
+        for token in _tokenize(value or ''):
+          postings = self._text[token]
+          postings[doc_id] = postings.get(doc_id, 0) + 1
+          self._field_text[(name, token)].add(doc_id)
+      elif isinstance(field, search.AtomField):
+        self._atoms[(name, unicode(value).lower())].add(doc_id)
+      elif isinstance(field, (search.NumberField, search.DateField)):
+        value = _numericValue(value)
+        if name not in values:
+          self._numbers[name].add(doc_id, value)
+      elif isinstance(field, search.GeoField):
+        self._geo[name].setdefault(doc_id, value)
+      values.setdefault(name, value)
+    self._sort_values[doc_id] = values
+    self._docs[doc_id] = doc
+
+  def _unindex(self, doc_id):
+    doc = self._docs.pop(doc_id, None)
+    if not doc:
+      return
+    for field in doc.fields:
+      name = field.name
+      if isinstance(field, (search.TextField, search.HtmlField)):
+        for token in _tokenize(field.value or ''):
+          self._text[token].pop(doc_id, None)
+          self._field_text[(name, token)].discard(doc_id)
+      elif isinstance(field, search.AtomField):
+        self._atoms[(name, unicode(field.value).lower())].discard(doc_id)
+      elif isinstance(field, (search.NumberField, search.DateField)):
+        self._numbers[name].remove(doc_id)
+      elif isinstance(field, search.GeoField):
+        self._geo[name].pop(doc_id, None)
+    self._sort_values.pop(doc_id, None)
+
+  def put(self, documents):
+    """Index the given document(s), replacing any with the same ids."""
+    if isinstance(documents, search.Document):
+      documents = [documents]
+    results = []
+    with self._lock:
+      for doc in documents:
+        if doc.doc_id is None:
+          raise search.PutError('local backend requires doc ids', [])
+        self._unindex(doc.doc_id)
+        self._index(doc)
+        results.append(search.PutResult(
+            code=search.OperationResult.OK, id=doc.doc_id))
+      self._sorted_ids = None
+    return results
+
+  def delete(self, document_ids):
+    """Delete the documents with the given id(s), if they exist."""
+    if isinstance(document_ids, basestring):
+      document_ids = [document_ids]
+    with self._lock:
+      for doc_id in document_ids:
+        self._unindex(doc_id)
+      self._sorted_ids = None
+
+  def put_async(self, documents, **kwargs):
+    return _Future(self.put, documents)
+
+  def delete_async(self, document_ids, **kwargs):
+    return _Future(self.delete, document_ids)
+
+  # retrieval
+
+  def _copy(self, doc, ids_only=False):
+    """Return a copy of a stored doc, so that callers can modify it without
+    modifying the index."""
+    if ids_only:
+      return search.Document(doc_id=doc.doc_id)
+    return search.Document(
+        doc_id=doc.doc_id, fields=list(doc.fields), language=doc.language,
+        rank=doc.rank, facets=list(doc.facets))
+
+  def get(self, doc_id):
+    doc = self._docs.get(doc_id)
+    return doc and self._copy(doc)
+
+  def get_range(self, start_id=None, include_start_object=True, limit=100,
+                ids_only=False, **kwargs):
+    """Return up to limit documents in doc id order, from the start id."""
+    with self._lock:
+      if self._sorted_ids is None:
+        self._sorted_ids = sorted(self._docs)
+      sorted_ids = self._sorted_ids
+    if start_id is None:
+      start = 0
+    elif include_start_object:
+      start = bisect.bisect_left(sorted_ids, start_id)
+    else:
+      start = bisect.bisect_right(sorted_ids, start_id)
+    results = [self._copy(self._docs[doc_id], ids_only)
+               for doc_id in sorted_ids[start:start + limit]
+               if doc_id in self._docs]
+    return search.GetResponse(results=results)
+
+  def get_range_async(self, **kwargs):
+    return _Future(self.get_range, **kwargs)
+
+  # search
+
+  def _matchText(self, text, field=None):
+    """The ids of the docs containing all the tokens of the text, in the given
+    field or in any text field."""
+    ids = None
+    for token in _tokenize(text):
+      if field:
+        matches = self._field_text.get((field, token), set())
+      else:
+        matches = set(self._text.get(token, ()))
+      ids = matches if ids is None else ids & matches
+    return ids if ids is not None else set()
+
+  def _matchField(self, field, op, value):
+    if field in self._numbers:
+      target = _parseNumber(value)
+      if target is None:
+        raise search.QueryError('bad value %s for field %s' % (value, field))
+      return self._numbers[field].select(op, target)
+    if op not in (':', '='):
+      raise search.QueryError('cannot compare field %s with %s' % (field, op))
+    return (self._atoms.get((field, value.lower()), set()) |
+            self._matchText(value, field))
+
+  def _matchDistance(self, field, lat, lon, op, value):
+    return set(doc_id for doc_id, point in self._geo[field].iteritems()
+               if _compare(_distance(point, lat, lon), op, value))
+
+  def _parse(self, query_string):
+    """Parse the query string into a list of (kind, args) clauses."""
+    clauses = []
+    pos = 0
+    query_string = query_string.strip()
+    while pos < len(query_string):
+      match = _QUERY_RE.match(query_string, pos)
+      if not match or match.end() == pos:
+        raise search.QueryError('Failed to parse query "%s"' % query_string)
+      pos = match.end()
+      groups = match.groupdict()
+      if groups['dfield']:
+        clauses.append(('distance', (
+            groups['dfield'], float(groups['lat']), float(groups['lon']),
+            groups['dop'], float(groups['dvalue']))))
+      elif groups['cfield']:
+        values = [_unescape(quoted) if quoted else value
+                  for quoted, value in _CHOICE_RE.findall(groups['choices'])
+                  if quoted or value != 'OR']
+        clauses.append(('choice', (groups['cfield'], values)))
+      elif groups['field']:
+        value = groups['fquoted']
+        if value is None:
+          value = groups['fvalue']
+        else:
+          value = _unescape(value)
+        clauses.append(('field', (groups['field'], groups['op'], value)))
+      elif groups['phrase'] is not None:
+        clauses.append(('text', (_unescape(groups['phrase']),)))
+      elif groups['term'] not in _NOISE_WORDS:
+        clauses.append(('text', (groups['term'],)))
+    return clauses
+
+  def _match(self, query_string):
+    """The ids of the docs matching all the clauses of the query, as a set
+    (or, for an empty query, the map of all the docs by id)."""
+    ids = None
+    for kind, args in self._parse(query_string):
+      if kind == 'distance':
+        matches = self._matchDistance(*args)
+      elif kind == 'field':
+        matches = self._matchField(*args)
+      elif kind == 'choice':
+        field, values = args
+        matches = set()
+        for value in values:
+          matches |= self._matchField(field, ':', value)
+      else:
+        matches = self._matchText(*args)
+      ids = matches if ids is None else ids & matches
+      if not ids:
+        return set()
+    # an empty query matches every doc; the doc map is used as the set of
+    # their ids, rather than copied (it is only read, under the lock).
+    return ids if ids is not None else self._docs
+
+  def _score(self, doc_id, query_string):
+    """A simple term-frequency score, for sorting on relevance."""
+    return sum(self._text.get(token, {}).get(doc_id, 0)
+               for token in _tokenize(query_string))
+
+  def _sortKey(self, sort_options, query_string):
+    """Build the key function for ordering the matching docs."""
+    expressions = (sort_options and sort_options.expressions) or []
+    if not expressions:
+      if sort_options and sort_options.match_scorer:
+        return lambda doc_id: -self._score(doc_id, query_string)
+      # by default, documents are returned by descending rank.
+      return lambda doc_id: -self._docs[doc_id].rank
+
+    distances = {}
+    for expr in expressions:
+      match = _DISTANCE_EXPR_RE.match(expr.expression)
+      if match:
+        distances[expr.expression] = (
+            self._geo[match.group(1)], float(match.group(2)),
+            float(match.group(3)))
+
+    def key(doc_id):
+      values = self._sort_values[doc_id]
+      parts = []
+      for expr in expressions:
+        if expr.expression in distances:
+          points, lat, lon = distances[expr.expression]
+          point = points.get(doc_id)
+          value = point and _distance(point, lat, lon)
+        else:
+          value = values.get(expr.expression)
+        if value is None:
+          value = _numericValue(expr.default_value)
+        if isinstance(value, basestring):
+          value = value.lower()
+        if expr.direction == search.SortExpression.DESCENDING:
+          if isinstance(value, (int, long, float)):
+            value = -value
+          else:
+            value = _Reversed(value)
+        parts.append(value)
+      parts.append(doc_id)
+      return tuple(parts)
+    return key
+
+  def _facets(self, ids, facet_requests, facet_options, sort_key):
+    """Compute the facet results for the given requests over the matching
+    docs.  As with the search service, only the first facet_options.depth
+    docs, in the order of the results (given by sort_key), are counted."""
+    if not facet_requests:
+      return []
+    depth = facet_options and facet_options.depth
+    if depth and depth < len(ids):
+      ids = heapq.nsmallest(depth, ids, key=sort_key)
+    facet_results = []
+    for request in facet_requests:
+      if isinstance(request, basestring):
+        request = search.FacetRequest(request)
+      values = [facet.value for doc_id in ids
+                for facet in self._docs[doc_id].facets
+                if facet.name == request.name]
+      result_values = []
+      if request.ranges:
+        for frange in request.ranges:
+          count = len([v for v in values
+                       if (frange.start is None or v >= frange.start) and
+                       (frange.end is None or v < frange.end)])
+          if count:
+            refinement = search.FacetRefinement(
+                name=request.name, facet_range=frange)
+            label = '[%s,%s)' % (
+                '-inf' if frange.start is None else frange.start,
+                'inf' if frange.end is None else frange.end)
+            result_values.append(
+                search.FacetResultValue(label, count, refinement))
+      else:
+        counts = collections.Counter(unicode(v) for v in values)
+        for label, count in counts.most_common(
+            request.value_limit or _DEFAULT_VALUE_LIMIT):
+          refinement = search.FacetRefinement(name=request.name, value=label)
+          result_values.append(
+              search.FacetResultValue(label, count, refinement))
+      if result_values:
+        facet_results.append(
+            search.FacetResult(name=request.name, values=result_values))
+    return facet_results
+
+  @staticmethod
+  def _encodeCursor(offset):
+    return base64.urlsafe_b64encode('local:%d' % offset)
+
+  @staticmethod
+  def _decodeCursor(web_safe_string):
+    try:
+      return int(base64.urlsafe_b64decode(str(web_safe_string)).split(':')[1])
+    except (TypeError, ValueError, IndexError):
+      raise search.InvalidRequest('invalid cursor')
+
+  def search(self, query, **kwargs):
+    """Search the index, returning a search.SearchResults."""
+    if isinstance(query, basestring):
+      query = search.Query(query_string=query)
+    options = query.options or search.QueryOptions()
+    with self._lock:
+      ids = self._match(query.query_string)
+      limit = options.limit or _DEFAULT_LIMIT
+      cursor = options.cursor
+      if cursor is not None and cursor.web_safe_string:
+        start = self._decodeCursor(cursor.web_safe_string)
+      else:
+        start = options.offset or 0
+      sort_key = self._sortKey(options.sort_options, query.query_string)
+      ordered = heapq.nsmallest(start + limit, ids, key=sort_key)
+      page = ordered[start:start + limit]
+      results = []
+      for doc_id in page:
+        doc = self._docs[doc_id]
+        if options.ids_only:
+          fields = None
+        elif options.returned_fields:
+          fields = [f for f in doc.fields if f.name in options.returned_fields]
+        else:
+          fields = list(doc.fields)
+        results.append(search.ScoredDocument(
+            doc_id=doc_id, fields=fields, language=doc.language,
+            rank=doc.rank))
+      facets = self._facets(ids, query.return_facets, query.facet_options,
+                            sort_key)
+    next_cursor = None
+    if cursor is not None and start + len(page) < len(ids):
+      next_cursor = search.Cursor(
+          web_safe_string=self._encodeCursor(start + len(page)))
+    return search.SearchResults(
+        number_found=len(ids), results=results, cursor=next_cursor,
+        facets=facets)
+
+  def search_async(self, query, **kwargs):
+    return _Future(self.search, query)
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def getIndex(name):
+  """Get the local index with the given name, creating it if necessary."""
+  with _INDEXES_LOCK:
+    index = _INDEXES.get(name)
+    if index is None:
+      index = _INDEXES[name] = LocalIndex(name)
+    return index
+
+
+def clearAll():
+  """Discard all the local indexes (e.g. between tests)."""
+  with _INDEXES_LOCK:
+    _INDEXES.clear()
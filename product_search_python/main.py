@@ -14,20 +14,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Defines the routing for the app's non-admin handlers.
+"""Defines the routing for the app's non-admin handlers.  The handlers are
+named by string, so that handlers.py, and the modules it imports, are only
+loaded when the first request is routed to one of them, rather than when the
+app is.
 """
 
 
-from handlers import *
 import webapp2
 
 application = webapp2.WSGIApplication(
-    [('/', IndexHandler),
-     ('/psearch', ProductSearchHandler),
-     ('/product', ShowProductHandler),
-     ('/reviews', ShowReviewsHandler),
-     ('/create_review', CreateReviewHandler),
-     ('/get_store_locations', StoreLocationHandler)
+    [('/', 'handlers.IndexHandler'),
+     ('/psearch', 'handlers.ProductSearchHandler'),
+     ('/product', 'handlers.ShowProductHandler'),
+     ('/reviews', 'handlers.ShowReviewsHandler'),
+     ('/create_review', 'handlers.CreateReviewHandler'),
+     ('/get_store_locations', 'handlers.StoreLocationHandler'),
+     ('/login', 'handlers.LoginHandler'),
+     ('/logout', 'handlers.LogoutHandler'),
+     ('/_ah/warmup', 'handlers.WarmupHandler')
     ],
     debug=True)
 
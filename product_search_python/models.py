@@ -19,28 +19,43 @@ and Review.
 Each Product entity will have a corresponding indexed "product" search.Document.
 Product entities contain a subset of the fields in their corresponding document.
 Product Review entities are not indexed (do not have corresponding Documents).
+In 'sharded' ratings aggregation mode, review ratings are counted in
+ProductRatingShard entities, and rolled up into their products.
 Reviews include a product id field, pointing to their 'parent' product, but
 are not part of the same entity group, thus avoiding contention in
 scenarios where a large number of product reviews might be edited/added at once.
 """
 
+import hashlib
 import logging
+import random
+import time
 
 import categories
-import docs
+import config
+import profiling
 
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 
 
 class Category(ndb.Model):
   """The model class for product category information.  Supports building a
-  category tree."""
+  category tree.
 
-  _CATEGORY_INFO = None
-  _CATEGORY_DICT = None
-  _RCATEGORY_DICT = None
-  _ROOT = 'root'  # the 'root' category of the category tree
+  The category information is cached in memcache, under a version key that is
+  bumped whenever categories are built, and in-process on each instance, which
+  checks the version at most every config.CATEGORY_VERSION_CHECK_SECONDS.  So
+  new categories propagate to all instances."""
+
+  _CATEGORY_CACHE = None
+  _CATEGORY_VERSION = None
+  _VERSION_CHECKED = 0
+  _VERSION_KEY = 'category_version'
+  _DATA_KEY = 'category_data:%s'
+  ROOT = 'root'  # the 'root' category of the category tree
 
   parent_category = ndb.KeyProperty()
 
@@ -58,6 +73,7 @@ class Category(ndb.Model):
       return
     root_category = categories.ctree
     cls.buildCategory(root_category, None)
+    cls.invalidateCache()
 
   @classmethod
   def buildCategory(cls, category_data, parent_key):
@@ -86,17 +102,109 @@ class Category(ndb.Model):
     for cat in children:
       cls.buildCategory(cat, parent_key)
 
+  @classmethod
+  def invalidateCache(cls):
+    """Bump the category version, so that all instances reload the category
+    information."""
+    memcache.incr(cls._VERSION_KEY, initial_value=int(time.time()))
+    cls._VERSION_CHECKED = 0
+
+  @classmethod
+  def _getVersion(cls):
+    version = memcache.get(cls._VERSION_KEY)
+    if version is None:
+      memcache.add(cls._VERSION_KEY, int(time.time()))
+      version = memcache.get(cls._VERSION_KEY)
+    return version
+
+  @classmethod
+  def _loadCategoryData(cls):
+    """Build the category information from the datastore: the id/name
+    correspondences for the select menus, and the category tree, materialized
+    as each category's children and its path from the root."""
+    cls.buildAllCategories()  #first build categories from data file
+        # if required
+    cats = cls.query().fetch()
+    parents = dict((c.key.id(),
+                    c.parent_category and c.parent_category.id())
+                   for c in cats)
+    children = dict((name, []) for name in parents)
+    for name, parent in parents.iteritems():
+      if parent in children:
+        children[parent].append(name)
+    paths = {}
+    for name in parents:
+      path = [name]
+      while parents.get(path[0]) and len(path) <= len(parents):
+        path.insert(0, parents[path[0]])
+      paths[name] = path
+    return {
+        'info': sorted((name, name) for name in parents if name != cls.ROOT),
+        'children': dict((name, sorted(names))
+                         for name, names in children.iteritems()),
+        'paths': paths}
+
+  @classmethod
+  @profiling.timed('category')
+  def _getCategoryData(cls):
+    """Get the cached category information, reloading it if the category
+    version has changed."""
+    now = time.time()
+    if (cls._CATEGORY_CACHE is not None and
+        now - cls._VERSION_CHECKED < config.CATEGORY_VERSION_CHECK_SECONDS):
+      return cls._CATEGORY_CACHE
+    version = cls._getVersion()
+    if cls._CATEGORY_CACHE is None or version != cls._CATEGORY_VERSION:
+      data = version is not None and memcache.get(cls._DATA_KEY % version)
+      if not data:
+        data = cls._loadCategoryData()
+        # building the categories may have bumped the version.
+        version = cls._getVersion()
+        if version is not None:
+          memcache.set(cls._DATA_KEY % version, data)
+      cls._CATEGORY_CACHE = data
+      cls._CATEGORY_VERSION = version
+    cls._VERSION_CHECKED = now
+    return cls._CATEGORY_CACHE
+
   @classmethod
   def getCategoryInfo(cls):
     """Build and cache a list of category id/name correspondences.  This info is
     used to populate html select menus."""
-    if not cls._CATEGORY_INFO:
-      cls.buildAllCategories()  #first build categories from data file
-          # if required
-      cats = cls.query().fetch()
-      cls._CATEGORY_INFO = [(c.key.id(), c.key.id()) for c in cats
-            if c.key.id() != cls._ROOT]
-    return cls._CATEGORY_INFO
+    return cls._getCategoryData()['info']
+
+  @classmethod
+  def getCategoryVersion(cls):
+    """Return the version of the cached category information (None if it
+    is not known, e.g. if memcache is unavailable)."""
+    cls._getCategoryData()
+    return cls._CATEGORY_VERSION
+
+  @classmethod
+  def getChildCategories(cls, category_name):
+    """Return the names of the child categories of the given category."""
+    return cls._getCategoryData()['children'].get(category_name, [])
+
+  @classmethod
+  def getCategoryPath(cls, category_name):
+    """Return the names of the categories from the root down to (and
+    including) the given category, or None if there is no such category."""
+    return cls._getCategoryData()['paths'].get(category_name)
+
+  @classmethod
+  def getDescendantCategories(cls, category_name):
+    """Return the names of the given category and of all the categories below
+    it in the tree."""
+    children = cls._getCategoryData()['children']
+    names = []
+    pending = [category_name]
+    while pending:
+      name = pending.pop()
+      if name in children:
+        names.append(name)
+        pending.extend(children[name])
+    return names
+
 
 class Product(ndb.Model):
   """Model for Product data. A Product entity will be built for each product,
@@ -115,6 +223,12 @@ class Product(ndb.Model):
   # indicates whether the associated document needs to be re-indexed due to a
   # change in the average review rating.
   needs_review_reindex = ndb.BooleanProperty(default=False)
+  # the content hash of the product data in the associated document (see
+  # docs.Product.contentHash), for checking that the two are in sync.
+  content_hash = ndb.StringProperty(indexed=False)
+
+  # the max number of entity groups in a cross-group transaction
+  _XG_BATCH_SIZE = 25
 
   @property
   def pid(self):
@@ -133,48 +247,94 @@ class Product(ndb.Model):
     """Given a list of product entity keys, check each entity to see if it is
     marked as needing a document re-index.  This flag is set when a new review
     is created for that product, and config.BATCH_RATINGS_UPDATE = True.
-    Generate the modified docs as needed and batch re-index them."""
-
+    Generate the modified docs as needed and batch re-index them.
+
+    The product entities and their docs are each fetched in bulk, and the docs
+    updated in memory and re-indexed in batches.  The flags are then cleared
+    in cross-group transactions of up to _XG_BATCH_SIZE products, and only for
+    products whose average rating has not changed again in the meantime.
+    Returns the number of docs re-indexed."""
+    # docs imports this module, so it is imported here, on first use, rather
+    # than at the top, which would make the two modules import each other.
+    import docs
+
+    prods = [prod for prod in ndb.get_multi(pkeys)
+             if prod and prod.needs_review_reindex]
+    if not prods:
+      return 0
+    docmap = docs.Product.getDocs([prod.doc_id for prod in prods])
     doclist = []
-
-    def _tx(pid):
-      prod = cls.get_by_id(pid)
-      if prod and prod.needs_review_reindex:
-
+    indexed_ratings = {}
+    for prod in prods:
+      doc = docmap.get(prod.doc_id)
+      if doc:
         # update the associated document with the new ratings info
-        # and reindex
-        modified_doc = docs.Product.updateRatingInDoc(
-            prod.doc_id, prod.avg_rating)
-        if modified_doc:
-          doclist.append(modified_doc)
-        prod.needs_review_reindex = False
-        prod.put()
-    for pkey in pkeys:
-      ndb.transaction(lambda: _tx(pkey.id()))
+        docs.Product(doc).setAvgRating(prod.avg_rating)
+        doclist.append(doc)
+      else:
+        logging.error('Could not retrieve doc associated with id %s',
+                      prod.doc_id)
+      # products without a doc have nothing to re-index; clear their flags too.
+      indexed_ratings[prod.key] = prod.avg_rating
     # reindex all modified docs in batch
-    docs.Product.add(doclist)
+    if doclist and docs.Product.add(doclist) is None:
+      logging.error('Re-indexing of docs with new ratings failed.')
+      return 0
+
+    def _tx(keys):
+      updated = []
+      for prod in ndb.get_multi(keys):
+        if (prod and prod.needs_review_reindex
+            and prod.avg_rating == indexed_ratings[prod.key]):
+          prod.needs_review_reindex = False
+          updated.append(prod)
+      ndb.put_multi(updated)
+    keys = indexed_ratings.keys()
+    for i in range(0, len(keys), cls._XG_BATCH_SIZE):
+      batch = keys[i:i + cls._XG_BATCH_SIZE]
+      ndb.transaction(lambda: _tx(batch), xg=True)
+    return len(doclist)
 
   @classmethod
-  def create(cls, params, doc_id):
+  def reindexFlaggedProducts(cls, cursor=None):
+    """Re-index the docs of products flagged as needing a ratings update, a
+    batch of config.RATINGS_REINDEX_BATCH_SIZE products at a time.  Each batch
+    after the first is processed in a follow-up task, continuing from the
+    (urlsafe) query cursor at which the previous one stopped, so that a large
+    backlog can be spread over several tasks."""
+    query = cls.query(cls.needs_review_reindex == True)
+    pkeys, next_cursor, more = query.fetch_page(
+        config.RATINGS_REINDEX_BATCH_SIZE, keys_only=True,
+        start_cursor=cursor and ndb.Cursor(urlsafe=cursor))
+    count = cls.updateProdDocsWithNewRating(pkeys)
+    logging.info('re-indexed %s docs with new ratings info.', count)
+    if more and next_cursor:
+      defer(cls.reindexFlaggedProducts, next_cursor.urlsafe())
+
+  @classmethod
+  def create(cls, params, doc_id, content_hash=None):
     """Create a new product entity from a subset of the given params dict
-    values, and the given doc_id."""
+    values, and the given doc_id and content hash."""
     prod = cls(
         id=params['pid'], price=params['price'],
-        category=params['category'], doc_id=doc_id)
+        category=params['category'], doc_id=doc_id,
+        content_hash=content_hash)
     prod.put()
     return prod
 
-  def update_core(self, params, doc_id):
-    """Update 'core' values from the given params dict and doc_id."""
+  def update_core(self, params, doc_id, content_hash=None):
+    """Update 'core' values from the given params dict, doc_id and content
+    hash."""
     self.populate(
         price=params['price'], category=params['category'],
-        doc_id=doc_id)
+        doc_id=doc_id, content_hash=content_hash)
 
   @classmethod
   def updateProdDocWithNewRating(cls, pid):
     """Given the id of a product entity, see if it is marked as needing
     a document re-index.  This flag is set when a new review is created for
     that product.  If it needs a re-index, call the document method."""
+    import docs  # see updateProdDocsWithNewRating
 
     def _tx():
       prod = cls.get_by_id(pid)
@@ -187,6 +347,36 @@ class Product(ndb.Model):
     # and reindex
     docs.Product.updateRatingsInfo(doc_id, avg_rating)
 
+  @classmethod
+  def rollupRatings(cls, pid):
+    """Recompute the average rating and number of reviews of the product
+    from its ratings counter shards (see ProductRatingShard).  If they have
+    changed, flag the product's doc as needing a re-index, and (unless in
+    batch mode) re-index it in a transactional task."""
+    shards = [shard for shard in
+              ndb.get_multi(ProductRatingShard.shardKeys(pid)) if shard]
+    count = sum(shard.rating_count for shard in shards)
+    if not count:
+      return
+    total = sum(shard.rating_sum for shard in shards)
+    seq = ProductChange.allocateSeqs(1)[0]
+
+    def _tx():
+      prod = cls.get_by_id(pid)
+      # the shard counts only increase, so a rollup that read fewer ratings
+      # than the product already has (e.g. a retried task, overlapping a later
+      # one) is stale, and must not roll the product back.
+      if not prod or count <= prod.num_reviews:
+        return
+      prod.avg_rating = total / float(count)
+      prod.num_reviews = count
+      prod.needs_review_reindex = True
+      change = ProductChange.build(seq, prod.key, ProductChange.RATING, prod)
+      ndb.put_multi([prod, change])
+      if not config.BATCH_RATINGS_UPDATE:
+        defer(cls.updateProdDocWithNewRating, pid, _transactional=True)
+    ndb.transaction(_tx)
+
 
 class Review(ndb.Model):
   """Model for Review data. Associated with a product entity via the product
@@ -208,4 +398,207 @@ class Review(ndb.Model):
       return
     reviews = cls.query(
         cls.product_key == ndb.Key(Product, pid)).fetch(keys_only=True)
-    return ndb.delete_multi(reviews)
+    return ndb.delete_multi(reviews + ProductRatingShard.shardKeys(pid))
+
+
+class ProductRatingShard(ndb.Model):
+  """A shard of the ratings counter of a product, used when
+  config.RATINGS_AGGREGATION is 'sharded'.  Each review's rating is added to a
+  random shard, and each shard is a root entity, so that the reviews of a
+  product are not all written to the same entity group.  The product's
+  average rating is rolled up from the shards by Product.rollupRatings."""
+
+  rating_sum = ndb.IntegerProperty(default=0, indexed=False)
+  rating_count = ndb.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def shardKeys(cls, pid):
+    """The keys of all the counter shards of the product."""
+    return [ndb.Key(cls, '%s:%s' % (pid, i))
+            for i in range(config.RATING_SHARDS)]
+
+  @classmethod
+  def addRating(cls, review_key):
+    """Add the rating of the given review to a random shard of its product's
+    counter, and mark the review's rating as added, in an XG transaction.
+    Then schedule a rollup of the product's average rating."""
+
+    def _tx():
+      review = review_key.get()
+      if review.rating_added:
+        return None
+      pid = review.product_key.id()
+      shard_key = ndb.Key(
+          cls, '%s:%s' % (pid, random.randrange(config.RATING_SHARDS)))
+      shard = shard_key.get() or cls(key=shard_key)
+      shard.rating_sum += review.rating
+      shard.rating_count += 1
+      review.rating_added = True
+      ndb.put_multi([shard, review])
+      return pid
+    pid = ndb.transaction(_tx, xg=True)
+    if pid:
+      cls.scheduleRollup(pid)
+
+  @classmethod
+  def scheduleRollup(cls, pid):
+    """Schedule a rollup of the product's ratings at the end of the current
+    window of config.RATINGS_ROLLUP_DELAY seconds.  The task is named for the
+    product and the window, so that all the ratings added to the product in a
+    window share a single rollup (and re-index)."""
+    window = int(time.time() / config.RATINGS_ROLLUP_DELAY)
+    name = 'ratings-rollup-%s-%s' % (
+        hashlib.md5(pid.encode('utf-8')).hexdigest(), window)
+    try:
+      defer(Product.rollupRatings, pid, _name=name,
+            _countdown=config.RATINGS_ROLLUP_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass  # the rollup for this window is already scheduled.
+
+
+class ProductChange(ndb.Model):
+  """An entry of the append-only log of product mutations, for consumers
+  that want to follow the changes to the products (e.g. incremental
+  re-indexers) rather than rescan them.  Each change is a child of its
+  product's entity, so that it can be written in the same transaction as the
+  product without adding an entity group, and has a sequence number allocated
+  from a single id range, so that changes can be read in order (see since).
+  Sequence numbers are allocated before the changes are committed, so a
+  consumer should re-read a short window before the last sequence number it
+  has seen, to pick up any changes committed out of order.
+
+  The changes of a product outlive it: its DELETE change is what records its
+  deletion, so the log is not cleared along with the product (neither by the
+  delete handler nor by reinit.py).  The bulk deletions of reinit.py and
+  reconcile.py write their changes outside of any transaction, before
+  deleting, so a retried batch may record a deletion more than once."""
+
+  CREATE = 'create'
+  UPDATE = 'update'
+  DELETE = 'delete'
+  RATING = 'rating'
+
+  seq = ndb.IntegerProperty()
+  op = ndb.StringProperty()
+  content_hash = ndb.StringProperty(indexed=False)
+  avg_rating = ndb.FloatProperty(indexed=False)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @property
+  def pid(self):
+    return self.key.parent().id()
+
+  @classmethod
+  def allocateSeqs(cls, num):
+    """Allocate num consecutive sequence numbers.  Done outside of the
+    transactions recording the changes, so that retried transactions reuse
+    them."""
+    first, last = cls.allocate_ids(size=num)
+    return range(first, last + 1)
+
+  @classmethod
+  def build(cls, seq, product_key, op, prod=None):
+    """Build (but don't put) the change entity recording the given operation
+    on the product, with the product's state after it, if any."""
+    return cls(
+        parent=product_key, id=seq, seq=seq, op=op,
+        content_hash=prod and prod.content_hash,
+        avg_rating=prod and prod.avg_rating)
+
+  @classmethod
+  def buildMulti(cls, prods, op):
+    """Build the change entities recording the given operation on each of
+    the given products."""
+    seqs = cls.allocateSeqs(len(prods)) if prods else []
+    return [cls.build(seq, prod.key, op, prod)
+            for seq, prod in zip(seqs, prods)]
+
+  @classmethod
+  def buildDeletes(cls, product_keys):
+    """Build the change entities recording the deletion of each of the
+    products with the given keys."""
+    seqs = cls.allocateSeqs(len(product_keys)) if product_keys else []
+    return [cls.build(seq, key, cls.DELETE)
+            for seq, key in zip(seqs, product_keys)]
+
+  @classmethod
+  def since(cls, seq, limit=100):
+    """Return up to limit changes with sequence numbers after seq, in
+    order."""
+    return cls.query(cls.seq > seq).order(cls.seq).fetch(limit)
+
+
+class ReinitJob(ndb.Model):
+  """The status of a reinitialization of the app data (see reinit.py).  The
+  job runs in two phases, 'deleting' and 'loading', each made up of shards that
+  run in parallel; pending_shards counts the shards of the current phase that
+  have not yet finished."""
+
+  sample_data = ndb.BooleanProperty(default=True)
+  phase = ndb.StringProperty()
+  pending_shards = ndb.IntegerProperty(default=0)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  def shards(self):
+    """Retrieve the shards of this job."""
+    return ReinitShard.query(ReinitShard.job_key == self.key).fetch()
+
+
+class ReinitShard(ndb.Model):
+  """A shard of a reinitialization job, with its progress checkpoint.  Each
+  shard is a root entity, so that shards can checkpoint in parallel."""
+
+  job_key = ndb.KeyProperty(kind=ReinitJob)
+  phase = ndb.StringProperty()
+  # what the shard processes: a datastore kind, an index, or a data file.
+  target = ndb.StringProperty()
+  # the (urlsafe) key range of a datastore shard, or the doc id range of an
+  # index shard; None for an open end.
+  start_key = ndb.StringProperty(indexed=False)
+  end_key = ndb.StringProperty(indexed=False)
+  # the checkpoint: a query cursor, the last doc id deleted, or a count of data
+  # file rows processed.
+  cursor = ndb.StringProperty(indexed=False)
+  processed = ndb.IntegerProperty(default=0)
+  done = ndb.BooleanProperty(default=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ReconcileJob(ndb.Model):
+  """A check of the consistency of the product entities and the product
+  index (see reconcile.py).  The job is made up of shards, over ranges of the
+  product id space, that run in parallel.  If repair is False, the
+  inconsistencies found are only counted."""
+
+  repair = ndb.BooleanProperty(default=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  def shards(self):
+    """Retrieve the shards of this job."""
+    return ReconcileShard.query(ReconcileShard.job_key == self.key).fetch()
+
+
+class ReconcileShard(ndb.Model):
+  """A shard of a consistency check job, with its progress checkpoint and
+  counts.  Each shard is a root entity, so that shards can checkpoint in
+  parallel."""
+
+  job_key = ndb.KeyProperty(kind=ReconcileJob)
+  # the range of product ids [start_id, end_id) checked; None for an open end.
+  start_id = ndb.StringProperty(indexed=False)
+  end_id = ndb.StringProperty(indexed=False)
+  # the checkpoint: the last product id checked.
+  last_id = ndb.StringProperty(indexed=False)
+  checked = ndb.IntegerProperty(default=0)
+  # docs without a product entity
+  orphaned = ndb.IntegerProperty(default=0)
+  # product entities without a doc
+  missing = ndb.IntegerProperty(default=0)
+  # a sample of the ids of the products without a doc
+  missing_ids = ndb.StringProperty(repeated=True, indexed=False)
+  # docs whose product data or rating differ from their product entity's
+  stale = ndb.IntegerProperty(default=0)
+  repaired = ndb.IntegerProperty(default=0)
+  done = ndb.BooleanProperty(default=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
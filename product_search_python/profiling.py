@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the per-request instrumentation.  While a request is being
+profiled (see base_handler.BaseHandler.dispatch), named spans of code are
+timed, and the RPCs made are counted by service and method.  At the end of the
+request, a summary is logged, and the span timings are returned in a
+Server-Timing response header.
+
+Profiling is enabled by config.REQUEST_PROFILING.  When no request is being
+profiled, span() returns a shared no-op context manager, so instrumented code
+pays only for a thread-local lookup.
+"""
+
+import collections
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+_local = threading.local()
+# the apiproxy that the RPC counting hook was installed on.
+_hooked_apiproxy = None
+_HOOK_NAME = 'request_profiling'
+
+
+class RequestProfile(object):
+  """The span timings and RPC counts of one request."""
+
+  def __init__(self, path):
+    self.path = path
+    self.start = time.time()
+    self.elapsed = None
+    self.spans = collections.OrderedDict()
+    self.rpcs = collections.Counter()
+
+  def record(self, name, seconds):
+    entry = self.spans.get(name)
+    if entry is None:
+      entry = self.spans[name] = [0, 0.0]
+    entry[0] += 1
+    entry[1] += seconds
+
+  def summary(self):
+    """Return a dict summarizing the request, for logging."""
+    return {
+        'path': self.path,
+        'total_ms': round(1000 * self.elapsed, 1),
+        'spans': dict((name, {'count': count, 'ms': round(1000 * seconds, 1)})
+                      for name, (count, seconds) in self.spans.iteritems()),
+        'rpcs': dict(self.rpcs),
+        'rpc_count': sum(self.rpcs.itervalues())}
+
+  def serverTiming(self):
+    """Return the value of the Server-Timing header for the request."""
+    metrics = ['%s;dur=%.1f' % (name, 1000 * seconds)
+               for name, (_, seconds) in self.spans.iteritems()]
+    metrics.append('total;dur=%.1f' % (1000 * self.elapsed))
+    return ', '.join(metrics)
+
+
+class _Span(object):
+
+  __slots__ = ['profile', 'name', 'start']
+
+  def __init__(self, profile, name):
+    self.profile = profile
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.profile.record(self.name, time.time() - self.start)
+    return False
+
+
+class _NullSpan(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _countRpc(service, call, request, response):
+  profile = getattr(_local, 'profile', None)
+  if profile is not None:
+    profile.rpcs['%s.%s' % (service, call)] += 1
+
+
+def current():
+  """Return the profile of the request being handled by this thread, or
+  None."""
+  return getattr(_local, 'profile', None)
+
+
+def start(path):
+  """Start profiling a request on this thread."""
+  global _hooked_apiproxy
+  # the apiproxy may be replaced, e.g. by the testbed.
+  if apiproxy_stub_map.apiproxy is not _hooked_apiproxy:
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(_HOOK_NAME, _countRpc)
+    _hooked_apiproxy = apiproxy_stub_map.apiproxy
+  profile = _local.profile = RequestProfile(path)
+  return profile
+
+
+def finish():
+  """Stop profiling the request on this thread, and log its summary.  Returns
+  the profile."""
+  profile = getattr(_local, 'profile', None)
+  _local.profile = None
+  if profile is not None:
+    profile.elapsed = time.time() - profile.start
+    logging.info('request profile: %s',
+                 json.dumps(profile.summary(), sort_keys=True))
+  return profile
+
+
+def span(name):
+  """Return a context manager that times the code it wraps as the named span
+  of the current request's profile."""
+  profile = getattr(_local, 'profile', None)
+  if profile is None:
+    return _NULL_SPAN
+  return _Span(profile, name)
+
+
+def timed(name):
+  """A decorator that times each call of the function as the named span."""
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+class _TimedFuture(object):
+  """Wraps the future of an async index call, recording the span from the call
+  to the return of its result."""
+
+  def __init__(self, future, span_):
+    self._future = future
+    self._span = span_
+
+  def get_result(self):
+    try:
+      return self._future.get_result()
+    finally:
+      if self._span:
+        self._span.__exit__()
+        self._span = None
+
+
+class ProfiledIndex(object):
+  """Wraps a search index, timing its calls as 'index.<method>' spans."""
+
+  _METHODS = frozenset(['search', 'put', 'delete', 'get', 'get_range'])
+
+  def __init__(self, index):
+    self._index = index
+
+  def __getattr__(self, name):
+    attr = getattr(self._index, name)
+    if name in self._METHODS:
+      return timed('index.' + name)(attr)
+    if name.endswith('_async') and name[:-len('_async')] in self._METHODS:
+      @functools.wraps(attr)
+      def call_async(*args, **kwargs):
+        span_ = span('index.' + name[:-len('_async')]).__enter__()
+        return _TimedFuture(attr(*args, **kwargs), span_)
+      return call_async
+    return attr
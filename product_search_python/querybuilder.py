@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the builder of product search queries.  The parts of the query
+options that depend only on the sort option -- the sort expressions, the
+returned fields and expressions, and the facet requests -- are compiled once,
+at import, into an immutable template per sort option (see
+docs.Product._SORT_OPTIONS), which is then reused for every search.  The
+category and rating filters are composed with the user's query as structured
+restrictions, with their values escaped.  Each ProductQuery also has a
+canonical key, used to cache its results and to log it.
+"""
+
+import urllib
+
+import config
+import docs
+
+from google.appengine.api import search
+
+
+RELEVANCE = 'relevance'
+
+
+def quote(value):
+  """Quote a value for use in a field restriction, escaping any quotes and
+  backslashes it contains."""
+  return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def parseRating(value):
+  """Return the given rating param as an int, or None if it is not a rating in
+  the allowed range."""
+  try:
+    rating = int(value)
+  except (TypeError, ValueError):
+    return None
+  if rating < config.RATING_MIN or rating > config.RATING_MAX:
+    return None
+  return rating
+
+
+def categoryFilter(category, subcategories=None):
+  """The restriction to products of the given category, or of any of the given
+  categories below it in the category tree.  Because the category field is
+  atomic, the whole category string is matched."""
+  names = [category] + sorted(set(subcategories or []) - set([category]))
+  if len(names) == 1:
+    return '%s:%s' % (docs.Product.CATEGORY, quote(category))
+  return '%s:(%s)' % (docs.Product.CATEGORY,
+                      ' OR '.join(quote(name) for name in names))
+
+
+def ratingFilter(rating):
+  """The restriction to products with an average rating in the bucket of the
+  given rating, i.e. in [rating, rating + 1), or of the max rating."""
+  if rating < config.RATING_MAX:
+    return '%s >= %s %s < %s' % (docs.Product.AVG_RATING, rating,
+                                 docs.Product.AVG_RATING, rating + 1)
+  return '%s:%s' % (docs.Product.AVG_RATING, rating)
+
+
+class QueryTemplate(object):
+  """The precompiled, immutable parts of the query options for one sort
+  option."""
+
+  # computed and returned fields examples.  Their use is not required
+  # for the application to function correctly.
+  RETURNED_EXPRESSIONS = (
+      search.FieldExpression(name='adjusted_price', expression='price * 1.08'),)
+  RETURNED_FIELDS = (
+      docs.Product.PID, docs.Product.DESCRIPTION, docs.Product.CATEGORY,
+      docs.Product.AVG_RATING, docs.Product.PRICE, docs.Product.PRODUCT_NAME)
+  SNIPPETED_FIELDS = (docs.Product.DESCRIPTION,)
+
+  def __init__(self, sort, sort_options):
+    self.sort = sort
+    self.sort_options = sort_options
+
+  def buildQuery(self, query_string, limit, offset, cursor=None):
+    """Build a search query from the template.  If a cursor is given, the page
+    of results is fetched from it rather than from the offset."""
+    return search.Query(
+        query_string=query_string,
+        options=search.QueryOptions(
+            limit=limit,
+            offset=None if cursor else offset,
+            cursor=cursor,
+            sort_options=self.sort_options,
+            snippeted_fields=list(self.SNIPPETED_FIELDS),
+            returned_expressions=list(self.RETURNED_EXPRESSIONS),
+            returned_fields=list(self.RETURNED_FIELDS)),
+        return_facets=docs.Product.getFacetRequests(),
+        facet_options=docs.Product.getFacetOptions())
+
+
+def _compileTemplates():
+  """Compile the query template of each sort option.  If sorting on
+  'relevance', the match scorer is used.  Otherwise, the selected field is the
+  first dimension of the sort, and the average rating the second -- unless
+  sorting on rating, in which case price is the second dimension."""
+  expressions = dict((name, expr)
+                     for name, _, expr in docs.Product._SORT_OPTIONS)
+  templates = {RELEVANCE: QueryTemplate(
+      RELEVANCE, search.SortOptions(match_scorer=search.MatchScorer()))}
+  for name, expr in expressions.iteritems():
+    if name == docs.Product.AVG_RATING:
+      second = expressions[docs.Product.PRICE]
+    else:
+      second = expressions[docs.Product.AVG_RATING]
+    templates[name] = QueryTemplate(
+        name, search.SortOptions(expressions=[expr, second]))
+  return templates
+
+
+_TEMPLATES = _compileTemplates()
+
+
+def getTemplate(sort):
+  """Return the query template of the given sort option; unknown options sort
+  on relevance."""
+  return _TEMPLATES.get(sort) or _TEMPLATES[RELEVANCE]
+
+
+class ProductQuery(object):
+  """A product search: the user's query, with its optional category and
+  rating filters, sort option, and page.  The category filter also matches
+  the given subcategories (see models.Category.getDescendantCategories)."""
+
+  def __init__(self, user_query, category=None, rating=None, sort=None,
+               limit=config.DOC_LIMIT, offset=0, cursor=None,
+               subcategories=None):
+    self.user_query = user_query or ''
+    self.category = category or None
+    self.subcategories = subcategories
+    self.rating = rating
+    self.template = getTemplate(sort)
+    self.sort = self.template.sort
+    self.limit = limit
+    self.offset = offset
+    self.cursor = cursor
+
+  def queryString(self, with_rating=True):
+    """The query string: the user's query, restricted by the filters.  The
+    rating filter can be left out, e.g. to count the matches in each rating
+    bucket."""
+    parts = [' '.join(self.user_query.split())]
+    if self.category:
+      parts.append(categoryFilter(self.category, self.subcategories))
+    if with_rating and self.rating:
+      parts.append(ratingFilter(self.rating))
+    return ' '.join(part for part in parts if part)
+
+  def buildSearchQuery(self):
+    """Build the search query for the page of results."""
+    return self.template.buildQuery(
+        self.queryString(), self.limit, self.offset, self.cursor)
+
+  def key(self):
+    """The canonical key of the query: equal for all requests that give the
+    same results, and readable, for logging."""
+    cursor_string = self.cursor and self.cursor.web_safe_string
+    return urllib.urlencode([
+        ('q', self.queryString().encode('utf-8')),
+        ('sort', self.sort),
+        ('limit', self.limit),
+        # a page fetched from a cursor doesn't depend on its offset.
+        ('offset', '' if self.cursor else self.offset),
+        ('cursor', cursor_string or ('start' if self.cursor else ''))])
+
+  def __str__(self):
+    return self.key()
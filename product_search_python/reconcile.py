@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the job that checks that the product entities and the product
+index are consistent, and repairs them where they are not.  They can diverge
+when a write fails part way: e.g. a product's doc is indexed but its entity
+is not written, or its entity is deleted but not its doc, or the re-index of
+its doc with a new average rating fails.
+
+The product entities and the docs are both keyed on the product id, so the
+job reads the two in id order, a batch at a time, and merge-joins them,
+finding:
+  - orphaned docs, which have no product entity, and are deleted;
+  - missing docs, whose product entity has no doc.  These can't be rebuilt
+    from the entity, which holds only the 'core' product fields, so they are
+    counted, and a sample of their ids is kept, for the products to be
+    reloaded;
+  - stale docs, whose product data (see docs.Product.contentHash) differs
+    from their entity's, or whose average rating does.  The doc is written
+    before the entity, so in the first case the entity is updated from the
+    doc; the entity holds the ratings, so in the second the doc is re-indexed
+    with the entity's rating.
+Only a batch of entities, a batch of docs and a batch of repairs are held at
+a time, however large the catalog.
+
+The job is split into shards over ranges of the product id space, which run
+in parallel as chains of tasks, each checkpointing the last id it checked in
+its models.ReconcileShard entity, as in reinit.py.
+"""
+
+import logging
+import time
+
+import config
+import docs
+import models
+
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+# the max number of missing product ids recorded per shard.
+_MISSING_SAMPLE_SIZE = 20
+# ratings that differ by less than this are taken to be equal.
+_RATING_TOLERANCE = 1e-6
+
+
+def _productStream(start_id, include_start, end_id, batch_size):
+  """Yield the product entities with ids in the given range, in id order,
+  fetching each batch while the one before is being consumed."""
+  query = models.Product.query()
+  if start_id is not None:
+    start_key = ndb.Key(models.Product, start_id)
+    if include_start:
+      query = query.filter(models.Product.key >= start_key)
+    else:
+      query = query.filter(models.Product.key > start_key)
+  if end_id is not None:
+    query = query.filter(models.Product.key < ndb.Key(models.Product, end_id))
+  query = query.order(models.Product.key)
+  fetch = query.fetch_page_async(batch_size)
+  while True:
+    prods, cursor, more = fetch.get_result()
+    if more and cursor:
+      fetch = query.fetch_page_async(batch_size, start_cursor=cursor)
+    for prod in prods:
+      yield prod
+    if not more or not cursor:
+      return
+
+
+def _docStream(start_id, include_start, end_id, batch_size):
+  """Yield the product docs with ids in the given range, in id order,
+  fetching each batch while the one before is being consumed."""
+  index = docs.Product.getIndex()
+  fetch = index.get_range_async(
+      start_id=start_id, include_start_object=include_start,
+      limit=batch_size)
+  while True:
+    results = fetch.get_result().results
+    if len(results) == batch_size:
+      fetch = index.get_range_async(
+          start_id=results[-1].doc_id, include_start_object=False,
+          limit=batch_size)
+    for doc in results:
+      if end_id is not None and doc.doc_id >= end_id:
+        return
+      yield doc
+    if len(results) < batch_size:
+      return
+
+
+def mergeJoin(prods, product_docs):
+  """Merge-join the product entities and docs, both in id order.  Yields a
+  (pid, prod, doc) tuple for each id, where prod or doc is None if there is
+  no entity or doc with that id."""
+  prod = next(prods, None)
+  doc = next(product_docs, None)
+  while prod is not None or doc is not None:
+    pid = prod and prod.key.id()
+    if doc is None or (prod is not None and pid < doc.doc_id):
+      yield pid, prod, None
+      prod = next(prods, None)
+    elif prod is None or doc.doc_id < pid:
+      yield doc.doc_id, None, doc
+      doc = next(product_docs, None)
+    else:
+      yield pid, prod, doc
+      prod = next(prods, None)
+      doc = next(product_docs, None)
+
+
+def hasStaleContent(prod, doc):
+  """Whether the product data of the doc differs from the product entity's.
+  Entities written before content hashes were stored are stale."""
+  pdoc = docs.Product(doc)
+  return (prod.doc_id != doc.doc_id
+          or prod.content_hash != docs.Product.contentHash(doc)
+          or prod.price != pdoc.getPrice()
+          or prod.category != pdoc.getCategory())
+
+
+def hasStaleRating(prod, doc):
+  """Whether the average rating of the doc differs from the product entity's.
+  Products flagged for a ratings re-index are left to that re-index."""
+  if prod.needs_review_reindex:
+    return False
+  doc_rating = docs.Product(doc).getAvgRating() or 0
+  return abs(doc_rating - prod.avg_rating) > _RATING_TOLERANCE
+
+
+class _Repairs(object):
+  """The repairs found in a batch of products, pending until flushed."""
+
+  def __init__(self):
+    self.orphaned_ids = []
+    # the docs whose product entities are to be updated from them
+    self.content_docs = []
+    # the docs to re-index with their entity's rating
+    self.rating_docs = []
+
+  def __len__(self):
+    return (len(self.orphaned_ids) + len(self.content_docs)
+            + len(self.rating_docs))
+
+  def flush(self):
+    """Make the pending repairs.  Returns the number made."""
+    repaired = (self._deleteOrphans() + self._updateEntities()
+                + self._reindexRatings())
+    self.__init__()
+    return repaired
+
+  def _deleteOrphans(self):
+    """Delete the orphaned docs, other than those whose product entity has
+    been written since they were found, recording their deletion in the
+    change log."""
+    if not self.orphaned_ids:
+      return 0
+    prods = ndb.get_multi(
+        [ndb.Key(models.Product, pid) for pid in self.orphaned_ids])
+    doc_ids = [pid for pid, prod in zip(self.orphaned_ids, prods)
+               if prod is None]
+    if doc_ids:
+      ndb.put_multi(models.ProductChange.buildDeletes(
+          [ndb.Key(models.Product, pid) for pid in doc_ids]))
+      try:
+        docs.Product.getIndex().delete(doc_ids)
+      finally:
+        docs.Product.invalidateCache()
+    return len(doc_ids)
+
+  def _updateEntities(self):
+    """Update the core values of the product entities from their docs, in
+    XG transactions, recording the changes in the change log."""
+    if not self.content_docs:
+      return 0
+    seqs = models.ProductChange.allocateSeqs(len(self.content_docs))
+
+    def _tx(batch):
+      entities = []
+      updated = 0
+      keys = [ndb.Key(models.Product, doc.doc_id) for doc, _ in batch]
+      for prod, (doc, seq) in zip(ndb.get_multi(keys), batch):
+        if not prod:
+          continue
+        pdoc = docs.Product(doc)
+        prod.update_core(
+            {'price': pdoc.getPrice(), 'category': pdoc.getCategory()},
+            doc.doc_id, docs.Product.contentHash(doc))
+        entities.extend([prod, models.ProductChange.build(
+            seq, prod.key, models.ProductChange.UPDATE, prod)])
+        updated += 1
+      ndb.put_multi(entities)
+      return updated
+    updated = 0
+    pending = zip(self.content_docs, seqs)
+    batch_size = models.Product._XG_BATCH_SIZE
+    for i in range(0, len(pending), batch_size):
+      batch = pending[i:i + batch_size]
+      updated += ndb.transaction(lambda: _tx(batch), xg=True)
+    return updated
+
+  def _reindexRatings(self):
+    """Re-index the docs whose average rating was stale."""
+    if not self.rating_docs:
+      return 0
+    if docs.Product.add(self.rating_docs) is None:
+      return 0
+    return len(self.rating_docs)
+
+
+def _checkRange(shard, repair, deadline):
+  """Check the shard's range of product ids, from its checkpoint, until the
+  end of the range or the deadline.  The repairs found are made, and the
+  checkpoint saved, a batch at a time.  Returns True if the range was
+  finished."""
+  batch_size = config.RECONCILE_BATCH_SIZE
+  if shard.last_id is not None:
+    start_id, include_start = shard.last_id, False
+  else:
+    start_id, include_start = shard.start_id, True
+  joined = mergeJoin(
+      _productStream(start_id, include_start, shard.end_id, batch_size),
+      _docStream(start_id, include_start, shard.end_id, batch_size))
+  repairs = _Repairs()
+  checked = 0
+  for pid, prod, doc in joined:
+    if prod is None:
+      shard.orphaned += 1
+      repairs.orphaned_ids.append(pid)
+    elif doc is None:
+      shard.missing += 1
+      if len(shard.missing_ids) < _MISSING_SAMPLE_SIZE:
+        shard.missing_ids.append(pid)
+    else:
+      stale_content = hasStaleContent(prod, doc)
+      stale_rating = hasStaleRating(prod, doc)
+      if stale_content:
+        repairs.content_docs.append(doc)
+      if stale_rating:
+        docs.Product(doc).setAvgRating(prod.avg_rating)
+        repairs.rating_docs.append(doc)
+      if stale_content or stale_rating:
+        shard.stale += 1
+    checked += 1
+    if checked == batch_size or len(repairs) >= batch_size:
+      _checkpoint(shard, pid, checked, repair and repairs)
+      repairs = _Repairs()
+      checked = 0
+      if time.time() >= deadline:
+        return False
+  _checkpoint(shard, None, checked, repair and repairs)
+  return True
+
+
+def _checkpoint(shard, last_id, checked, repairs):
+  """Make the pending repairs, if any, then save the shard's progress up to
+  (and including) last_id."""
+  if repairs:
+    shard.repaired += repairs.flush()
+  shard.checked += checked
+  shard.last_id = last_id
+  shard.put()
+
+
+def startJob(repair=True):
+  """Start a consistency check job, over config.RECONCILE_SHARDS ranges of
+  the product id space.  Returns the models.ReconcileJob entity, whose status
+  can be polled (see getJobStatus)."""
+  job = models.ReconcileJob(repair=repair)
+  job.put()
+  shards = [models.ReconcileShard(job_key=job.key, start_id=start_id,
+                                  end_id=end_id)
+            for start_id, end_id in docs.Product.splitIdSpace(
+                config.RECONCILE_SHARDS)]
+  ndb.put_multi(shards)
+  logging.info('reconcile job %s: started, in %s shards.',
+               job.key.id(), len(shards))
+  for shard in shards:
+    defer(runShard, shard.key.id())
+  return job
+
+
+def runShard(shard_id):
+  """Run a shard until it is done or its time budget is spent; in the latter
+  case, defer a task to resume it from its checkpoint."""
+  shard = models.ReconcileShard.get_by_id(shard_id)
+  if not shard or shard.done:
+    return
+  job = shard.job_key.get()
+  deadline = time.time() + config.RECONCILE_TASK_SECONDS
+  if _checkRange(shard, job.repair, deadline):
+    shard.done = True
+    shard.put()
+    logging.info('reconcile shard %s done: %s checked, %s orphaned, '
+                 '%s missing, %s stale, %s repaired.', shard_id,
+                 shard.checked, shard.orphaned, shard.missing, shard.stale,
+                 shard.repaired)
+  else:
+    defer(runShard, shard_id)
+
+
+def getLatestJob():
+  """Return the most recently started consistency check job, or None."""
+  return models.ReconcileJob.query().order(
+      -models.ReconcileJob.created).get()
+
+
+def getJobStatus(job):
+  """Build a dict describing the progress and findings of the given job,
+  totalled over its shards."""
+  if not job:
+    return None
+  shards = job.shards()
+  status = {'job_id': job.key.id(),
+            'repair': job.repair,
+            'started': job.created.isoformat(),
+            'pending_shards': len([s for s in shards if not s.done]),
+            'missing_ids': sorted(
+                pid for shard in shards for pid in shard.missing_ids)}
+  for count in ('checked', 'orphaned', 'missing', 'stale', 'repaired'):
+    status[count] = sum(getattr(shard, count) for shard in shards)
+  return status
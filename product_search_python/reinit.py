@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the resumable job that reinitializes the app data: it deletes all
+the product and review entities and the product and store documents, then
+(optionally) loads in the sample data.
+
+The job runs in two phases, 'deleting' and 'loading'.  Each phase is split
+into shards -- key ranges of a datastore kind, id ranges of an index, or a
+sample data file -- which run in parallel, as chains of tasks.  Each task works until its time
+budget is spent, checkpointing its progress in its models.ReinitShard entity
+as it goes, and then defers a follow-up task that resumes from the checkpoint.
+When the last shard of a phase finishes, the next phase is started.
+"""
+
+import csv
+import itertools
+import logging
+import os
+import time
+
+import config
+import docs
+import geo
+import importer
+import models
+import stores
+
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+DELETING = 'deleting'
+LOADING = 'loading'
+DONE = 'done'
+
+# The sample data files, and their csv field names.  These are hardwired to the
+# format of the sample data files for the two example product types ('books'
+# and 'hd televisions')-- see categories.py
+SAMPLE_DATA_FILES = {
+    config.SAMPLE_DATA_BOOKS: [
+        'pid', 'name', 'category', 'price',
+        'publisher', 'title', 'pages', 'author',
+        'description', 'isbn'],
+    config.SAMPLE_DATA_TVS: [
+        'pid', 'name', 'category', 'price',
+        'size', 'brand', 'tv_type',
+        'description']}
+
+_KINDS = dict((model_class._get_kind(), model_class)
+              for model_class in (models.Review, models.Product,
+                                  models.ProductRatingShard))
+_INDEXES = dict((manager._INDEX_NAME, manager)
+                for manager in (docs.Product, docs.Store))
+_STORES = 'stores'
+
+# the number of entities deleted per batch
+_DELETE_BATCH_SIZE = 500
+# the number of scatter keys sampled per shard, to split a kind's key range.
+_OVERSAMPLING = 32
+
+
+def loadStoreLocationData():
+  """Create documents from the store location info in stores.py, in batches.
+  Currently logs but otherwise swallows search errors."""
+  geo.loadStores(stores.stores)
+
+
+def splitKeyRange(model_class, num_shards):
+  """Split the key range of the given kind into (up to) num_shards ranges of
+  roughly equal size, using the __scatter__ property that the datastore sets
+  on a random sample of entities.  Returns a list of (start, end) key pairs,
+  where None marks an open end."""
+  if num_shards > 1:
+    keys = model_class.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+            num_shards * _OVERSAMPLING, keys_only=True)
+    keys.sort()
+  else:
+    keys = []
+  if not keys:
+    return [(None, None)]
+  step = len(keys) / float(num_shards)
+  splits = sorted(set(keys[int(step * i)] for i in range(1, num_shards)))
+  bounds = [None] + splits + [None]
+  return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def startJob(sample_data=True):
+  """Start a reinitialization job.  Returns the models.ReinitJob entity, whose
+  status can be polled (see getJobStatus)."""
+  job = models.ReinitJob(sample_data=sample_data)
+  job.put()
+  shards = []
+  for kind, model_class in _KINDS.iteritems():
+    for start, end in splitKeyRange(model_class, config.REINIT_SHARDS):
+      shards.append(models.ReinitShard(
+          job_key=job.key, phase=DELETING, target=kind,
+          start_key=start and start.urlsafe(),
+          end_key=end and end.urlsafe()))
+  for index_name, manager in _INDEXES.iteritems():
+    for start_id, end_id in manager.splitIdSpace(config.REINIT_SHARDS):
+      shards.append(models.ReinitShard(
+          job_key=job.key, phase=DELETING, target=index_name,
+          start_key=start_id, end_key=end_id))
+  _startPhase(job, DELETING, shards)
+  return job
+
+
+def _startPhase(job, phase, shards):
+  """Record the shards of the phase, and start a chain of tasks for each."""
+  ndb.put_multi(shards)
+  job.phase = phase
+  job.pending_shards = len(shards)
+  job.put()
+  logging.info('reinit job %s: %s, in %s shards.',
+               job.key.id(), phase, len(shards))
+  for shard in shards:
+    defer(runShard, shard.key.id())
+
+
+def _nextPhase(job_id):
+  """Start the phase after the one just finished."""
+  job = models.ReinitJob.get_by_id(job_id)
+  if job.phase == DELETING and job.sample_data:
+    shards = [models.ReinitShard(job_key=job.key, phase=LOADING, target=target)
+              for target in SAMPLE_DATA_FILES.keys() + [_STORES]]
+    _startPhase(job, LOADING, shards)
+  else:
+    job.phase = DONE
+    job.put()
+    logging.info('Re-initialization complete.')
+
+
+def _finishShard(shard_key, job_key):
+  """Mark the shard done.  If it was the last of its phase to finish, start
+  the next phase, in a transactional task."""
+  def _tx():
+    shard, job = ndb.get_multi([shard_key, job_key])
+    if shard.done:
+      return
+    shard.done = True
+    job.pending_shards -= 1
+    ndb.put_multi([shard, job])
+    if job.pending_shards == 0:
+      defer(_nextPhase, job.key.id(), _transactional=True)
+  ndb.transaction(_tx, xg=True)
+
+
+def _deleteKeyRange(shard, deadline):
+  """Delete the entities in the shard's key range, a batch at a time.  The
+  deletion of products is recorded in the change log; the changes of a batch
+  are written before it is deleted, so a retried batch may record a deletion
+  twice, but none is left out."""
+  model_class = _KINDS[shard.target]
+  query = model_class.query()
+  if shard.start_key:
+    query = query.filter(
+        model_class.key >= ndb.Key(urlsafe=shard.start_key))
+  if shard.end_key:
+    query = query.filter(model_class.key < ndb.Key(urlsafe=shard.end_key))
+  query = query.order(model_class.key)
+  cursor = shard.cursor and ndb.Cursor(urlsafe=shard.cursor)
+  while time.time() < deadline:
+    keys, cursor, more = query.fetch_page(
+        _DELETE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    if model_class is models.Product and keys:
+      ndb.put_multi(models.ProductChange.buildDeletes(keys))
+    ndb.delete_multi(keys)
+    shard.processed += len(keys)
+    if not more or not cursor:
+      return True
+    shard.cursor = cursor.urlsafe()
+    shard.put()
+  return False
+
+
+def _deleteIndex(shard, deadline):
+  """Delete the docs in the shard's range of ids of its index, resuming after
+  the last id deleted, if any."""
+  if shard.cursor:
+    start_id, include_start = shard.cursor, False
+  else:
+    start_id, include_start = shard.start_key, True
+  deleted, last_id = _INDEXES[shard.target].deleteRange(
+      start_id, shard.end_key, deadline, include_start)
+  shard.processed += deleted
+  shard.cursor = last_id
+  return last_id is None
+
+
+def _loadDataFile(shard, deadline):
+  """Import the rows of the shard's sample data file, a chunk at a time,
+  skipping the rows already processed."""
+  if shard.target == _STORES:
+    loadStoreLocationData()
+    return True
+  datafile = os.path.join('data', shard.target)
+  with open(datafile, 'r') as f:
+    reader = csv.DictReader(f, SAMPLE_DATA_FILES[shard.target])
+    rows = itertools.islice(reader, shard.processed, None)
+    while time.time() < deadline:
+      chunk = list(itertools.islice(rows, config.REINIT_LOAD_CHUNK))
+      if not chunk:
+        return True
+      importer.ProductImporter().run(chunk)
+      shard.processed += len(chunk)
+      shard.put()
+  return False
+
+
+def runShard(shard_id):
+  """Run a shard until it is done or its time budget is spent; in the latter
+  case, defer a task to resume it from its checkpoint."""
+  shard = models.ReinitShard.get_by_id(shard_id)
+  if not shard or shard.done:
+    return
+  deadline = time.time() + config.REINIT_TASK_SECONDS
+  if shard.phase == LOADING:
+    finished = _loadDataFile(shard, deadline)
+  elif shard.target in _KINDS:
+    finished = _deleteKeyRange(shard, deadline)
+  else:
+    finished = _deleteIndex(shard, deadline)
+  shard.put()
+  if finished:
+    _finishShard(shard.key, shard.job_key)
+  else:
+    defer(runShard, shard_id)
+
+
+def getLatestJob():
+  """Return the most recently started reinitialization job, or None."""
+  return models.ReinitJob.query().order(-models.ReinitJob.created).get()
+
+
+def getJobStatus(job):
+  """Build a dict describing the progress of the given job."""
+  if not job:
+    return None
+  return {
+      'job_id': job.key.id(),
+      'phase': job.phase,
+      'pending_shards': job.pending_shards,
+      'started': job.created.isoformat(),
+      'updated': job.updated.isoformat(),
+      'shards': [{'phase': shard.phase, 'target': shard.target,
+                  'processed': shard.processed, 'done': shard.done}
+                 for shard in sorted(job.shards(),
+                                     key=lambda s: (s.phase, s.target))]}
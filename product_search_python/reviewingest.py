@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the batched ingestion of new reviews, used when
+config.REVIEW_INGESTION is 'pull'.  Rather than each new review running its own
+task and product transaction, its key is added to a pull queue, tagged with
+the product id, and a processing task is scheduled for the product at the end
+of the current window of config.REVIEW_INGEST_WINDOW seconds.  That task leases
+all the reviews queued for the product, applies their ratings to it in as few
+transactions as possible, and then re-indexes its doc once.  A cron job
+(see cron.yaml) sweeps up any reviews left in the queue.
+"""
+
+import hashlib
+import logging
+import random
+import time
+
+import config
+import models
+
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+# the number of seconds reviews are leased for while they are applied.
+_LEASE_SECONDS = 60
+# the max number of reviews applied per transaction: a cross-group transaction
+# may span at most 25 entity groups, one of which is the product (or shard).
+_MAX_REVIEWS_PER_TX = 24
+
+
+def _tag(pid):
+  return pid.encode('utf-8')
+
+
+def queueReview(review):
+  """Add the review to the ingestion queue.  Must be called in the
+  transaction that creates the review, so that it is queued if and only if it
+  is created."""
+  taskqueue.Queue(config.REVIEW_INGEST_QUEUE).add(
+      taskqueue.Task(payload=review.key.urlsafe(), method='PULL',
+                     tag=_tag(review.product_key.id())),
+      transactional=True)
+
+
+def scheduleIngestion(pid):
+  """Schedule the processing of the product's queued reviews at the end of the
+  current window.  The task is named for the product and the window, so that
+  all the reviews of the product queued in a window share it."""
+  window = int(time.time() / config.REVIEW_INGEST_WINDOW)
+  name = 'review-ingest-%s-%s' % (hashlib.md5(_tag(pid)).hexdigest(), window)
+  try:
+    defer(ingestProductReviews, pid, _name=name,
+          _countdown=config.REVIEW_INGEST_WINDOW)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass  # the processing for this window is already scheduled.
+
+
+def _applyReviews(pid, review_keys):
+  """Apply the ratings of the given reviews of the product, in an XG
+  transaction, skipping any already applied.  In 'sharded' ratings
+  aggregation mode, the ratings are added to a counter shard of the product
+  rather than to the product itself.  Returns the number applied."""
+  sharded = config.RATINGS_AGGREGATION == 'sharded'
+  if not sharded:
+    seq = models.ProductChange.allocateSeqs(1)[0]
+
+  def _tx():
+    reviews = [review for review in ndb.get_multi(review_keys)
+               if review and not review.rating_added]
+    if not reviews:
+      return 0
+    count = len(reviews)
+    total = sum(review.rating for review in reviews)
+    if sharded:
+      shard_key = ndb.Key(
+          models.ProductRatingShard,
+          '%s:%s' % (pid, random.randrange(config.RATING_SHARDS)))
+      target = shard_key.get() or models.ProductRatingShard(key=shard_key)
+      target.rating_sum += total
+      target.rating_count += count
+    else:
+      target = models.Product.get_by_id(pid)
+      if not target:
+        logging.warn('reviews of missing product %s not applied.', pid)
+        return 0
+      num_reviews = target.num_reviews + count
+      target.avg_rating = (
+          target.avg_rating * target.num_reviews + total) / float(num_reviews)
+      target.num_reviews = num_reviews
+      target.needs_review_reindex = True
+    for review in reviews:
+      review.rating_added = True
+    entities = reviews + [target]
+    if not sharded:
+      entities.append(models.ProductChange.build(
+          seq, target.key, models.ProductChange.RATING, target))
+    ndb.put_multi(entities)
+    return count
+  return ndb.transaction(_tx, xg=True)
+
+
+def _applyTasks(pid, queue, tasks):
+  """Apply the reviews of the leased tasks, then delete the tasks."""
+  review_keys = [ndb.Key(urlsafe=task.payload) for task in tasks]
+  applied = 0
+  for i in range(0, len(review_keys), _MAX_REVIEWS_PER_TX):
+    applied += _applyReviews(pid, review_keys[i:i + _MAX_REVIEWS_PER_TX])
+  queue.delete_tasks(tasks)
+  return applied
+
+
+def _finishProduct(pid, applied):
+  """Update the product's doc (once) with the ratings applied."""
+  if not applied:
+    return
+  if config.RATINGS_AGGREGATION == 'sharded':
+    models.Product.rollupRatings(pid)
+  elif not config.BATCH_RATINGS_UPDATE:
+    models.Product.updateProdDocWithNewRating(pid)
+
+
+def ingestProductReviews(pid):
+  """Apply all the reviews queued for the product, up to
+  config.REVIEW_INGEST_BATCH_SIZE at a time, and then update its doc."""
+  queue = taskqueue.Queue(config.REVIEW_INGEST_QUEUE)
+  applied = 0
+  while True:
+    tasks = queue.lease_tasks_by_tag(
+        _LEASE_SECONDS, config.REVIEW_INGEST_BATCH_SIZE, tag=_tag(pid))
+    if not tasks:
+      break
+    applied += _applyTasks(pid, queue, tasks)
+    if len(tasks) < config.REVIEW_INGEST_BATCH_SIZE:
+      break
+  _finishProduct(pid, applied)
+  logging.info('applied %s queued reviews of product %s.', applied, pid)
+  return applied
+
+
+def ingestAllReviews(deadline=None):
+  """Apply the reviews queued for any product, a product at a time, until the
+  queue is empty or the deadline (a time.time() value) is passed.  Used to
+  sweep up reviews whose processing task was not scheduled."""
+  queue = taskqueue.Queue(config.REVIEW_INGEST_QUEUE)
+  applied = 0
+  while not deadline or time.time() < deadline:
+    # with no tag given, the tasks with the same tag as the oldest task are
+    # leased.
+    tasks = queue.lease_tasks_by_tag(
+        _LEASE_SECONDS, config.REVIEW_INGEST_BATCH_SIZE)
+    if not tasks:
+      break
+    pid = tasks[0].tag.decode('utf-8')
+    count = _applyTasks(pid, queue, tasks)
+    _finishProduct(pid, count)
+    applied += count
+  return applied
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the registry of compiled product category schemas.  The category
+field specifications in categories.py are compiled once, at import, into a
+list of field builders per category -- each pairing a value converter with
+the search field class to build -- which are then reused for every product
+document built.
+"""
+
+import logging
+
+import categories
+import errors
+
+from google.appengine.api import search
+
+
+# the converters for the values of each supported field type.
+_CONVERTERS = {
+    search.NumberField: float,
+    search.TextField: str,
+}
+
+
+class FieldBuilder(object):
+  """Builds the document field for one category-specific product field."""
+
+  def __init__(self, name, field_class):
+    self.name = name
+    self.field_class = field_class
+    self.convert = _CONVERTERS[field_class]
+
+  def build(self, value):
+    """Build the field from the given (unconverted) value."""
+    try:
+      return self.field_class(name=self.name, value=self.convert(value))
+    except ValueError:
+      error_message = ('bad value %s for field %s of type %s' %
+                       (self.name, value, self.field_class))
+      logging.error(error_message)
+      raise errors.OperationFailedError(error_message)
+
+
+class CategorySchema(object):
+  """The compiled field builders for the non-'core' fields of a product
+  category."""
+
+  def __init__(self, category_name, field_spec):
+    self.category_name = category_name
+    self.builders = []
+    for name, field_class in sorted(field_spec.iteritems()):
+      if field_class in _CONVERTERS:
+        self.builders.append(FieldBuilder(name, field_class))
+      else:
+        # you may want to add handling of other field types for generality.
+        # Not needed for our current sample data.
+        logging.warn('not processed: field %s of category %s, of type %s',
+                     name, category_name, field_class)
+    self.field_names = [builder.name for builder in self.builders]
+
+  def buildFields(self, params):
+    """Build the category-specific fields from the given params dict.  All
+    such fields are treated as required."""
+    fields = []
+    for builder in self.builders:
+      if builder.name not in params:
+        error_message = ('value not given for field "%s" of field type "%s"'
+                         % (builder.name, builder.field_class))
+        logging.warn(error_message)
+        raise errors.OperationFailedError(error_message)
+      fields.append(builder.build(params[builder.name]))
+    return fields
+
+
+class SchemaRegistry(object):
+  """The compiled schemas of all the product categories."""
+
+  def __init__(self, product_dict):
+    self._schemas = dict(
+        (category_name, CategorySchema(category_name, field_spec))
+        for category_name, field_spec in product_dict.iteritems())
+    # the union of the category-specific fields of all categories, e.g. for
+    # the product creation form.
+    names = set()
+    for category_schema in self._schemas.itervalues():
+      names.update(category_schema.field_names)
+    self.form_fields = sorted(names)
+
+  def getSchema(self, category_name):
+    """Return the compiled schema of the given category, or None."""
+    return self._schemas.get(category_name)
+
+
+_REGISTRY = SchemaRegistry(categories.product_dict)
+
+
+def getSchema(category_name):
+  """Return the compiled schema of the given category, or None."""
+  return _REGISTRY.getSchema(category_name)
+
+
+def getFormFields():
+  """Return the names of the category-specific fields of all categories."""
+  return _REGISTRY.form_fields
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains a cache for search results.  Each index has a 'generation'
+token, kept in memcache so that it is shared by all instances, which is
+replaced whenever the index is modified (see docs.BaseDocumentManager).  Cached
+results are keyed on the generation as well as on the query, so a change to the
+index invalidates all the results cached for it.  Results are kept in an
+in-process LRU cache, and optionally in memcache as well, so that they can be
+shared between instances.
+"""
+
+import collections
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+import config
+
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+  """A thread-safe, size-bounded in-process cache with per-entry expiry.
+  Keeps hit, miss, eviction and expiration counts."""
+
+  def __init__(self, max_size, ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key):
+    """Return the value cached under the given key, or None."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      expires, value = entry
+      if expires < time.time():
+        self.expirations += 1
+        self.misses += 1
+        return None
+      # re-insert, to mark the entry as the most recently used.
+      self._entries[key] = entry
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    """Cache the value under the given key, evicting the least recently used
+    entries if the cache is full."""
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self.ttl, value)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class SearchResultCache(object):
+  """Caches search results for a single index."""
+
+  _GENERATION_KEY = 'search_generation:%s'
+  _RESULT_KEY = 'search_result:%s:%s:%s'
+
+  def __init__(self, index_name, max_size, ttl, use_memcache):
+    self.index_name = index_name
+    self.ttl = ttl
+    self.use_memcache = use_memcache
+    self._local = LRUCache(max_size, ttl)
+    self.memcache_hits = 0
+    # the generation last read from memcache, and when.
+    self._generation = None
+    self._generation_checked = 0
+
+  def getGeneration(self):
+    """Get the current generation of the index: an opaque, random token, so
+    that a new generation -- started when the index is modified, or when the
+    token is evicted from memcache -- never reuses an earlier one.
+
+    The generation is cached on the instance for up to
+    config.SEARCH_GENERATION_CHECK_SECONDS, so that a hit in the in-process
+    cache costs no memcache call.  So a modification of the index made on
+    another instance may take that long to invalidate the results cached on
+    this one; those made on this instance invalidate them at once."""
+    now = time.time()
+    if (self._generation is not None and now - self._generation_checked <
+        config.SEARCH_GENERATION_CHECK_SECONDS):
+      return self._generation
+    gen_key = self._GENERATION_KEY % self.index_name
+    generation = memcache.get(gen_key)
+    if generation is None:
+      memcache.add(gen_key, uuid.uuid4().hex)
+      generation = memcache.get(gen_key)
+    self._generation, self._generation_checked = generation, now
+    return generation
+
+  def bumpGeneration(self):
+    """Start a new generation of the index, invalidating all cached results."""
+    gen_key = self._GENERATION_KEY % self.index_name
+    generation = uuid.uuid4().hex
+    memcache.set(gen_key, generation)
+    self._generation, self._generation_checked = generation, time.time()
+    self._local.clear()
+
+  def _makeKey(self, query_key, generation):
+    digest = hashlib.md5(repr(query_key)).hexdigest()
+    return self._RESULT_KEY % (self.index_name, generation, digest)
+
+  def get(self, query_key):
+    """Return the results cached for the given (normalized) query key in the
+    current generation of the index, or None."""
+    generation = self.getGeneration()
+    if generation is None:  # memcache is unavailable.
+      return None
+    key = self._makeKey(query_key, generation)
+    value = self._local.get(key)
+    if value is None and self.use_memcache:
+      value = memcache.get(key)
+      if value is not None:
+        self.memcache_hits += 1
+        self._local.set(key, value)
+    return value
+
+  def set(self, query_key, value):
+    """Cache the results for the given query key in the current generation of
+    the index."""
+    generation = self.getGeneration()
+    if generation is None:
+      return
+    key = self._makeKey(query_key, generation)
+    self._local.set(key, value)
+    if self.use_memcache:
+      try:
+        memcache.set(key, value, time=self.ttl)
+      except Exception:  # e.g. the value could not be pickled.
+        logging.exception('could not cache search results in memcache.')
+
+  def stats(self):
+    """Return the cache counters for this instance."""
+    lookups = self._local.hits + self._local.misses
+    hits = self._local.hits + self.memcache_hits
+    return {
+        'index': self.index_name,
+        'size': len(self._local),
+        'hits': self._local.hits,
+        'memcache_hits': self.memcache_hits,
+        'misses': self._local.misses - self.memcache_hits,
+        'evictions': self._local.evictions,
+        'expirations': self._local.expirations,
+        'hit_rate': float(hits) / lookups if lookups else 0.0}
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def getCache(index_name):
+  """Get the result cache for the index with the given name."""
+  with _CACHES_LOCK:
+    cache = _CACHES.get(index_name)
+    if cache is None:
+      cache = SearchResultCache(
+          index_name, config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL,
+          config.SEARCH_CACHE_MEMCACHE)
+      _CACHES[index_name] = cache
+    return cache
+
+
+def invalidate(index_name):
+  """Invalidate all the results cached for the index with the given name."""
+  getCache(index_name).bumpGeneration()
+
+
+def allStats():
+  """Return the counters of all the result caches on this instance."""
+  return [cache.stats() for cache in _CACHES.values()]
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the benchmarks of the product search request path.  For each
+catalog size, a synthetic catalog (see test_search.create_catalog_data) is
+loaded into a fresh set of service stubs, and the operations below are timed.
+For each, the latency percentiles, the RPCs made per call (by service and
+method) and the growth of the process's peak memory while it ran are
+reported, and for each catalog size, the process's peak memory.  Run with
+run_benchmarks.py, which runs each catalog size in its own process, so that
+the peak memory of one size is not that of an earlier one.
+"""
+
+import base64
+import collections
+import itertools
+import json
+import random
+import resource
+import time
+import urllib
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.search import simple_search_stub
+from google.appengine.ext import deferred
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+
+import config
+import docs
+import localsearch
+import main
+import models
+import utils
+
+from tests import test_search
+
+# the search requests made for each catalog; 'category' and 'rating' are
+# filled in per request from the catalog.
+_SEARCH_PARAMS = [
+    {'query': ''},
+    {'query': 'adventure'},
+    {'query': 'mystery garden'},
+    {'query': 'price < 100'},
+    {'query': 'adventure', 'category': 'books'},
+    {'query': 'television', 'category': 'hd televisions', 'sort': 'price'},
+    {'query': 'history', 'rating': '4'},
+    {'query': 'science', 'sort': 'ar', 'offset': '3'},
+]
+
+
+def percentiles(latencies):
+  """Summarize a list of latencies (in seconds) as milliseconds."""
+  if not latencies:
+    return {}
+  ordered = sorted(latencies)
+
+  def pct(p):
+    return 1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+  return {'count': len(ordered), 'mean': 1000 * sum(ordered) / len(ordered),
+          'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99),
+          'max': 1000 * ordered[-1]}
+
+
+def peakMemoryKb():
+  """The peak resident memory of the process (in KB, on Linux)."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RpcCounter(object):
+  """An apiproxy pre-call hook that counts RPCs by service and method."""
+
+  _HOOK_NAME = 'benchmark_rpc_counter'
+
+  def __init__(self):
+    self.counts = collections.Counter()
+
+  def __call__(self, service, call, request, response):
+    self.counts['%s.%s' % (service, call)] += 1
+
+  def install(self):
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        self._HOOK_NAME, self)
+
+
+class Benchmark(object):
+  """Runs the benchmarks for one catalog size."""
+
+  def __init__(self, size, repeat, backend, seed=0):
+    self.size = size
+    self.repeat = repeat
+    self.backend = backend
+    self.rnd = random.Random(seed)
+    self.seed = seed
+    self.results = collections.OrderedDict()
+    self.rpcs = None
+
+  def setUp(self):
+    config.SEARCH_BACKEND = self.backend
+    # measure the uncached request path.
+    config.SEARCH_CACHE_SIZE = 0
+    config.BATCH_RATINGS_UPDATE = False
+    localsearch.clearAll()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(app_id='productsearch', overwrite=True)
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.testbed.init_user_stub()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'search', simple_search_stub.SearchServiceStub())
+    self.rpcs = RpcCounter()
+    self.rpcs.install()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    localsearch.clearAll()
+
+  def _runTasks(self):
+    """Run the deferred tasks, including any they add, until none are left."""
+    taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskq.GetTasks('default')
+    taskq.FlushQueue('default')
+    while tasks:
+      for task in tasks:
+        deferred.run(base64.b64decode(task['body']))
+      tasks = taskq.GetTasks('default')
+      taskq.FlushQueue('default')
+
+  def measure(self, name, function, args_list):
+    """Call the function with each of the args tuples in turn, recording its
+    latencies, the RPCs made per call, and how much the calls raised the
+    process's peak memory (which never goes down, so only its growth can be
+    told apart from that of the operations before)."""
+    latencies = []
+    self.rpcs.counts.clear()
+    peak_before = peakMemoryKb()
+    for args in args_list:
+      start = time.time()
+      function(*args)
+      latencies.append(time.time() - start)
+    result = percentiles(latencies)
+    calls = len(latencies) or 1
+    result['rpcs_per_call'] = dict(
+        (rpc, float(count) / calls)
+        for rpc, count in sorted(self.rpcs.counts.iteritems()))
+    result['peak_memory_growth_kb'] = peakMemoryKb() - peak_before
+    self.results[name] = result
+    return result
+
+  def loadCatalog(self):
+    rows = test_search.create_catalog_data(self.size, self.seed)
+    batches = iter(lambda: list(itertools.islice(
+        rows, config.IMPORT_BATCH_SIZE)), [])
+    self.measure('buildProductBatch', docs.Product.buildProductBatch,
+                 ((batch,) for batch in batches))
+
+  def _search(self, params):
+    response = main.application.get_response(
+        '/psearch?' + urllib.urlencode(params))
+    if response.status_int != 200:
+      raise AssertionError('search failed: %s' % response.status)
+
+  def benchmarkSearch(self):
+    self.measure('doProductSearch', self._search,
+                 [(params,) for params in _SEARCH_PARAMS] * self.repeat)
+
+  def benchmarkRatingsBuckets(self):
+    queries = [params['query'] for params in _SEARCH_PARAMS]
+    self.measure('generateRatingsBuckets', docs.Product.generateRatingsBuckets,
+                 [(query,) for query in queries] * self.repeat)
+
+  def benchmarkUpdateAverageRating(self):
+    """Add reviews for random products, and time the rating updates,
+    including the reindexing of the product documents."""
+    pids = ['book%d' % i if i % 2 == 0 else 'tv%d' % i
+            for i in (self.rnd.randrange(self.size)
+                      for _ in range(len(_SEARCH_PARAMS) * self.repeat))]
+    review_keys = [models.Review(
+        product_key=models.Product.get_by_id(pid).key, username='bench',
+        rating=self.rnd.randint(config.RATING_MIN, config.RATING_MAX),
+        comment='benchmark review').put() for pid in pids]
+
+    def update(review_key):
+      utils.updateAverageRating(review_key)
+      self._runTasks()
+    self.measure('updateAverageRating', update,
+                 [(key,) for key in review_keys])
+
+  def benchmarkDeleteAll(self):
+    self.measure('deleteAllInIndex', docs.Product.deleteAllInIndex, [()])
+
+  def run(self):
+    """Run all the benchmarks for the catalog size; returns the results."""
+    self.setUp()
+    try:
+      models.Category.buildAllCategories()
+      self.loadCatalog()
+      self.benchmarkSearch()
+      self.benchmarkRatingsBuckets()
+      self.benchmarkUpdateAverageRating()
+      self.benchmarkDeleteAll()
+    finally:
+      self.tearDown()
+    return {'catalog_size': self.size, 'backend': self.backend,
+            'repeat': self.repeat, 'peak_memory_kb': peakMemoryKb(),
+            'results': self.results}
+
+
+def runAll(sizes, repeat, backend, seed=0):
+  """Run the benchmarks for each catalog size, returning a list of the
+  results of each."""
+  return [Benchmark(size, repeat, backend, seed).run() for size in sizes]
+
+
+def toJson(runs, started=None):
+  """Format the results of the runs as JSON.  The start time is only
+  included if given, so that the output of two runs can be diffed."""
+  output = {'runs': runs}
+  if started:
+    output['started'] = started
+  return json.dumps(output, indent=2, sort_keys=True)
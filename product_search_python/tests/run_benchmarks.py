@@ -0,0 +1,89 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import logging
+import time
+
+USAGE = """%prog [options] SDK_PATH
+Run the product search benchmarks, and write the results as JSON.  Each
+catalog size is run in its own process, so that its peak memory is its own.
+
+SDK_PATH    Path to the SDK installation"""
+
+
+def runSize(sdk_path, size, options):
+    """Run the benchmarks for one catalog size in a new process, and return
+    the results of its run."""
+    args = [sys.executable, os.path.abspath(__file__), '--sizes=%d' % size,
+            '--repeat=%d' % options.repeat, '--backend=%s' % options.backend,
+            '--seed=%d' % options.seed, sdk_path]
+    return json.loads(subprocess.check_output(args))['runs']
+
+
+def main(sdk_path, options):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, project_dir)
+    # the templates are found relative to the app's directory.
+    os.chdir(project_dir)
+    from tests import benchmarks
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    sizes = [int(size) for size in options.sizes.split(',')]
+    if len(sizes) == 1:
+        runs = benchmarks.runAll(sizes, options.repeat, options.backend,
+                                 options.seed)
+    else:
+        runs = []
+        for size in sizes:
+            runs.extend(runSize(sdk_path, size, options))
+    output = benchmarks.toJson(
+        runs, started=started if options.timestamp else None)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--sizes', default='1000,100000,1000000',
+                      help='comma-separated catalog sizes [%default]')
+    parser.add_option('--repeat', type='int', default=10,
+                      help='times each set of requests is repeated [%default]')
+    parser.add_option('--backend', default='local',
+                      choices=['local', 'service'],
+                      help="search backend: 'local', or 'service' for the "
+                      "search service stub [%default]")
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed for the catalog data [%default]')
+    parser.add_option('--output', help='write the JSON results to this file')
+    parser.add_option('--timestamp', action='store_true',
+                      help='include the start time in the results')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    logging.getLogger().setLevel(logging.ERROR)
+    main(args[0], options)
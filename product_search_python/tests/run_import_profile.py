@@ -0,0 +1,150 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import __builtin__
+import json
+import optparse
+import os
+import sys
+import time
+
+USAGE = """%prog [options] SDK_PATH
+Profile the imports of a new instance of the app, and report the time taken
+to import each module.  The app's modules are imported in the order a new
+instance loads them: the routing of main.py, then the handlers of its first
+request, then the same for admin.py.  Each step is reported with the modules
+it newly imported, by cumulative time (including the modules they import in
+turn) and own time.  Run it in a new process each time, so that no module is
+already imported.
+
+SDK_PATH    Path to the SDK installation"""
+
+# the modules imported by each step, in order.
+STEPS = [('main', 'main'), ('first request', 'handlers'),
+         ('admin', 'admin'), ('first admin request', 'admin_handlers')]
+
+
+class ImportTimer(object):
+    """Times the imports made while installed, by wrapping __import__."""
+
+    def __init__(self):
+        # (module name, cumulative seconds, own seconds), in import order.
+        self.imports = []
+        # the time taken by the imports nested in each import in progress.
+        self._nested = []
+        self._import = None
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timedImport
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+    def _timedImport(self, name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        before = set(sys.modules)
+        self._nested.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            loaded = [module for module in set(sys.modules) - before
+                      if sys.modules[module] is not None]
+            if loaded:
+                self.imports.append(
+                    (self._label(name, fromlist, loaded), elapsed,
+                     elapsed - nested))
+
+    @staticmethod
+    def _label(name, fromlist, loaded):
+        """Name an import by the module it asked for, as resolved: a
+        submodule named in its fromlist, or a module of a package it was
+        imported from (python 2 tries relative imports first)."""
+        for module in sorted(loaded, key=len):
+            if module == name or module.endswith('.' + name):
+                return module
+        for sub in fromlist or []:
+            if '%s.%s' % (name, sub) in loaded:
+                return '%s.%s' % (name, sub)
+        return name
+
+
+def profile(steps):
+    """Import the modules of the given steps, and return a list of each step's
+    (name, seconds, imports)."""
+    report = []
+    timer = ImportTimer()
+    for step, module in steps:
+        timer.imports = []
+        timer.install()
+        start = time.time()
+        try:
+            __import__(module)
+        finally:
+            timer.uninstall()
+        report.append((step, time.time() - start, timer.imports))
+    return report
+
+
+def formatReport(report, top):
+    lines = []
+    for step, seconds, imports in report:
+        lines.append('%s: %.1f ms, %d modules imported' % (
+            step, seconds * 1000, len(imports)))
+        lines.append('  %10s %10s  %s' % ('cumul. ms', 'own ms', 'module'))
+        for name, cumulative, own in sorted(
+                imports, key=lambda i: -i[1])[:top]:
+            lines.append('  %10.1f %10.1f  %s' % (
+                cumulative * 1000, own * 1000, name))
+    return '\n'.join(lines)
+
+
+def main(sdk_path, options):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, project_dir)
+    os.chdir(project_dir)
+    report = profile(STEPS)
+    if options.json:
+        print json.dumps([
+            {'step': step, 'ms': seconds * 1000,
+             'imports': [{'module': name, 'cumulative_ms': cumulative * 1000,
+                          'own_ms': own * 1000}
+                         for name, cumulative, own in imports]}
+            for step, seconds, imports in report], indent=2)
+    else:
+        print formatReport(report, options.top)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--top', type='int', default=20,
+                      help='modules reported per step [%default]')
+    parser.add_option('--json', action='store_true',
+                      help='write the full report as JSON')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    main(args[0], options)
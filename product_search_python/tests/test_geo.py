@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains unit tests for the store location lookups."""
+
+import json
+import unittest
+import urllib
+
+from google.appengine.ext import testbed
+
+import config
+import geo
+import localsearch
+import main
+import stores
+
+
+class GeoTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.backend = config.SEARCH_BACKEND
+    config.SEARCH_BACKEND = 'local'
+    localsearch.clearAll()
+    geo.loadStores(stores.stores)
+
+  def tearDown(self):
+    config.SEARCH_BACKEND = self.backend
+    localsearch.clearAll()
+    self.testbed.deactivate()
+
+  def _nearest(self, lat, lon, limit, max_distance=None, rows=None):
+    """Find the nearest stores by brute force."""
+    candidates = sorted(
+        (geo.distance(lat, lon, s_lat, s_lon), store_id)
+        for store_id, _, _, (s_lat, s_lon) in rows or stores.stores)
+    return [store_id for dist, store_id in candidates
+            if max_distance is None or dist <= max_distance][:limit]
+
+  def testCells(self):
+    self.assertEqual(geo.geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+    cells = geo.blockCells(-33.87, 151.2, 4)
+    self.assertEqual(len(cells), 9)
+    self.assertTrue(geo.geohash(-33.87, 151.2, 4) in cells)
+    # the block of a coarser precision contains that of a finer one.
+    self.assertTrue(geo.coveredRadius(-33.87, 3) >
+                    geo.coveredRadius(-33.87, 4))
+
+  def testNearestStores(self):
+    for lat, lon in [(-33.87, 151.2), (-30.5, 151.6), (51.5, -0.1)]:
+      found = geo.nearestStores(lat, lon, 3)
+      self.assertEqual([store['store_id'] for store in found],
+                       self._nearest(lat, lon, 3))
+      found = geo.nearestStores(lat, lon, 10, max_distance=20000)
+      self.assertEqual([store['store_id'] for store in found],
+                       self._nearest(lat, lon, 10, 20000))
+    # more stores than the coarsest cells cover are found by a full search.
+    found = geo.nearestStores(-33.87, 151.2, len(stores.stores))
+    self.assertEqual(len(found), len(stores.stores))
+
+  def testCellCache(self):
+    geo.nearestStores(-33.87, 151.2, 3)
+    # the cached cells are used until the store index is modified.
+    localsearch.getIndex(config.STORE_INDEX_NAME).delete(['sydney'])
+    found = geo.nearestStores(-33.873038, 151.20563, 1)
+    self.assertEqual(found[0]['store_id'], 'sydney')
+    # re-indexing a store invalidates them.
+    geo.loadStores(stores.stores[:1])
+    found = geo.nearestStores(-33.873038, 151.20563, 1)
+    self.assertNotEqual(found[0]['store_id'], 'sydney')
+
+  def testTruncatedCells(self):
+    # a cluster of stores, more than a cell's limit, in the same finest cell.
+    cluster = [('cluster%d' % i, 'Store %d' % i, 'Address %d' % i,
+                (-33.87 + i * 1e-5, 151.2)) for i in range(5)]
+    geo.loadStores(cluster)
+    rows = stores.stores + cluster
+    limit = config.GEO_CELL_LIMIT
+    config.GEO_CELL_LIMIT = 2
+    try:
+      cell = geo.geohash(-33.87, 151.2, config.GEO_MAX_PRECISION)
+      records, truncated = geo.getCells([cell])
+      self.assertEqual(truncated, set([cell]))
+      self.assertEqual(len(records[cell]), 2)
+      # the truncated cells are cached as such.
+      self.assertEqual(geo.getCells([cell])[1], set([cell]))
+      lat, lon = -33.87 + 4e-5, 151.2
+      found = geo.nearestStores(lat, lon, 3)
+      self.assertEqual([store['store_id'] for store in found],
+                       self._nearest(lat, lon, 3, rows=rows))
+      found = geo.nearestStores(lat, lon, 10, max_distance=100)
+      self.assertEqual([store['store_id'] for store in found],
+                       self._nearest(lat, lon, 10, 100, rows=rows))
+    finally:
+      config.GEO_CELL_LIMIT = limit
+
+  def _getStores(self, **params):
+    return main.application.get_response(
+        '/get_store_locations?' + urllib.urlencode(params))
+
+  def testStoreLocationPages(self):
+    response = self._getStores(latitude=-33.87, longitude=151.2, limit=3,
+                               callback='cb')
+    self.assertEqual(response.status_int, 200)
+    self.assertTrue(response.body.startswith('cb(') and
+                    response.body.endswith(');'))
+    page = json.loads(response.body[len('cb('):-len(');')])
+    self.assertEqual(page['next_offset'], 3)
+    self.assertEqual(sorted(page['stores'][0].keys()),
+                     ['addr', 'lat', 'lon', 'storename'])
+
+    response = self._getStores(latitude=-33.87, longitude=151.2, limit=3,
+                               offset=3, fields='id,distance')
+    page = json.loads(response.body)
+    self.assertEqual([store['id'] for store in page['stores']],
+                     self._nearest(-33.87, 151.2, 6)[3:])
+    self.assertTrue(page['stores'][0]['distance'] <=
+                    page['stores'][1]['distance'])
+    response = self._getStores(latitude=-33.87, longitude=151.2,
+                               limit=len(stores.stores))
+    self.assertEqual(json.loads(response.body)['next_offset'], None)
+
+    # the last page allowed can be fetched, though one more store than the
+    # page is asked for.
+    response = self._getStores(
+        latitude=-33.87, longitude=151.2,
+        limit=config.STORE_LOCATION_MAX_LIMIT,
+        offset=(config.STORE_LOCATION_MAX_RESULTS -
+                config.STORE_LOCATION_MAX_LIMIT))
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(json.loads(response.body),
+                     {'stores': [], 'next_offset': None})
+
+    # the limit is required, and bounded.
+    self.assertEqual(
+        self._getStores(latitude=-33.87, longitude=151.2).status_int, 400)
+    self.assertEqual(self._getStores(
+        latitude=-33.87, longitude=151.2,
+        limit=config.STORE_LOCATION_MAX_LIMIT + 1).status_int, 400)
+    self.assertEqual(self._getStores(
+        latitude=-33.87, longitude=151.2, limit=3,
+        fields='secret').status_int, 400)
+    self.assertEqual(self._getStores(
+        latitude=-33.87, longitude=151.2, limit=3,
+        callback='alert(1)').status_int, 400)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains unit tests for the local search backend."""
+
+import unittest
+
+from google.appengine.api import search
+
+import localsearch
+
+
+def _makeDoc(i, category, price, ar, description):
+  return search.Document(
+      doc_id='doc%03d' % i,
+      fields=[search.TextField(name='name', value='product %s' % i),
+              search.TextField(name='description', value=description),
+              search.AtomField(name='category', value=category),
+              search.NumberField(name='price', value=price),
+              search.NumberField(name='ar', value=ar)],
+      facets=[search.AtomFacet(name='category', value=category),
+              search.NumberFacet(name='price', value=price)])
+
+
+class LocalSearchTestCase(unittest.TestCase):
+
+  def setUp(self):
+    localsearch.clearAll()
+    self.index = localsearch.getIndex('test')
+    self.index.put([
+        _makeDoc(i, 'books' if i % 2 else 'tvs', i * 10, i % 5 + 1,
+                 'a large red book' if i % 3 else 'a small blue tv')
+        for i in range(30)])
+
+  def tearDown(self):
+    localsearch.clearAll()
+
+  def testTextAndFieldQueries(self):
+    self.assertEqual(self.index.search('red book').number_found, 20)
+    self.assertEqual(self.index.search('"blue tv"').number_found, 10)
+    self.assertEqual(self.index.search('category:books').number_found, 15)
+    self.assertEqual(
+        self.index.search('category:books price < 100').number_found, 5)
+    self.assertEqual(
+        self.index.search('ar >= 4 ar < 5 red').number_found, 4)
+    self.assertEqual(self.index.search('description:tv').number_found, 10)
+    self.assertRaises(search.QueryError, self.index.search, 'price:cheap')
+    self.assertEqual(self.index.search(
+        'category:("books" OR "tvs") price < 100').number_found, 10)
+    self.assertEqual(
+        self.index.search('category:(books OR radios)').number_found, 15)
+
+  def testSortAndPaging(self):
+    sort_options = search.SortOptions(expressions=[
+        search.SortExpression(expression='price',
+                              direction=search.SortExpression.DESCENDING,
+                              default_value=0)])
+    query = search.Query(
+        query_string='category:tvs',
+        options=search.QueryOptions(
+            limit=4, sort_options=sort_options, cursor=search.Cursor(),
+            returned_fields=['price']))
+    results = self.index.search(query)
+    self.assertEqual(results.number_found, 15)
+    self.assertEqual([doc.doc_id for doc in results],
+                     ['doc028', 'doc026', 'doc024', 'doc022'])
+    self.assertEqual([f.name for f in results.results[0].fields], ['price'])
+    # the cursor picks up where the last page left off.
+    query = search.Query(
+        query_string='category:tvs',
+        options=search.QueryOptions(
+            limit=4, sort_options=sort_options, cursor=results.cursor))
+    results = self.index.search(query)
+    self.assertEqual(results.results[0].doc_id, 'doc020')
+
+  def testFacets(self):
+    query = search.Query(
+        query_string='red',
+        return_facets=[
+            search.FacetRequest('category'),
+            search.FacetRequest('price', ranges=[
+                search.FacetRange(end=100), search.FacetRange(start=100)])])
+    results = self.index.search(query)
+    counts = dict((facet.name, dict((v.label, v.count) for v in facet.values))
+                  for facet in results.facets)
+    self.assertEqual(counts['category'], {'books': 10, 'tvs': 10})
+    self.assertEqual(sum(counts['price'].values()), 20)
+
+    # the facet depth counts the top results, in the order of the results.
+    query = search.Query(
+        query_string='',
+        options=search.QueryOptions(sort_options=search.SortOptions(
+            expressions=[search.SortExpression(
+                expression='price', default_value=0,
+                direction=search.SortExpression.DESCENDING)])),
+        return_facets=[search.FacetRequest('category')],
+        facet_options=search.FacetOptions(depth=5))
+    results = self.index.search(query)
+    self.assertEqual(results.number_found, 30)
+    self.assertEqual(
+        dict((v.label, v.count) for v in results.facets[0].values),
+        {'books': 3, 'tvs': 2})
+
+  def testGetRangeAndDelete(self):
+    response = self.index.get_range(start_id='doc010', limit=5)
+    self.assertEqual([doc.doc_id for doc in response],
+                     ['doc010', 'doc011', 'doc012', 'doc013', 'doc014'])
+    response = self.index.get_range(
+        start_id='doc010', include_start_object=False, ids_only=True)
+    self.assertEqual(response.results[0].doc_id, 'doc011')
+    self.index.delete(['doc%03d' % i for i in range(0, 30, 2)])
+    self.assertEqual(self.index.search('category:tvs').number_found, 0)
+    self.assertEqual(self.index.search('price < 50').number_found, 2)
+    # re-putting a doc replaces it.
+    self.index.put(_makeDoc(1, 'tvs', 1000, 5, 'a blue tv'))
+    self.assertEqual(self.index.search('category:tvs').number_found, 1)
+    self.assertEqual(self.index.search('price >= 1000').number_found, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains unit tests for the product query builder."""
+
+import unittest
+
+from google.appengine.api import search
+
+import docs
+import querybuilder
+
+
+class QueryBuilderTestCase(unittest.TestCase):
+
+  def testFilters(self):
+    query = querybuilder.ProductQuery(
+        '  sherlock   holmes ', category='hd "big" tvs', rating=5)
+    self.assertEqual(query.queryString(),
+                     'sherlock holmes category:"hd \\"big\\" tvs" ar:5')
+    self.assertEqual(query.queryString(with_rating=False),
+                     'sherlock holmes category:"hd \\"big\\" tvs"')
+    # a category filter also matches the categories below it in the tree.
+    query = querybuilder.ProductQuery(
+        'holmes', category='tvs', subcategories=['tvs', 'oled', 'lcd'])
+    self.assertEqual(query.queryString(),
+                     'holmes category:("tvs" OR "lcd" OR "oled")')
+    query = querybuilder.ProductQuery('', rating=3)
+    self.assertEqual(query.queryString(), 'ar >= 3 ar < 4')
+    self.assertEqual(querybuilder.parseRating('4'), 4)
+    self.assertEqual(querybuilder.parseRating('9'), None)
+    self.assertEqual(querybuilder.parseRating('x'), None)
+
+  def testTemplates(self):
+    price = querybuilder.getTemplate(docs.Product.PRICE)
+    self.assertEqual(
+        [e.expression for e in price.sort_options.expressions],
+        [docs.Product.PRICE, docs.Product.AVG_RATING])
+    rating = querybuilder.getTemplate(docs.Product.AVG_RATING)
+    self.assertEqual(
+        [e.expression for e in rating.sort_options.expressions],
+        [docs.Product.AVG_RATING, docs.Product.PRICE])
+    # unknown sort options sort on relevance.
+    self.assertEqual(querybuilder.getTemplate('').sort,
+                     querybuilder.RELEVANCE)
+
+    query = querybuilder.ProductQuery(
+        'holmes', sort=docs.Product.PRICE, limit=5, offset=10)
+    search_query = query.buildSearchQuery()
+    self.assertEqual(search_query.query_string, 'holmes')
+    self.assertEqual(search_query.options.limit, 5)
+    self.assertEqual(search_query.options.offset, 10)
+    self.assertTrue(search_query.options.sort_options is price.sort_options)
+
+  def testKey(self):
+    key = querybuilder.ProductQuery(
+        'sherlock  holmes', category='books', sort='', limit=3).key()
+    self.assertEqual(key, querybuilder.ProductQuery(
+        ' sherlock holmes', category='books', sort='relevance',
+        limit=3).key())
+    self.assertNotEqual(key, querybuilder.ProductQuery(
+        'sherlock holmes', category='books', sort='relevance', limit=3,
+        offset=3).key())
+    # pages fetched from the same cursor have the same key.
+    cursor = search.Cursor(web_safe_string='abc')
+    self.assertEqual(
+        querybuilder.ProductQuery('holmes', offset=3, cursor=cursor).key(),
+        querybuilder.ProductQuery('holmes', offset=6, cursor=cursor).key())
+
+
+if __name__ == '__main__':
+  unittest.main()
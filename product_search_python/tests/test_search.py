@@ -22,12 +22,16 @@ __author__ = 'tmatsuo@google.com (Takashi Matsuo), amyu@google.com (Amy Unruh)'
 import os
 import shutil
 import tempfile
+import time
 import unittest
 import base64
 import pickle
+import random
+import urlparse
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import files
+from google.appengine.api import memcache
 from google.appengine.api import queueinfo
 from google.appengine.api import search
 from google.appengine.api import users
@@ -35,14 +39,27 @@ from google.appengine.api.search import simple_search_stub
 from google.appengine.api.taskqueue import taskqueue_stub
 from google.appengine.ext import db
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
+from google.appengine.runtime import apiproxy_errors
+from webapp2_extras import jinja2
 
 import admin_handlers
+import base_handler
 import config
 import docs
 import errors
+import fragments
+import handlers
+import importer
+import main
 import models
+import profiling
+import reconcile
+import reinit
+import reviewingest
+import searchcache
 import utils
 
 PRODUCT_PARAMS = dict(
@@ -77,6 +94,37 @@ def create_test_data(n):
     ret.append(params)
   return ret
 
+_CATALOG_WORDS = [
+    'adventure', 'mystery', 'garden', 'history', 'science', 'ocean', 'winter',
+    'kitchen', 'travel', 'music', 'desert', 'castle', 'river', 'galaxy',
+    'detective', 'dragon', 'machine', 'island', 'forest', 'city']
+_TV_BRANDS = ['Mega TVs', 'Vision', 'Brightline', 'Pixelcraft']
+_TV_TYPES = ['plasma', 'lcd', 'led']
+
+def create_catalog_data(n, seed=0):
+  """Generate n synthetic product rows, alternating between the book and
+  television categories, with valid pids and randomly varied text and prices.
+  Unlike create_test_data, the rows are generated lazily, so that large
+  catalogs need not be held in memory."""
+  rnd = random.Random(seed)
+  for i in xrange(n):
+    words = ' '.join(rnd.sample(_CATALOG_WORDS, 3))
+    price = round(rnd.uniform(1, 2000), 2)
+    if i % 2:
+      yield dict(
+          pid='tv%d' % i, name='%s tv %d' % (words, i),
+          category='hd televisions', price=price,
+          size=rnd.choice([26, 32, 42, 50, 60]),
+          brand=rnd.choice(_TV_BRANDS), tv_type=rnd.choice(_TV_TYPES),
+          description='A %s television about %s' % (
+              rnd.choice(_TV_TYPES), words))
+    else:
+      yield dict(
+          PRODUCT_PARAMS, pid='book%d' % i, name='%s %d' % (words, i),
+          title=words, price=price, pages=rnd.randint(50, 1000),
+          author='Author %d' % rnd.randint(1, 1000), isbn=str(i),
+          description='A book about %s' % words)
+
 
 class FTSTestCase(unittest.TestCase):
 
@@ -93,7 +141,9 @@ class FTSTestCase(unittest.TestCase):
     # Initialize the datastore stub with this policy.
     self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
     self.testbed.init_memcache_stub()
-    self.testbed.init_taskqueue_stub()
+    # the app's queue.yaml defines the review ingestion pull queue.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
     # search stub is not available via testbed, so doing this by
     # myself.
@@ -121,6 +171,133 @@ class FTSTestCase(unittest.TestCase):
     for doc in res:
       self.assertEqual(doc.doc_id, product.doc_id)
 
+  def testShardedRatingsAggregation(self):
+    "Check that sharded ratings are rolled up once per product and window."
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    config.RATINGS_AGGREGATION = 'sharded'
+    config.BATCH_RATINGS_UPDATE = False
+    try:
+      for i, rating in enumerate([5, 4, 4, 3]):
+        review = models.Review(product_key=product.key, username='u%s' % i,
+                               rating=rating, comment='comment')
+        review.put()
+        utils.updateAverageRating(review.key)
+        # adding the same review twice has no effect.
+        utils.updateAverageRating(review.key)
+      # the product itself is only updated by the rollup.
+      self.assertEqual(models.Product.get_by_id(product.pid).num_reviews, 0)
+      taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+      self.assertEqual(len(taskq.GetTasks("default")), 1)
+      self._runTasks()
+    finally:
+      config.RATINGS_AGGREGATION = 'transactional'
+
+    product = models.Product.get_by_id(product.pid)
+    self.assertEqual(product.num_reviews, 4)
+    self.assertEqual(product.avg_rating, 4.0)
+    self.assertFalse(product.needs_review_reindex)
+    doc = docs.Product(docs.Product.getDoc(product.doc_id))
+    self.assertEqual(doc.getAvgRating(), 4.0)
+
+    # a stale rollup, which read fewer ratings than the product has, does not
+    # roll the product back.
+    product.num_reviews, product.avg_rating = 5, 3.8
+    product.put()
+    changes = models.ProductChange.query(ancestor=product.key).count()
+    models.Product.rollupRatings(product.pid)
+    product = models.Product.get_by_id(product.pid)
+    self.assertEqual((product.num_reviews, product.avg_rating), (5, 3.8))
+    self.assertEqual(
+        models.ProductChange.query(ancestor=product.key).count(), changes)
+
+    models.Review.deleteReviews(product.pid)
+    self.assertEqual(models.ProductRatingShard.query().count(), 0)
+
+  def testReviewIngestion(self):
+    "Check that queued reviews are applied to their product in a batch."
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    config.BATCH_RATINGS_UPDATE = False
+    for i, rating in enumerate([5, 3, 4]):
+      def _tx():
+        review = models.Review(product_key=product.key, username='u%s' % i,
+                               rating=rating, comment='comment')
+        review.put()
+        reviewingest.queueReview(review)
+      ndb.transaction(_tx)
+      reviewingest.scheduleIngestion(product.pid)
+    taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    # a single processing task is scheduled for the product's window.
+    self.assertEqual(len(taskq.GetTasks("default")), 1)
+
+    self.assertEqual(reviewingest.ingestProductReviews(product.pid), 3)
+    product = models.Product.get_by_id(product.pid)
+    self.assertEqual(product.num_reviews, 3)
+    self.assertEqual(product.avg_rating, 4.0)
+    self.assertEqual(len(product.reviews()), 3)
+    doc = docs.Product(docs.Product.getDoc(product.doc_id))
+    self.assertEqual(doc.getAvgRating(), 4.0)
+    # the queue has been emptied.
+    self.assertEqual(reviewingest.ingestAllReviews(), 0)
+
+  def testUpsertProducts(self):
+    "Check that bulk upserts only write the products that changed."
+    models.Category.buildAllCategories()
+    rows = create_test_data(3)
+    for row in rows:
+      row['pid'] = row['pid'].replace(' ', '')
+    report = docs.Product.upsertProducts(rows + [{}])
+    self.assertEqual(report, {'created': 3, 'updated': 0, 'unchanged': 0,
+                              'failed': 1})
+    doc = docs.Product.getDoc(rows[0]['pid'])
+    docs.Product(doc).setAvgRating(4.0)
+    docs.Product.add(doc)
+
+    rows[0]['price'] = 10
+    rows[1]['description'] = 'A new description'
+    report = docs.Product.upsertProducts(rows)
+    self.assertEqual(report, {'created': 0, 'updated': 2, 'unchanged': 1,
+                              'failed': 0})
+    product = models.Product.get_by_id(rows[0]['pid'])
+    self.assertEqual(product.price, 10)
+    # the doc's ratings info is retained.
+    doc = docs.Product(docs.Product.getDoc(rows[0]['pid']))
+    self.assertEqual(doc.getAvgRating(), 4.0)
+    self.assertEqual(doc.getPrice(), 10)
+
+  def testProductChangeLog(self):
+    "Check the content hashes and the change log of product mutations."
+    models.Category.buildAllCategories()
+    docs.Product.buildProductBatch(create_test_data(2))
+    params = dict(PRODUCT_PARAMS)
+    docs.Product.buildProduct(params)
+    params['description'] = 'A new description'
+    product = docs.Product.buildProduct(params)
+    doc = docs.Product.getDocFromPid(product.key.id())
+    self.assertEqual(product.content_hash,
+                     docs.Product(doc).getContentHash())
+    self.assertEqual(product.content_hash,
+                     docs.Product._hashFields(doc.fields))
+
+    changes = models.ProductChange.since(0)
+    self.assertEqual([change.op for change in changes],
+                     [models.ProductChange.CREATE] * 3 +
+                     [models.ProductChange.UPDATE])
+    self.assertEqual(changes[-1].pid, product.key.id())
+    self.assertEqual(changes[-1].content_hash, product.content_hash)
+    self.assertEqual(models.ProductChange.since(changes[1].seq, limit=1),
+                     [changes[2]])
+
+  def testCreateCatalogData(self):
+    "Check that the synthetic catalog rows all make valid products."
+    models.Category.buildAllCategories()
+    docs.Product.buildProductBatch(list(create_catalog_data(10)))
+    self.assertEqual(models.Product.query().count(), 10)
+    self.assertEqual(
+        models.Product.query(
+            models.Product.category == 'hd televisions').count(), 5)
+
   def testUpdateAverageRatingNonBatch1(self):
     "Test non-batch mode avg ratings updating."
     models.Category.buildAllCategories()
@@ -226,6 +403,372 @@ class FTSTestCase(unittest.TestCase):
     res = docs.Product.getIndex().search(sq)
     self.assertEqual(res.number_found, 0)
 
+    # the batch update re-indexes the doc, and clears the entity's flag.
+    self.assertTrue(product.needs_review_reindex)
+    models.Product.reindexFlaggedProducts()
+    product = models.Product.get_by_id(product.pid)
+    self.assertFalse(product.needs_review_reindex)
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 1)
+
+  def testCategoryCache(self):
+    "Check the cached category information and tree."
+    models.Category.invalidateCache()
+    self.assertEqual(models.Category.getCategoryInfo(),
+                     [('books', 'books'), ('hd televisions', 'hd televisions')])
+    self.assertEqual(models.Category.getChildCategories('root'),
+                     ['books', 'hd televisions'])
+    self.assertEqual(models.Category.getCategoryPath('books'),
+                     ['root', 'books'])
+    self.assertEqual(sorted(models.Category.getDescendantCategories('root')),
+                     ['books', 'hd televisions', 'root'])
+
+    # a new category propagates once the version is bumped.
+    models.Category(id='radios',
+                    parent_category=ndb.Key(models.Category, 'root')).put()
+    models.Category.invalidateCache()
+    self.assertEqual(models.Category.getCategoryPath('radios'),
+                     ['root', 'radios'])
+
+  def testCategoryHierarchy(self):
+    "Check that category facets and filters follow the category tree."
+    models.Category.buildAllCategories()
+    models.Category(id='oled', parent_category=ndb.Key(
+        models.Category, 'hd televisions')).put()
+    models.Category.invalidateCache()
+
+    def facets(counts):
+      return [search.FacetResult(name=docs.Product.CATEGORY, values=[
+          search.FacetResultValue(label, count, search.FacetRefinement(
+              name=docs.Product.CATEGORY, value=label))
+          for label, count in counts])]
+
+    def labels(links):
+      return [text for _, text in links]
+
+    # the counts of subcategories roll up into their top-level category.
+    results = facets([('books', 3), ('hd televisions', 2), ('oled', 2)])
+    self.assertEqual(
+        labels(docs.Product.generateCategoryLinks(results, {})),
+        ['hd televisions (4)', 'books (3)'])
+    # below a category, its children are linked to.
+    results = facets([('hd televisions', 2), ('oled', 2)])
+    self.assertEqual(labels(docs.Product.generateCategoryLinks(
+        results, {}, 'hd televisions')), ['hd televisions (2)', 'oled (2)'])
+
+    for pid in ['p1', 'p2']:
+      docs.Product.buildProduct(dict(
+          pid=pid, name='tv %s' % pid, category='hd televisions',
+          price=500, size=42, brand='Vision', tv_type='lcd',
+          description='A television'))
+    response = main.application.get_response(
+        '/psearch?category=hd+televisions')
+    self.assertEqual(response.status_int, 200)
+    self.assertTrue('pid=p1' in response.body and 'pid=p2' in response.body)
+
+  def testPagingPastOffsetLimit(self):
+    "Check that paging back by offset can page forward past its limit again."
+    handler = handlers.ProductSearchHandler()
+    doc_limit = handler._getDocLimit()
+    last = handler._OFFSET_LIMIT // doc_limit * doc_limit + doc_limit
+
+    def follow(link):
+      return dict(urlparse.parse_qsl(urlparse.urlsplit(link).query,
+                                     keep_blank_values=True))
+
+    def links(params, next_cursor=None):
+      return handler._generatePaginationLinks(
+          int(params['offset']), doc_limit, 5000, params, next_cursor)
+
+    # a page past the offset limit, fetched from a cursor.
+    params = dict(query='', offset=str(last), cursor='c1', pcursor='c0',
+                  ncursor='', noffset='')
+    prev_link, next_link = links(params, 'c2')
+    self.assertEqual(follow(next_link)['cursor'], 'c2')
+    # back two pages by offset, then forward again.
+    prev_params = follow(prev_link)
+    self.assertEqual(prev_params['offset'], str(last - doc_limit))
+    back_params = follow(links(prev_params)[0])
+    self.assertEqual(back_params['offset'], str(last - 2 * doc_limit))
+    next_params = follow(links(back_params)[1])
+    self.assertEqual(next_params['offset'], str(last - doc_limit))
+    self.assertEqual(next_params['cursor'], '')
+    # the page before the limit continues from the cursor it was left from.
+    next_params = follow(links(next_params)[1])
+    self.assertEqual(next_params['offset'], str(last))
+    self.assertEqual(next_params['cursor'], 'c1')
+
+  def testGetDocs(self):
+    "Check that documents can be fetched in bulk by id."
+    models.Category.buildAllCategories()
+    for pid in ['p1', 'p2', 'p4', 'p5']:
+      docs.Product.buildProduct(dict(PRODUCT_PARAMS, pid=pid))
+
+    res = docs.Product.getDocs(['p5', 'p1', 'p3', 'p2', 'zzz', 'bad id'])
+    self.assertEqual(sorted(res.keys()), ['p1', 'p2', 'p5'])
+    for doc_id, doc in res.iteritems():
+      self.assertEqual(doc.doc_id, doc_id)
+    self.assertEqual(docs.Product.getDoc('p4').doc_id, 'p4')
+    self.assertEqual(docs.Product.getDoc('p3'), None)
+
+  def testGetDocsSparse(self):
+    "Check that ids spread thinly through the index are fetched in two rounds."
+    index = docs.Product.getIndex()
+    index.put([search.Document(doc_id='d%03d' % i) for i in range(200)])
+    doc_ids = ['d%03d' % i for i in range(0, 200, 20)] + ['d999']
+    limits = []
+
+    class CountingIndex(object):
+      def get_range_async(self, **kwargs):
+        limits.append(kwargs['limit'])
+        return index.get_range_async(**kwargs)
+
+    docs.Product.getIndex = classmethod(lambda cls: CountingIndex())
+    try:
+      res = docs.Product.getDocs(doc_ids)
+    finally:
+      del docs.Product.getIndex
+    self.assertEqual(sorted(res.keys()), doc_ids[:-1])
+    # one range scan of the run, then a lookup of each id it did not reach.
+    self.assertEqual(limits, [len(doc_ids)] + [1] * (len(doc_ids) - 1))
+
+  def testImportData(self):
+    "Check the batched, pipelined import of product rows."
+    models.Category.buildAllCategories()
+    rows = [dict(PRODUCT_PARAMS, pid='p%d' % i) for i in range(7)]
+    rows.append(dict(PRODUCT_PARAMS, pid='bad', price='not a price'))
+
+    report = importer.ProductImporter(
+        batch_size=3, max_in_flight=2).run(iter(rows))
+    self.assertEqual(report['rows'], 8)
+    self.assertEqual(report['imported'], 7)
+    self.assertEqual(report['failed'], 1)
+    self.assertEqual(report['batches'], 3)
+    self.assertEqual(models.Product.query().count(), 7)
+    self.assertEqual(models.Product.get_by_id('p3').doc_id, 'p3')
+    self.assertEqual(len(docs.Product.getDocs(['p%d' % i for i in range(7)])),
+                     7)
+
+  def testImportRetries(self):
+    "Check that failures other than search errors are retried when indexing."
+    models.Category.buildAllCategories()
+    rows = [dict(PRODUCT_PARAMS, pid='p%d' % i) for i in range(4)]
+    index = docs.Product.getIndex()
+    failures = [apiproxy_errors.DeadlineExceededError('deadline')]
+
+    class FailingFuture(object):
+      def get_result(self):
+        raise failures.pop()
+
+    class FlakyIndex(object):
+      def put_async(self, documents):
+        if failures:
+          return FailingFuture()
+        return index.put_async(documents)
+
+    product_importer = importer.ProductImporter(batch_size=2, max_retries=1)
+    product_importer.RETRY_DELAY = 0
+    docs.Product.getIndex = classmethod(lambda cls: FlakyIndex())
+    try:
+      report = product_importer.run(iter(rows))
+    finally:
+      del docs.Product.getIndex
+    self.assertEqual((report['imported'], report['failed'], report['retries']),
+                     (4, 0, 1))
+    self.assertEqual(models.Product.query().count(), 4)
+
+  def testDeleteRange(self):
+    "Check the deletion of ranges of docs, and of all docs, in an index."
+    models.Category.buildAllCategories()
+    pids = ['p1', 'p2', 'p3', 'p4', 'p5']
+    for pid in pids:
+      docs.Product.buildProduct(dict(PRODUCT_PARAMS, pid=pid))
+
+    deleted, last_id = docs.Product.deleteRange('p2', 'p4')
+    self.assertEqual((deleted, last_id), (2, None))
+    self.assertEqual(sorted(docs.Product.getDocs(pids).keys()),
+                     ['p1', 'p4', 'p5'])
+    # a deletion past its deadline still deletes a batch before stopping, so
+    # that it resumes after an id it has deleted.
+    batch_size = docs.Product._DELETE_BATCH_SIZE
+    docs.Product._DELETE_BATCH_SIZE = 1
+    try:
+      deleted, last_id = docs.Product.deleteRange(
+          None, None, time.time() - 1)
+      self.assertEqual((deleted, last_id), (1, 'p1'))
+      deleted, last_id = docs.Product.deleteRange(
+          last_id, 'p5', time.time() - 1, include_start=False)
+      self.assertEqual((deleted, last_id), (1, None))
+    finally:
+      docs.Product._DELETE_BATCH_SIZE = batch_size
+    self.assertEqual(sorted(docs.Product.getDocs(pids).keys()), ['p5'])
+    self.assertTrue(docs.Product.deleteAllInIndex())
+    self.assertEqual(docs.Product.getDocs(pids), {})
+
+  def _runTasks(self):
+    """Run the task queue tasks, including any they add, until none are
+    left."""
+    taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskq.GetTasks("default")
+    taskq.FlushQueue("default")
+    while tasks:
+      for task in tasks:
+        deferred.run(base64.b64decode(task["body"]))
+      tasks = taskq.GetTasks("default")
+      taskq.FlushQueue("default")
+
+  def testReinitAll(self):
+    "Check that the reinit job deletes all product data, and completes."
+    models.Category.buildAllCategories()
+    for pid in ['p1', 'p2', 'p3']:
+      product = docs.Product.buildProduct(dict(PRODUCT_PARAMS, pid=pid))
+      models.Review(product_key=product.key, username='bob', rating=4,
+                    comment='comment').put()
+
+    job = admin_handlers.reinitAll(sample_data=False)
+    self._runTasks()
+
+    self.assertEqual(models.Product.query().count(), 0)
+    self.assertEqual(models.Review.query().count(), 0)
+    self.assertEqual(docs.Product.getDocs(['p1', 'p2', 'p3']), {})
+    # the deletions are recorded in the change log.
+    self.assertEqual(
+        sorted(change.pid for change in models.ProductChange.query(
+            models.ProductChange.op == models.ProductChange.DELETE)),
+        ['p1', 'p2', 'p3'])
+    status = reinit.getJobStatus(job.key.get())
+    self.assertEqual(status['phase'], reinit.DONE)
+    self.assertEqual(status['pending_shards'], 0)
+    self.assertTrue(all(shard['done'] for shard in status['shards']))
+
+  def testReconcile(self):
+    "Check that the consistency check finds, and repairs, divergent data."
+    models.Category.buildAllCategories()
+    for pid in ['p1', 'p2', 'p3', 'p4', 'p5']:
+      docs.Product.buildProduct(dict(PRODUCT_PARAMS, pid=pid))
+    ndb.Key(models.Product, 'p1').delete()  # orphaned doc
+    docs.Product.removeProductDocByPid('p2')  # missing doc
+    p3, p4 = ndb.get_multi([ndb.Key(models.Product, 'p3'),
+                            ndb.Key(models.Product, 'p4')])
+    p3.price = 1.0  # stale product data
+    p4.avg_rating = 3.0  # stale rating
+    ndb.put_multi([p3, p4])
+
+    job = reconcile.startJob(repair=False)
+    self._runTasks()
+    status = reconcile.getJobStatus(job.key.get())
+    self.assertEqual(
+        [status[count] for count in
+         ('pending_shards', 'checked', 'orphaned', 'missing', 'stale',
+          'repaired')],
+        [0, 5, 1, 1, 2, 0])
+    self.assertEqual(status['missing_ids'], ['p2'])
+
+    job = reconcile.startJob()
+    self._runTasks()
+    self.assertEqual(reconcile.getJobStatus(job.key.get())['repaired'], 3)
+    self.assertEqual(docs.Product.getDoc('p1'), None)
+    self.assertEqual(
+        [change.pid for change in models.ProductChange.query(
+            models.ProductChange.op == models.ProductChange.DELETE)],
+        ['p1'])
+    self.assertEqual(models.Product.get_by_id('p3').price, 2000)
+    self.assertEqual(
+        docs.Product(docs.Product.getDoc('p4')).getAvgRating(), 3.0)
+
+  def testGenerateRatingsBucketsAsync(self):
+    "Check that the async ratings facet query gives the same buckets."
+    models.Category.buildAllCategories()
+    docs.Product.buildProduct(PRODUCT_PARAMS)
+    future = docs.Product.generateRatingsBucketsAsync('Sherlock')
+    self.assertEqual(future.get_result(),
+                     docs.Product.generateRatingsBuckets('Sherlock'))
+
+  def testRequestProfiling(self):
+    "Check that the spans and RPCs of a profiled request are recorded."
+    models.Category.buildAllCategories()
+    docs.Product.buildProduct(PRODUCT_PARAMS)
+    self.assertEqual(profiling.span('unprofiled'), profiling._NULL_SPAN)
+
+    profiling.start('/psearch')
+    models.Category.getCategoryInfo()
+    docs.Product.generateRatingsBuckets('Sherlock')
+    profile = profiling.finish()
+    self.assertEqual(profiling.current(), None)
+    self.assertEqual(profile.spans['ratings_buckets'][0], 1)
+    self.assertEqual(profile.spans['index.search'][0], 1)
+    self.assertTrue(profile.rpcs['search.Search'] >= 1)
+    self.assertTrue('ratings_buckets;dur=' in profile.serverTiming())
+    self.assertEqual(profile.summary()['path'], '/psearch')
+
+  def testFragmentCache(self):
+    "Check that page fragments are cached, and keyed on the categories."
+    models.Category.buildAllCategories()
+    fragments.clear()
+    renderer = jinja2.get_jinja2(app=main.application)
+    menu = fragments.categoryMenu(renderer, 'books')
+    self.assertTrue('value="books" selected="selected"' in menu)
+    hits = fragments._cache.hits
+    self.assertEqual(fragments.categoryMenu(renderer, 'books'), menu)
+    self.assertEqual(fragments._cache.hits, hits + 1)
+    # invalid selections share the unselected menu.
+    self.assertEqual(fragments.categoryMenu(renderer, 'bogus'),
+                     fragments.categoryMenu(renderer, None))
+    self.assertTrue('/logout' in fragments.sidebarLinks(renderer, True))
+    self.assertTrue('/login' in fragments.sidebarLinks(renderer, False))
+
+    response = main.application.get_response('/')
+    self.assertEqual(response.status_int, 200)
+    self.assertTrue('href="/login"' in response.body)
+    self.assertTrue('<option value="books">' in response.body)
+
+  def testWarmup(self):
+    "Check that warmup compiles the templates into the bytecode cache."
+    models.Category.buildAllCategories()
+    response = main.application.get_response('/_ah/warmup')
+    self.assertEqual(response.status_int, 200)
+    # a new instance finds the compiled templates in memcache.
+    environment = jinja2.Jinja2(
+        main.application,
+        config={'environment_args':
+                base_handler.templateEnvironmentArgs()}).environment
+    source, filename, _ = environment.loader.get_source(
+        environment, 'index.html')
+    bucket = environment.bytecode_cache.get_bucket(
+        environment, 'index.html', filename, source)
+    self.assertTrue(bucket.code is not None)
+
+  def testLazyRoutes(self):
+    "Check that the handlers are only imported when a request is routed."
+    for route in main.application.router.match_routes:
+      self.assertTrue(isinstance(route.handler, basestring))
+    self.assertFalse(hasattr(models, 'docs'))
+    response = main.application.get_response('/login')
+    self.assertEqual(response.status_int, 302)
+
+  def testSearchCacheInvalidation(self):
+    "Check that modifying the index invalidates its cached results."
+    models.Category.buildAllCategories()
+    cache = searchcache.getCache(docs.Product._INDEX_NAME)
+    cache.set(('query',), {'number_found': 0})
+    self.assertEqual(cache.get(('query',)), {'number_found': 0})
+
+    docs.Product.buildProduct(PRODUCT_PARAMS)
+    self.assertEqual(cache.get(('query',)), None)
+
+    # a generation evicted from memcache is not restarted at an earlier one.
+    generation = cache.getGeneration()
+    cache.set(('query',), {'number_found': 1})
+    memcache.delete(searchcache.SearchResultCache._GENERATION_KEY %
+                    docs.Product._INDEX_NAME)
+    check_seconds = config.SEARCH_GENERATION_CHECK_SECONDS
+    config.SEARCH_GENERATION_CHECK_SECONDS = 0
+    try:
+      self.assertNotEqual(cache.getGeneration(), generation)
+      self.assertEqual(cache.get(('query',)), None)
+    finally:
+      config.SEARCH_GENERATION_CHECK_SECONDS = check_seconds
+
 
 if __name__ == '__main__':
   unittest.main()
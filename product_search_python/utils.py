@@ -43,7 +43,7 @@ def updateAverageRating(review_key):
   """Helper function for updating the average rating of a product when new
   review(s) are added."""
 
-  def _tx():
+  def _tx(seq):
     review = review_key.get()
     product = review.product_key.get()
     if not review.rating_added:
@@ -53,7 +53,9 @@ def updateAverageRating(review_key):
           (review.rating - product.avg_rating)/float(product.num_reviews))
       # signal that we need to reindex the doc with the new ratings info.
       product.needs_review_reindex = True
-      ndb.put_multi([product, review])
+      change = models.ProductChange.build(
+          seq, product.key, models.ProductChange.RATING, product)
+      ndb.put_multi([product, review, change])
       # We need to update the ratings associated document at some point as well.
       # If the app is configured to have BATCH_RATINGS_UPDATE set to True, don't
       # do this re-indexing now.  (Instead, all the out-of-date documents can be
@@ -66,8 +68,14 @@ def updateAverageRating(review_key):
     return (product, review)
 
   try:
-    # use an XG transaction in order to update both entities at once
-    ndb.transaction(_tx, xg=True)
+    if config.RATINGS_AGGREGATION == 'sharded':
+      # count the rating in a shard of the product's ratings counter, rather
+      # than in the product entity itself.
+      models.ProductRatingShard.addRating(review_key)
+    else:
+      # use an XG transaction in order to update both entities at once
+      seq = models.ProductChange.allocateSeqs(1)[0]
+      ndb.transaction(lambda: _tx(seq), xg=True)
   except AttributeError:
     # swallow this error and log it; it's not recoverable.
     logging.exception('The function updateAverageRating failed. Either review '